@@ -56,6 +56,12 @@ main = syncreg.wsgiapp:make_app
 
 [paste.app_install]
 main = paste.script.appinstall:Installer
+
+[paste.server_runner]
+prefork = syncreg.server:run_prefork
+
+[console_scripts]
+syncreg = syncreg.command:main
 """
 
 setup(name='SyncReg', version=version, packages=find_packages(),
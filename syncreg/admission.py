@@ -0,0 +1,177 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Admission control by route class.
+
+Routes are grouped in classes, each with its own concurrency limit and
+bounded wait queue. When the slow routes (password reset, user creation)
+are stuck on SMTP or captcha, they fill their own class and the extra
+requests are shed with a 503, while the cheap lookups keep being served.
+
+Example, in the [admission] section:
+
+    classes = lookup, slow
+    lookup.routes = user_exists, user_node
+    lookup.max_concurrency = 50
+    lookup.max_queue = 200
+    lookup.queue_timeout = 1
+    slow.routes = password_reset, create_user, do_password_reset
+    slow.max_concurrency = 10
+    slow.max_queue = 10
+    slow.queue_timeout = 2
+    slow.retry_after = 10
+
+Routes that are not in any class are not limited. The limits apply per
+process: they are useful with threaded or green workers.
+"""
+import time
+import threading
+
+from webob.exc import HTTPServiceUnavailable
+
+from syncreg import deadline
+from syncreg.util import split_list
+
+
+class RouteClass(object):
+    """Concurrency limit with a bounded wait queue.
+
+    Args:
+        name: name of the class
+        max_concurrency: requests served at the same time
+        max_queue: requests allowed to wait for a slot
+        queue_timeout: maximum wait for a slot, in seconds
+        retry_after: value of the Retry-After header of shed requests
+    """
+    def __init__(self, name, max_concurrency=10, max_queue=10,
+                 queue_timeout=1., retry_after=5):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        self.shed = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Takes a slot. Returns False if the request has to be shed.
+
+        Args:
+            timeout: maximum wait, when smaller than the queue timeout
+        """
+        self._cond.acquire()
+        try:
+            if self.active < self.max_concurrency:
+                self.active += 1
+                return True
+
+            if self.waiting >= self.max_queue:
+                self.shed += 1
+                return False
+
+            self.waiting += 1
+            try:
+                if timeout is None or timeout > self.queue_timeout:
+                    timeout = self.queue_timeout
+                limit = time.time() + timeout
+                while self.active >= self.max_concurrency:
+                    remaining = limit - time.time()
+                    if remaining <= 0:
+                        self.shed += 1
+                        return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+        finally:
+            self._cond.release()
+
+    def release(self):
+        """Gives back a slot."""
+        self._cond.acquire()
+        try:
+            self.active -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def stats(self):
+        return {'active': self.active, 'waiting': self.waiting,
+                'shed': self.shed}
+
+
+class AdmissionControl(object):
+    """Holds the route classes, configured from the [admission] section."""
+
+    def __init__(self, config):
+        self.classes = {}
+        self.routes = {}
+        for name in split_list(config.get('admission.classes')):
+            prefix = 'admission.%s.' % name
+            options = dict([(option, config[prefix + option])
+                            for option in ('max_concurrency', 'max_queue',
+                                           'queue_timeout', 'retry_after')
+                            if prefix + option in config])
+            route_class = RouteClass(name, **options)
+            self.classes[name] = route_class
+            for route in split_list(config.get(prefix + 'routes')):
+                self.routes[route] = route_class
+
+    def wrap(self, action, function):
+        """Returns function, limited by the class of the action."""
+        route_class = self.routes.get(action)
+        if route_class is None:
+            return function
+
+        def _admitted(request, *args, **kw):
+            # no need to wait longer than the request's deadline
+            if not route_class.acquire(deadline.remaining()):
+                # shed because the request ran out of time
+                deadline.check()
+                raise HTTPServiceUnavailable(
+                        retry_after=route_class.retry_after)
+            try:
+                return function(request, *args, **kw)
+            finally:
+                route_class.release()
+        return _admitted
+
+    def stats(self):
+        return dict([(name, route_class.stats())
+                     for name, route_class in self.classes.items()])
@@ -0,0 +1,377 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Reset code backend storing the codes in a local SQLite database.
+
+    [reset_codes]
+    backend = syncreg.backends.resetcodes.SQLiteResetCode
+    path = /var/lib/syncreg/reset_codes.db
+    expiration = 21600
+    resend_delay = 60
+    max_codes = 100000
+    sweep_interval = 60
+
+The database is in WAL mode, so the workers of a server can share it and
+readers don't wait for the writers. Only a hash of each code is stored.
+
+Every process keeps the expiration times of its codes in a heap, loaded
+from the database when the process first uses the backend, so the expired
+ones are purged without scanning the table. The index of a process holds
+at most max_codes codes: past that, the codes closest to their expiration
+are dropped first, and logged. Every sweep_interval seconds, a process
+also deletes the expired codes of the other processes through the index
+on the expiration, and trims the table to max_codes.
+
+A code asked again within resend_delay seconds is not regenerated, and
+AlreadySentError is raised: the e-mail sent for the previous one is still
+on its way.
+"""
+import os
+import time
+import heapq
+import random
+import sqlite3
+import threading
+from hashlib import sha256
+
+from services.resetcodes import AlreadySentError
+
+from syncreg import logger
+
+
+_SCHEMA = """\
+CREATE TABLE IF NOT EXISTS reset_codes (
+    username TEXT PRIMARY KEY,
+    code TEXT NOT NULL,
+    created REAL NOT NULL,
+    expiration REAL NOT NULL
+)"""
+
+_INDEX = """\
+CREATE INDEX IF NOT EXISTS reset_codes_expiration
+ON reset_codes (expiration)"""
+
+_CHARS = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'
+_random = random.SystemRandom()
+
+
+def _hash(code):
+    if isinstance(code, unicode):
+        code = code.encode('utf8')
+    return sha256(code.strip().upper()).hexdigest()
+
+
+class SQLiteResetCode(object):
+    """Reset codes stored in SQLite, with an in-memory expiration index.
+
+    Args:
+        path: location of the database file
+        expiration: lifetime of a code, in seconds
+        resend_delay: seconds during which a code is not regenerated
+        max_codes: maximum number of live codes
+        timeout: seconds to wait for a lock on the database
+        sweep_interval: seconds between two sweeps of the whole table
+    """
+    def __init__(self, path='/tmp/reset_codes.db', expiration=6 * 3600,
+                 resend_delay=60, max_codes=100000, timeout=5.,
+                 sweep_interval=60, **kw):
+        self.path = path
+        self.expiration = expiration
+        self.resend_delay = resend_delay
+        self.max_codes = max_codes
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = None
+        self._next_sweep = 0
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(_SCHEMA)
+        conn.execute(_INDEX)
+        self._load()
+
+    def _conn(self):
+        """Returns the connection of the current thread and process."""
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = pid
+        return self._local.conn
+
+    def _load(self):
+        """Rebuilds the expiration index from the database."""
+        self._pid = os.getpid()
+        rows = self._conn().execute('SELECT username, expiration '
+                                    'FROM reset_codes').fetchall()
+        self._lock.acquire()
+        try:
+            # the most recent ones, if the table is over max_codes
+            rows.sort(key=lambda row: row[1])
+            rows = rows[-self.max_codes:]
+            self._expires = dict(rows)
+            self._heap = [(expiration, username)
+                          for username, expiration in rows]
+            heapq.heapify(self._heap)
+        finally:
+            self._lock.release()
+        self.purge()
+
+    def _generate(self):
+        code = ''.join([_random.choice(_CHARS) for i in range(16)])
+        return '-'.join([code[i:i + 4] for i in range(0, 16, 4)])
+
+    def _index(self, username, expiration):
+        """Adds a code to the index, and returns the users to evict."""
+        evicted = []
+        self._lock.acquire()
+        try:
+            self._expires[username] = expiration
+            heapq.heappush(self._heap, (expiration, username))
+            while len(self._expires) > self.max_codes:
+                evicted.append(self._pop())
+                self.evictions += 1
+            # replaced codes leave stale heap entries behind
+            if len(self._heap) > 2 * len(self._expires) + 64:
+                self._heap = [(expires, name) for name, expires
+                              in self._expires.items()]
+                heapq.heapify(self._heap)
+        finally:
+            self._lock.release()
+        return evicted
+
+    def _pop(self):
+        """Removes the next code to expire from the index."""
+        while True:
+            expiration, username = heapq.heappop(self._heap)
+            if self._expires.get(username) == expiration:
+                del self._expires[username]
+                return username, expiration
+
+    def _unindex(self, username):
+        self._lock.acquire()
+        try:
+            # the heap entry is dropped when it surfaces
+            self._expires.pop(username, None)
+        finally:
+            self._lock.release()
+
+    def _evict(self, codes):
+        """Deletes live codes, to stay under max_codes."""
+        if codes:
+            logger.warning('%d live reset codes dropped past max_codes=%d, '
+                           '%d so far' % (len(codes), self.max_codes,
+                                          self.evictions))
+        self._delete(codes)
+
+    def _delete(self, codes):
+        """Deletes codes, unless they were replaced in the meantime."""
+        if codes:
+            self._conn().executemany('DELETE FROM reset_codes WHERE '
+                                     'username = ? AND expiration = ?', codes)
+
+    def purge(self):
+        """Deletes the expired codes. Returns how many were found."""
+        if self._pid != os.getpid():
+            # forked: the index of the parent misses the codes generated
+            # since by its other children
+            self._load()
+        now = time.time()
+        expired = []
+        self._lock.acquire()
+        try:
+            while self._heap and self._heap[0][0] <= now:
+                expiration, username = heapq.heappop(self._heap)
+                if self._expires.get(username) == expiration:
+                    del self._expires[username]
+                    expired.append((username, expiration))
+        finally:
+            self._lock.release()
+        self._delete(expired)
+        purged = len(expired)
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            purged += self.sweep()
+        return purged
+
+    def sweep(self):
+        """Deletes the expired codes of all the processes, and the codes
+        closest to their expiration past max_codes. Returns how many were
+        deleted."""
+        now = time.time()
+        conn = self._conn()
+        deleted = conn.execute('DELETE FROM reset_codes WHERE '
+                               'expiration <= ?', (now,)).rowcount
+        over = conn.execute('SELECT COUNT(*) FROM reset_codes')
+        over = over.fetchone()[0] - self.max_codes
+        if over > 0:
+            conn.execute('DELETE FROM reset_codes WHERE username IN '
+                         '(SELECT username FROM reset_codes ORDER BY '
+                         'expiration LIMIT ?)', (over,))
+            self.evictions += over
+            logger.warning('%d live reset codes dropped past max_codes=%d, '
+                           '%d so far' % (over, self.max_codes,
+                                          self.evictions))
+            deleted += over
+        # the index entries of the deleted codes are dropped when they
+        # surface
+        return deleted
+
+    def ping(self):
+        self._conn().execute('SELECT 1')
+
+    def generate_reset_code(self, user, overwrite=False):
+        """Generates a reset code for the user, and returns it.
+
+        Raises AlreadySentError if a code was generated less than
+        resend_delay seconds ago, unless overwrite is True.
+        """
+        self.purge()
+        username = user['username']
+        now = time.time()
+        code = self._generate()
+        expiration = now + self.expiration
+        conn = self._conn()
+        # two workers can't both pass the resend_delay check
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if not overwrite and self.resend_delay:
+                row = conn.execute('SELECT created FROM reset_codes WHERE '
+                                   'username = ? AND expiration > ?',
+                                   (username, now)).fetchone()
+                if row is not None and row[0] + self.resend_delay > now:
+                    raise AlreadySentError()
+            conn.execute('INSERT OR REPLACE INTO reset_codes (username, '
+                         'code, created, expiration) VALUES (?, ?, ?, ?)',
+                         (username, _hash(code), now, expiration))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        self._evict(self._index(username, expiration))
+        return code
+
+    def generate_reset_codes(self, users):
+        """Generates new codes for several users, in one transaction.
+
+        Returns:
+            the codes, in the order of the users
+        """
+        self.purge()
+        now = time.time()
+        expiration = now + self.expiration
+        codes = [self._generate() for user in users]
+        rows = [(user['username'], _hash(code), now, expiration)
+                for user, code in zip(users, codes)]
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT OR REPLACE INTO reset_codes (username, '
+                             'code, created, expiration) VALUES '
+                             '(?, ?, ?, ?)', rows)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+        evicted = []
+        for user in users:
+            evicted.extend(self._index(user['username'], expiration))
+        self._evict(evicted)
+        return codes
+
+    def verify_reset_code(self, user, code):
+        """Returns True if the code is the live code of the user."""
+        if not code:
+            return False
+        row = self._conn().execute('SELECT code FROM reset_codes WHERE '
+                                   'username = ? AND expiration > ?',
+                                   (user['username'], time.time())).fetchone()
+        return row is not None and row[0] == _hash(code)
+
+    def use_reset_code(self, user, code, update):
+        """Claims the code, then calls update.
+
+        The code is deleted in a short transaction before update runs, so
+        of several concurrent calls with the same code, in any process,
+        only one calls update, and the database is not locked during the
+        call. When update raises, the code is put back, unless a new one
+        was generated meanwhile.
+
+        Returns:
+            False if the code is not the live code of the user
+        """
+        if not code:
+            return False
+        username = user['username']
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT code, created, expiration FROM '
+                               'reset_codes WHERE username = ? AND '
+                               'expiration > ?',
+                               (username, time.time())).fetchone()
+            if row is None or row[0] != _hash(code):
+                conn.execute('ROLLBACK')
+                return False
+            conn.execute('DELETE FROM reset_codes WHERE username = ?',
+                         (username,))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        self._unindex(username)
+
+        try:
+            update()
+        except Exception:
+            conn.execute('INSERT OR IGNORE INTO reset_codes (username, '
+                         'code, created, expiration) VALUES (?, ?, ?, ?)',
+                         (username,) + tuple(row))
+            self._evict(self._index(username, row[2]))
+            raise
+        return True
+
+    def clear_reset_code(self, user):
+        username = user['username']
+        self._conn().execute('DELETE FROM reset_codes WHERE username = ?',
+                             (username,))
+        self._unindex(username)
+        return True
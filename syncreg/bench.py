@@ -0,0 +1,277 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Benchmarks.
+
+    $ syncreg bench http http://localhost:5000/user/1.0/xxx -c 50 -d 30
+
+"http" measures the throughput of a running server, and is the way to
+compare the pre-fork server with the Paste threadpool: run the same
+application behind both and point the benchmark at each of them.
+
+    $ syncreg bench resetcodes -n 10000 -c 4
+
+"resetcodes" measures the generate and verify throughput of the SQLite
+reset code backend, on a scratch database.
+
+    $ syncreg bench routes --compare baseline.json --threshold 20
+
+"routes" calls every route of the application in-process, see
+syncreg.benchroutes.
+
+    $ syncreg bench memory -n 100000
+
+"memory" measures the size of the entries of the caches, see
+syncreg.memory.
+"""
+import os
+import sys
+import time
+import threading
+import httplib
+import urlparse
+import tempfile
+import shutil
+from optparse import OptionParser
+
+
+def percentile(values, pct):
+    """Returns the pct percentile of a sorted list of values."""
+    if not values:
+        return 0.
+    index = int(round(pct / 100. * (len(values) - 1)))
+    return values[index]
+
+
+def summarize(durations, errors, elapsed):
+    """Summarizes a benchmark run
+
+    Args:
+        durations: durations of the successful calls, in seconds
+        errors: number of failed calls
+        elapsed: wall clock time of the run, in seconds
+
+    Returns:
+        a mapping with the rate and latency percentiles, in milliseconds
+    """
+    durations = sorted(durations)
+    total = len(durations) + errors
+    return {'requests': total,
+            'errors': errors,
+            'ops_per_sec': elapsed and len(durations) / elapsed or 0.,
+            'p50': percentile(durations, 50) * 1000,
+            'p90': percentile(durations, 90) * 1000,
+            'p99': percentile(durations, 99) * 1000}
+
+
+def bench_http(url, concurrency=10, duration=10., timeout=30.):
+    """Calls a url from concurrent threads for a given duration.
+
+    A new connection is opened for every call, like nginx does with its
+    upstreams by default.
+    """
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme == 'https':
+        conn_class = httplib.HTTPSConnection
+    else:
+        conn_class = httplib.HTTPConnection
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+
+    durations = []
+    errors = [0]
+    lock = threading.Lock()
+    end = time.time() + duration
+
+    def _worker():
+        while time.time() < end:
+            start = time.time()
+            try:
+                conn = conn_class(parsed.netloc, timeout=timeout)
+                try:
+                    conn.request('GET', path)
+                    resp = conn.getresponse()
+                    resp.read()
+                    ok = resp.status < 500
+                finally:
+                    conn.close()
+            except Exception:
+                ok = False
+            spent = time.time() - start
+            lock.acquire()
+            try:
+                if ok:
+                    durations.append(spent)
+                else:
+                    errors[0] += 1
+            finally:
+                lock.release()
+
+    started = time.time()
+    threads = [threading.Thread(target=_worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(durations, errors[0], time.time() - started)
+
+
+def _run_calls(function, items, concurrency):
+    """Calls function on every item from concurrent threads."""
+    durations = []
+    errors = [0]
+    lock = threading.Lock()
+    items = list(items)
+
+    def _worker(items):
+        for item in items:
+            start = time.time()
+            try:
+                function(item)
+                ok = True
+            except Exception:
+                ok = False
+            spent = time.time() - start
+            lock.acquire()
+            try:
+                if ok:
+                    durations.append(spent)
+                else:
+                    errors[0] += 1
+            finally:
+                lock.release()
+
+    started = time.time()
+    threads = [threading.Thread(target=_worker, args=(items[i::concurrency],))
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(durations, errors[0], time.time() - started)
+
+
+def bench_resetcodes(backend, count=10000, concurrency=1):
+    """Generates then verifies a code for count users.
+
+    Returns:
+        the summaries of the generate and the verify calls
+    """
+    users = [{'username': 'bench%d' % i} for i in range(count)]
+    codes = {}
+
+    def _generate(user):
+        codes[user['username']] = backend.generate_reset_code(user, True)
+
+    def _verify(user):
+        if not backend.verify_reset_code(user, codes[user['username']]):
+            raise ValueError(user['username'])
+
+    return (_run_calls(_generate, users, concurrency),
+            _run_calls(_verify, users, concurrency))
+
+
+def print_summary(name, summary, stream=sys.stdout):
+    stream.write('%-24s %8d req %6d err %10.1f ops/s  p50 %7.2fms  '
+                 'p99 %7.2fms\n' % (name, summary['requests'],
+                                    summary['errors'], summary['ops_per_sec'],
+                                    summary['p50'], summary['p99']))
+
+
+def _bench_http(args):
+    parser = OptionParser(usage='%prog [options] url [url ...]',
+                          prog='syncreg bench http')
+    parser.add_option('-c', '--concurrency', dest='concurrency', type='int',
+                      default=10, help='concurrent clients')
+    parser.add_option('-d', '--duration', dest='duration', type='float',
+                      default=10., help='duration of the run, in seconds')
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error('You need to provide at least one url')
+
+    for url in args:
+        summary = bench_http(url, options.concurrency, options.duration)
+        print_summary(url, summary)
+    return 0
+
+
+def _bench_resetcodes(args):
+    from syncreg.backends.resetcodes import SQLiteResetCode
+    parser = OptionParser(usage='%prog [options]',
+                          prog='syncreg bench resetcodes')
+    parser.add_option('-n', '--count', dest='count', type='int',
+                      default=10000, help='number of users')
+    parser.add_option('-c', '--concurrency', dest='concurrency', type='int',
+                      default=1, help='concurrent clients')
+    options, args = parser.parse_args(args)
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        backend = SQLiteResetCode(os.path.join(tempdir, 'reset_codes.db'),
+                                  max_codes=options.count)
+        generate, verify = bench_resetcodes(backend, options.count,
+                                            options.concurrency)
+    finally:
+        shutil.rmtree(tempdir)
+    print_summary('generate_reset_code', generate)
+    print_summary('verify_reset_code', verify)
+    return 0
+
+
+def _bench_memory(args):
+    from syncreg.memory import bench_memory_command
+    return bench_memory_command(args)
+
+
+def _bench_routes(args):
+    from syncreg.benchroutes import routes_command
+    return routes_command(args)
+
+
+_BENCHMARKS = {'http': _bench_http,
+               'memory': _bench_memory,
+               'resetcodes': _bench_resetcodes,
+               'routes': _bench_routes}
+
+
+def bench_command(args):
+    """Runs one of the benchmarks."""
+    if not args or args[0] not in _BENCHMARKS:
+        print >> sys.stderr, ('Usage: syncreg bench <%s> [options]' %
+                              '|'.join(sorted(_BENCHMARKS)))
+        return 1
+    return _BENCHMARKS[args[0]](args[1:])
@@ -0,0 +1,392 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Benchmark of every route of the application, run in-process.
+
+    $ syncreg bench routes -n 200 --save baseline.json
+    $ syncreg bench routes -n 200 --compare baseline.json --threshold 20
+
+The application is built by make_app from a configuration file (the one
+of the tests by default), with its databases moved to a scratch SQLite
+directory and seeded with users. Every route of wsgiapp.urls is then
+called through WSGI, one request at a time, and its rate and latency
+percentiles are reported. The admin routes listed in EXCLUDED are not
+benchmarked, and are reported as such.
+
+--save writes the results as a JSON baseline. --compare reads one and
+fails when the rate of a route dropped, or its median or p99 latency
+grew, by more than --threshold percent.
+"""
+import os
+import sys
+import time
+import base64
+import shutil
+import smtplib
+import tempfile
+from optparse import OptionParser
+from urllib import urlencode
+
+import simplejson as json
+from webob import Request
+
+from services.user import User, extract_username
+
+from syncreg.bench import summarize, print_summary
+from syncreg.reload import read_config
+from syncreg.util import unwrap_app, split_list
+
+_CONFIG = os.path.join(os.path.dirname(__file__), 'tests', 'sync.conf')
+_PASSWORD = 'x' * 9
+
+
+class _NullSMTP(object):
+    """Swallows the e-mails sent during the benchmark."""
+
+    def __init__(self, *args, **kw):
+        pass
+
+    def sendmail(self, *args, **kw):
+        return {}
+
+    def __getattr__(self, name):
+        return lambda *args, **kw: None
+
+
+def load_config(path=_CONFIG, directory=None):
+    """Reads a configuration file like sync.conf.
+
+    If directory is given, every SQL database is replaced by an SQLite
+    file in it.
+    """
+    config = read_config(path)
+    if directory is not None:
+        for key in config:
+            if key.endswith('.sqluri'):
+                name = key.rsplit('.', 1)[0].replace(':', '_')
+                config[key] = 'sqlite:///%s.db' % os.path.join(directory,
+                                                               name)
+    # nothing external is called
+    config['captcha.use'] = False
+    config['warmup.background'] = False
+    return config
+
+
+class _Context(object):
+    """The users and codes shared by the scenarios."""
+
+    def __init__(self, app, count):
+        self.app = app
+        self.controller = unwrap_app(app).controllers['user']
+        backend = unwrap_app(app).auth.backend
+        self.users = []
+        self.doomed = []
+        for i in range(count):
+            for prefix, users in (('bench', self.users),
+                                  ('doomed', self.doomed)):
+                email = '%s%d@example.com' % (prefix, i)
+                username = extract_username(email)
+                backend.create_user(username, _PASSWORD, email)
+                users.append(username)
+        self.created = 0
+
+    def auth(self, username):
+        token = base64.b64encode('%s:%s' % (username, _PASSWORD))
+        return {'Authorization': 'Basic %s' % token}
+
+
+def _user_url(username, path=''):
+    return '/user/1.0/%s%s' % (username, path)
+
+
+# action -> function(context, index) returning the arguments of the
+# request: method, path, body, headers
+def _user_exists(ctx, index):
+    return 'GET', _user_url(ctx.users[index]), '', {}
+
+
+def _create_user(ctx, index):
+    email = 'new%d-%d@example.com' % (index, time.time() * 1000)
+    body = json.dumps({'email': email, 'password': _PASSWORD})
+    return 'PUT', _user_url(extract_username(email)), body, {}
+
+
+def _delete_user(ctx, index):
+    username = ctx.doomed[index]
+    return 'DELETE', _user_url(username), '', ctx.auth(username)
+
+
+def _user_node(ctx, index):
+    return 'GET', _user_url(ctx.users[index], '/node/weave'), '', {}
+
+
+def _password_reset(ctx, index):
+    return ('GET', _user_url(ctx.users[index], '/password_reset'), '', {})
+
+
+def _delete_password_reset(ctx, index):
+    username = ctx.users[index]
+    return ('DELETE', _user_url(username, '/password_reset'), '',
+            ctx.auth(username))
+
+
+def _change_email(ctx, index):
+    username = ctx.users[index]
+    return ('POST', _user_url(username, '/email'),
+            'bench%d@example.com' % index, ctx.auth(username))
+
+
+def _change_password(ctx, index):
+    username = ctx.users[index]
+    return ('POST', _user_url(username, '/password'), _PASSWORD,
+            ctx.auth(username))
+
+
+def _password_reset_form(ctx, index):
+    return 'GET', '/weave-password-reset', '', {}
+
+
+def _do_password_reset(ctx, index):
+    username = ctx.users[index]
+    code = ctx.controller.reset.generate_reset_code(User(username), True)
+    body = urlencode({'username': username, 'key': code,
+                      'password': _PASSWORD, 'confirm': _PASSWORD})
+    return ('POST', '/weave-password-reset', body,
+            {'Content-Type': 'application/x-www-form-urlencoded'})
+
+
+def _captcha_form(ctx, index):
+    return 'GET', '/misc/1.0/captcha_html', '', {}
+
+
+def _get_file(ctx, index):
+    return 'GET', '/media/forgot_password.css', '', {}
+
+
+def _status(path):
+    def _request(ctx, index):
+        return 'GET', path, '', {}
+    return _request
+
+
+SCENARIOS = {'user_exists': _user_exists,
+             'create_user': _create_user,
+             'delete_user': _delete_user,
+             'user_node': _user_node,
+             'password_reset': _password_reset,
+             'delete_password_reset': _delete_password_reset,
+             'change_email': _change_email,
+             'change_password': _change_password,
+             'password_reset_form': _password_reset_form,
+             'do_password_reset': _do_password_reset,
+             'captcha_form': _captcha_form,
+             'get_file': _get_file,
+             'ready': _status('/__ready__'),
+             'health': _status('/__health__'),
+             'stats': _status('/__stats__')}
+
+# admin routes deliberately left out, with the reason
+EXCLUDED = {'reload': 'reloads the configuration file, not a request '
+                      'path worth timing',
+            'memory': 'needs memory.enabled, whose tracing would skew the '
+                      'other routes'}
+
+# the routes that answer 503 when a dependency is missing
+_UNAVAILABLE_OK = ('ready', 'health')
+
+
+def iter_routes(urls):
+    """Yields the name and action of the routes, in order."""
+    for url in urls:
+        method, action = url[0], url[3]
+        if isinstance(method, tuple):
+            method = method[0]
+        yield '%s %s' % (method, action), action
+
+
+def bench_route(app, ctx, action, count, warmup=10):
+    """Calls a route count times, after warmup calls.
+
+    Returns:
+        the summary of the timed calls
+    """
+    scenario = SCENARIOS[action]
+    requests = []
+    for index in range(warmup + count):
+        method, path, body, headers = scenario(ctx, index)
+        requests.append((method, path, body, headers))
+
+    durations = []
+    errors = 0
+    started = None
+    for index, (method, path, body, headers) in enumerate(requests):
+        if index == warmup:
+            started = time.time()
+        request = Request.blank(path, method=method, headers=headers)
+        if body:
+            request.body = body
+        start = time.time()
+        response = request.get_response(app)
+        spent = time.time() - start
+        if index < warmup:
+            continue
+        if response.status_int < 400 or (response.status_int == 503 and
+                                         action in _UNAVAILABLE_OK):
+            durations.append(spent)
+        else:
+            errors += 1
+    return summarize(durations, errors, time.time() - started)
+
+
+def bench_routes(app, urls, count=200, warmup=10, only=None):
+    """Benchmarks the routes of an application.
+
+    Args:
+        app: the WSGI application
+        urls: its routes, like wsgiapp.urls
+        count: timed calls per route
+        warmup: calls per route before the timed ones
+        only: names of the actions to run, None for all
+
+    Returns:
+        a mapping of the route names to their summaries
+    """
+    ctx = _Context(app, warmup + count)
+    results = {}
+    old_smtp = smtplib.SMTP
+    smtplib.SMTP = _NullSMTP
+    try:
+        for name, action in iter_routes(urls):
+            if only and action not in only:
+                continue
+            if action in EXCLUDED:
+                print >> sys.stderr, 'Not benchmarked: %s, %s' % (
+                        name, EXCLUDED[action])
+                continue
+            if action not in SCENARIOS:
+                print >> sys.stderr, 'No scenario for %s' % name
+                continue
+            results[name] = bench_route(app, ctx, action, count, warmup)
+    finally:
+        smtplib.SMTP = old_smtp
+    return results
+
+
+def find_regressions(results, baseline, threshold=20.):
+    """Compares results to a baseline.
+
+    Returns:
+        a list of (route name, message) for the routes whose rate dropped
+        or median or p99 latency grew by more than threshold percent
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        current, previous = results[name], baseline[name]
+        slower = previous['ops_per_sec'] * (1 - threshold / 100.)
+        if current['ops_per_sec'] < slower:
+            regressions.append((name, 'rate %.1f -> %.1f ops/s' %
+                                (previous['ops_per_sec'],
+                                 current['ops_per_sec'])))
+            continue
+        for percentile in ('p50', 'p99'):
+            # older baselines may lack a percentile
+            if not previous.get(percentile):
+                continue
+            longer = previous[percentile] * (1 + threshold / 100.)
+            if current[percentile] > longer:
+                regressions.append((name, '%s %.2f -> %.2f ms' %
+                                    (percentile, previous[percentile],
+                                     current[percentile])))
+                break
+    return regressions
+
+
+def routes_command(args):
+    """Runs the benchmark of the routes."""
+    parser = OptionParser(usage='%prog [options]',
+                          prog='syncreg bench routes')
+    parser.add_option('-c', '--config', dest='config', default=_CONFIG,
+                      help='configuration file, like sync.conf')
+    parser.add_option('-n', '--count', dest='count', type='int',
+                      default=200, help='timed calls per route')
+    parser.add_option('-w', '--warmup', dest='warmup', type='int',
+                      default=10, help='untimed calls per route')
+    parser.add_option('-r', '--routes', dest='routes', default=None,
+                      help='actions to run, comma separated')
+    parser.add_option('--save', dest='save', default=None,
+                      help='writes the results to this JSON file')
+    parser.add_option('--compare', dest='compare', default=None,
+                      help='JSON baseline to compare the results to')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float',
+                      default=20., help='regression, in percent')
+    options, args = parser.parse_args(args)
+
+    from syncreg.wsgiapp import make_app, urls
+
+    directory = tempfile.mkdtemp()
+    try:
+        config = load_config(options.config, directory)
+        app = make_app(config)
+        results = bench_routes(app, urls, options.count, options.warmup,
+                               split_list(options.routes))
+    finally:
+        shutil.rmtree(directory)
+
+    for name, __ in iter_routes(urls):
+        if name in results:
+            print_summary(name, results[name])
+
+    if options.save is not None:
+        f = open(options.save, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if options.compare is not None:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        regressions = find_regressions(results, baseline, options.threshold)
+        for name, message in regressions:
+            print >> sys.stderr, 'REGRESSION %s: %s' % (name, message)
+        if regressions:
+            return 1
+    return 0
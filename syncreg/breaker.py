@@ -0,0 +1,115 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Circuit breaker.
+
+After failure_threshold consecutive failures the circuit opens and the
+callers stop hitting the backend. Once reset_timeout seconds have passed,
+a single call is let through to probe the backend: the circuit closes if
+it succeeds, and opens again if it fails.
+"""
+import time
+import threading
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, failure_threshold=5, reset_timeout=10):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns True if the caller may call the backend.
+
+        The caller then has to report the outcome with success(),
+        failure() or cancel().
+        """
+        self._lock.acquire()
+        try:
+            if self.state == CLOSED:
+                return True
+            if self._probing:
+                return False
+            if time.time() - self.opened_at < self.reset_timeout:
+                return False
+            # this caller is the probe
+            self.state = HALF_OPEN
+            self._probing = True
+            return True
+        finally:
+            self._lock.release()
+
+    def success(self):
+        self._lock.acquire()
+        try:
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+        finally:
+            self._lock.release()
+
+    def failure(self):
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            if (self.state == HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.time()
+            self._probing = False
+        finally:
+            self._lock.release()
+
+    def cancel(self):
+        """The call ended without telling anything about the backend."""
+        self._lock.acquire()
+        try:
+            if self._probing:
+                # somebody else will probe
+                self._probing = False
+                self.state = OPEN
+        finally:
+            self._lock.release()
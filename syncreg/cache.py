@@ -0,0 +1,396 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Cache shared by the workers and the nodes.
+
+    [cache]
+    backend = syncreg.cache.MemcacheClient
+    servers = 10.0.0.1:11211, 10.0.0.2:11211
+    ttl = 300
+
+The user controller keeps the user lookups in it, and the idempotency
+store can use it with "idempotency.shared = true". Every write of a user
+deletes the user's keys, for all the workers at once.
+
+The backends provide get(key, default), get_multi(keys), set(key, value,
+ttl), add(key, value, ttl), incr(key, delta), delete(key) and
+delete_multi(keys). Values are strings, numbers, None, or lists and
+mappings of those. A ttl of 0 never expires.
+
+MemoryCache keeps the values in the process, for tests and single process
+servers. MemcacheClient speaks the memcached text protocol, spreading the
+keys over the servers with a hash ring. A multi-get or a multi-delete
+sends one request to each server before reading any answer. A server that
+fails is skipped for retry_delay seconds: its keys are misses meanwhile.
+
+syncreg.stubs.MemcacheStub is a memcached stand-in, listening on a TCP
+port or a unix socket.
+"""
+import os
+import re
+import time
+import socket
+import threading
+from hashlib import sha1
+
+import simplejson as json
+
+from services.pluginreg import load_and_configure
+
+from syncreg import logger
+from syncreg.backends.sharded import HashRing
+from syncreg.server import parse_bind
+from syncreg.util import LRUCache, split_list
+
+
+_MISSING = object()
+
+# flags of the stored values
+_STR, _JSON, _UNICODE = range(3)
+
+_MAX_KEY = 250
+_BAD_KEY = re.compile('[\x00-\x20\x7f]')
+
+
+class MemoryCache(object):
+    """Cache in the memory of the process.
+
+    Args:
+        max_keys: maximum number of keys, the least recently used ones
+                  are dropped first
+    """
+    def __init__(self, max_keys=100000, **kw):
+        self._cache = LRUCache(max_keys)
+        self._lock = threading.Lock()
+
+    def _ttl(self, ttl):
+        return ttl or None
+
+    def get(self, key, default=None):
+        return self._cache.get(key, default)
+
+    def get_multi(self, keys):
+        found = {}
+        for key in keys:
+            value = self._cache.get(key, _MISSING)
+            if value is not _MISSING:
+                found[key] = value
+        return found
+
+    def set(self, key, value, ttl=0):
+        self._cache.set(key, value, self._ttl(ttl))
+        return True
+
+    def add(self, key, value, ttl=0):
+        """Sets key only if it is missing. Returns True if it was set."""
+        self._lock.acquire()
+        try:
+            if self._cache.get(key, _MISSING) is not _MISSING:
+                return False
+            self._cache.set(key, value, self._ttl(ttl))
+            return True
+        finally:
+            self._lock.release()
+
+    def incr(self, key, delta=1):
+        """Adds delta to a number. Returns the new value, or None if the key
+        is missing."""
+        return self._cache.incr(key, delta)
+
+    def delete(self, key):
+        return self._cache.delete(key)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self._cache.delete(key)
+
+
+def _encode(value):
+    if isinstance(value, str):
+        return _STR, value
+    if isinstance(value, unicode):
+        return _UNICODE, value.encode('utf8')
+    return _JSON, json.dumps(value)
+
+
+def _decode(flags, data):
+    if flags == _STR:
+        return data
+    if flags == _UNICODE:
+        return data.decode('utf8')
+    return json.loads(data)
+
+
+class _Connection(object):
+
+    def __init__(self, family, address, timeout):
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(address)
+            if family != socket.AF_UNIX:
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                     1)
+        except socket.error:
+            self.sock.close()
+            raise
+        self.file = self.sock.makefile('rb')
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def readline(self):
+        line = self.file.readline()
+        if not line.endswith('\r\n'):
+            raise IOError('Connection closed')
+        return line[:-2]
+
+    def read(self, size):
+        data = self.file.read(size + 2)
+        if len(data) != size + 2:
+            raise IOError('Connection closed')
+        return data[:-2]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class MemcacheClient(object):
+    """Client of memcached servers.
+
+    Args:
+        servers: 'host:port' or 'unix:/path' addresses, comma separated
+        prefix: prepended to all the keys
+        timeout: socket timeout, in seconds
+        retry_delay: seconds during which a failed server is skipped
+        replicas: number of points of each server on the hash ring
+    """
+    def __init__(self, servers='127.0.0.1:11211', prefix='syncreg:',
+                 timeout=1., retry_delay=5., replicas=100, **kw):
+        self.servers = split_list(servers)
+        self.addresses = dict([(server, parse_bind(server))
+                               for server in self.servers])
+        self.prefix = prefix
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.ring = HashRing(self.servers, replicas)
+        self._down = {}
+        self._local = threading.local()
+        # the connections of all the threads, closed by close()
+        self._connections = []
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        key = self.prefix + key
+        if len(key) > _MAX_KEY or _BAD_KEY.search(key):
+            key = '%sh:%s' % (self.prefix, sha1(key).hexdigest())
+        return key
+
+    def _connection(self, server):
+        """Returns the connection of the current thread, or None while the
+        server is skipped."""
+        pid = os.getpid()
+        if (getattr(self._local, 'pid', None) != pid or
+                self._local.generation != self._generation):
+            # the connections of the parent process are not ours, and
+            # close() closed the others
+            self._local.pid = pid
+            self._local.generation = self._generation
+            self._local.connections = {}
+        conn = self._local.connections.get(server)
+        if conn is not None:
+            return conn
+        if self._down.get(server, 0) > time.time():
+            return None
+        family, address = self.addresses[server]
+        try:
+            conn = _Connection(family, address, self.timeout)
+        except socket.error, e:
+            self._failed(server, e)
+            return None
+        self._local.connections[server] = conn
+        self._lock.acquire()
+        try:
+            self._connections.append((pid, conn))
+        finally:
+            self._lock.release()
+        return conn
+
+    def close(self):
+        """Closes the connections of all the threads of the process.
+
+        A thread using the client afterwards connects again.
+        """
+        pid = os.getpid()
+        self._lock.acquire()
+        try:
+            connections, self._connections = self._connections, []
+            self._generation += 1
+        finally:
+            self._lock.release()
+        for owner, conn in connections:
+            if owner == pid:
+                try:
+                    conn.close()
+                except socket.error:
+                    pass
+
+    def _failed(self, server, error):
+        conn = self._local.connections.pop(server, None)
+        if conn is not None:
+            conn.close()
+            self._lock.acquire()
+            try:
+                if (os.getpid(), conn) in self._connections:
+                    self._connections.remove((os.getpid(), conn))
+            finally:
+                self._lock.release()
+        self._down[server] = time.time() + self.retry_delay
+        logger.warning('Cache server %s failed (%s), skipped for %ss' %
+                       (server, error, self.retry_delay))
+
+    def _group(self, keys):
+        """Returns {server: {cache key: key}}."""
+        groups = {}
+        for key in keys:
+            cache_key = self._key(key)
+            server = self.ring.get_node(cache_key)
+            groups.setdefault(server, {})[cache_key] = key
+        return groups
+
+    def _call(self, key, command, read):
+        """Sends a command about key, and returns read(connection), or
+        None when the server can't be used."""
+        server = self.ring.get_node(key)
+        conn = self._connection(server)
+        if conn is None:
+            return None
+        try:
+            conn.send(command)
+            return read(conn)
+        except (socket.error, IOError, ValueError), e:
+            self._failed(server, e)
+            return None
+
+    def get_multi(self, keys):
+        """Returns a mapping of the keys found to their values."""
+        groups = self._group(keys)
+        sent = []
+        for server, cache_keys in groups.items():
+            conn = self._connection(server)
+            if conn is None:
+                continue
+            try:
+                conn.send('get %s\r\n' % ' '.join(cache_keys))
+            except (socket.error, IOError), e:
+                self._failed(server, e)
+                continue
+            sent.append((server, conn, cache_keys))
+
+        found = {}
+        for server, conn, cache_keys in sent:
+            try:
+                while True:
+                    line = conn.readline()
+                    if line == 'END':
+                        break
+                    kind, cache_key, flags, size = line.split(' ')[:4]
+                    if kind != 'VALUE':
+                        raise ValueError(line)
+                    data = conn.read(int(size))
+                    found[cache_keys[cache_key]] = _decode(int(flags), data)
+            except (socket.error, IOError, ValueError), e:
+                self._failed(server, e)
+        return found
+
+    def get(self, key, default=None):
+        return self.get_multi([key]).get(key, default)
+
+    def _store(self, command, key, value, ttl):
+        flags, data = _encode(value)
+        key = self._key(key)
+        request = '%s %s %d %d %d\r\n%s\r\n' % (command, key, flags,
+                                                int(ttl), len(data), data)
+        return self._call(key, request,
+                          lambda conn: conn.readline() == 'STORED') or False
+
+    def set(self, key, value, ttl=0):
+        """Stores a value. Returns True if it was stored."""
+        return self._store('set', key, value, ttl)
+
+    def add(self, key, value, ttl=0):
+        """Stores a value only if the key is missing. Returns True if it
+        was stored."""
+        return self._store('add', key, value, ttl)
+
+    def incr(self, key, delta=1):
+        """Adds delta to a number. Returns the new value, or None if the key
+        is missing."""
+        def _read(conn):
+            line = conn.readline()
+            if line == 'NOT_FOUND':
+                return None
+            return int(line)
+        key = self._key(key)
+        return self._call(key, 'incr %s %d\r\n' % (key, delta), _read)
+
+    def delete(self, key):
+        key = self._key(key)
+        return self._call(key, 'delete %s\r\n' % key,
+                          lambda conn: conn.readline() == 'DELETED') or False
+
+    def delete_multi(self, keys):
+        """Deletes keys, without waiting for the answers."""
+        for server, cache_keys in self._group(keys).items():
+            conn = self._connection(server)
+            if conn is None:
+                continue
+            try:
+                conn.send(''.join(['delete %s noreply\r\n' % cache_key
+                                   for cache_key in cache_keys]))
+            except (socket.error, IOError), e:
+                self._failed(server, e)
+
+
+def get_cache(config):
+    """Returns the backend of the [cache] section, or None."""
+    if config.get('cache.backend') is None:
+        return None
+    return load_and_configure(config, 'cache')
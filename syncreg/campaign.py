@@ -0,0 +1,393 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Password reset campaign, forcing a reset for a list of users.
+
+    $ syncreg campaign sync.conf usernames.txt --host https://example.com
+
+The users are read one per line, by username or e-mail, from the file or
+from stdin with "-". They are processed in batches of --batch-size: the
+e-mail addresses are read from the [auth] backend, new reset codes are
+generated by the [reset_codes] backend, replacing any previous code, and
+the mail template is rendered once for the whole batch.
+
+The mails are sent by --workers threads sharing a limit of --rate mails
+per second. Each thread keeps its SMTP connection open. A mail refused
+with a permanent (5xx) error is a failure right away; after a connection
+or a temporary (4xx) error, it is retried on a new connection.
+
+After each batch, once its mails are sent, the number of lines processed
+is saved in the --checkpoint file: the same command started again resumes
+from there.
+"""
+import sys
+import time
+import Queue
+import smtplib
+import threading
+import traceback
+from email.mime.text import MIMEText
+from email.header import Header
+from itertools import islice
+from optparse import OptionParser
+
+from services.user import User, extract_username
+from services.pluginreg import load_and_configure
+
+from syncreg import logger
+from syncreg.export import read_checkpoint, write_checkpoint
+from syncreg.reload import read_config
+from syncreg.util import render_mako
+
+
+SUBJECT = 'Resetting your Services password'
+
+# replaced by the values of each user in the rendered template
+_USERNAME = '\x00username\x00'
+_CODE = '\x00code\x00'
+
+
+class RateLimiter(object):
+    """Spaces the calls to wait() to stay under a rate.
+
+    Args:
+        rate: maximum number of calls per second, None for no limit
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        self._lock.acquire()
+        try:
+            now = time.time()
+            slot = max(now, self._next)
+            self._next = slot + 1. / self.rate
+        finally:
+            self._lock.release()
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class MailDispatcher(object):
+    """Sends mails from a pool of threads.
+
+    Args:
+        host, port: the SMTP server
+        user, password: the SMTP credentials, if needed
+        workers: number of threads, each with its own connection
+        rate: maximum number of mails per second, for all the threads
+        retries: attempts made on another connection when sending fails
+                 with a connection or a temporary error
+    """
+    def __init__(self, host='localhost', port=25, user=None, password=None,
+                 workers=4, rate=None, retries=2):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.retries = retries
+        self.limiter = RateLimiter(rate)
+        self.sent = 0
+        self.failures = []
+        self._queue = Queue.Queue(workers * 100)
+        self._lock = threading.Lock()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._loop)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port)
+        if self.user is not None:
+            server.login(self.user, self.password)
+        return server
+
+    def _loop(self):
+        server = None
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                username, sender, rcpt, message = item
+                self.limiter.wait()
+                error = None
+                for attempt in range(self.retries + 1):
+                    try:
+                        if server is None:
+                            server = self._connect()
+                        server.sendmail(sender, [rcpt], message)
+                    except (smtplib.SMTPException, IOError), error:
+                        if server is not None and _permanent(error):
+                            # refused for good, the connection is fine
+                            break
+                        # the connection may be the problem
+                        server = _close(server)
+                    else:
+                        error = None
+                        break
+                if error is not None:
+                    logger.error('Could not send the mail of %s: %s' %
+                                 (username, error))
+                    self._count(failure=username)
+                    continue
+                self._count()
+            finally:
+                self._queue.task_done()
+        _close(server)
+
+    def _count(self, failure=None):
+        self._lock.acquire()
+        try:
+            if failure is None:
+                self.sent += 1
+            else:
+                self.failures.append(failure)
+        finally:
+            self._lock.release()
+
+    def send(self, username, sender, rcpt, subject, body):
+        """Queues a mail, blocking while the queue is full."""
+        message = MIMEText(body.encode('utf8'), 'plain', 'utf8')
+        message['From'] = sender
+        message['To'] = rcpt
+        message['Subject'] = Header(subject, 'utf8')
+        self._queue.put((username, sender, rcpt, message.as_string()))
+
+    def join(self):
+        """Waits until all the queued mails are sent, or failed."""
+        self._queue.join()
+
+    def close(self):
+        """Sends the queued mails and stops the threads."""
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def _permanent(error):
+    """Returns True if the server refused a mail with a 5xx error."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, message in error.recipients.values()]
+        return bool(codes) and min(codes) >= 500
+    code = getattr(error, 'smtp_code', None)
+    return code is not None and code >= 500
+
+
+def _close(server):
+    if server is not None:
+        try:
+            server.quit()
+        except Exception:
+            logger.debug(traceback.format_exc())
+    return None
+
+
+class Campaign(object):
+    """Generates reset codes for users and mails them.
+
+    Args:
+        auth: the auth backend
+        reset: the reset code backend
+        dispatcher: a MailDispatcher
+        host: root URL of the reset form, in the mails
+        sender: the From address of the mails
+        batch_size: number of users processed at once
+    """
+    def __init__(self, auth, reset, dispatcher, host, sender,
+                 batch_size=1000, subject=SUBJECT):
+        self.auth = auth
+        self.reset = reset
+        self.dispatcher = dispatcher
+        self.host = host
+        self.sender = sender
+        self.batch_size = batch_size
+        self.subject = subject
+        self.queued = 0
+        self.unknown = []
+        self.no_email = []
+
+    def _users(self, lines):
+        users = []
+        for line in lines:
+            name = line.strip()
+            if not name:
+                continue
+            if '@' in name:
+                name = extract_username(name)
+            user = User(name)
+            if self.auth.get_user_id(user) is None:
+                self.unknown.append(name)
+                continue
+            self.auth.get_user_info(user, ['mail'])
+            if not user.get('mail'):
+                self.no_email.append(name)
+                continue
+            users.append(user)
+        return users
+
+    def _generate(self, users):
+        """Returns the new reset codes of the users."""
+        generate = getattr(self.reset, 'generate_reset_codes', None)
+        if generate is not None:
+            return generate(users)
+        return [self.reset.generate_reset_code(user, True) for user in users]
+
+    def run_batch(self, lines):
+        """Processes a batch of lines, and waits for its mails."""
+        users = self._users(lines)
+        if not users:
+            return
+        codes = self._generate(users)
+        template = render_mako('password_reset_mail.mako', host=self.host,
+                               user_name=_USERNAME, code=_CODE)
+        for user, code in zip(users, codes):
+            body = template.replace(_USERNAME, user['username'])
+            body = body.replace(_CODE, code)
+            self.dispatcher.send(user['username'], self.sender,
+                                 user['mail'], self.subject, body)
+            self.queued += 1
+        self.dispatcher.join()
+
+    def run(self, lines, start=0, checkpoint=None, callback=None):
+        """Processes the users.
+
+        Args:
+            lines: iterable of usernames or e-mails
+            start: number of lines already processed, that are skipped
+            checkpoint: file where the number of processed lines is saved
+                        after each batch
+            callback: called with that number after each batch
+
+        Returns:
+            the number of processed lines
+        """
+        lines = iter(lines)
+        position = start
+        for line in islice(lines, start):
+            pass
+        while True:
+            batch = list(islice(lines, self.batch_size))
+            if not batch:
+                break
+            self.run_batch(batch)
+            position += len(batch)
+            if checkpoint is not None:
+                write_checkpoint(checkpoint, position)
+            if callback is not None:
+                callback(position)
+        return position
+
+
+def campaign_command(args):
+    """Forces a password reset for a list of users."""
+    parser = OptionParser(usage='%prog [options] sync.conf usernames.txt',
+                          prog='syncreg campaign')
+    parser.add_option('--host', dest='host', default=None,
+                      help='root URL of the reset form (required)')
+    parser.add_option('-b', '--batch-size', dest='batch_size', type='int',
+                      default=1000, help='users processed at once')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+                      default=4, help='threads sending the mails')
+    parser.add_option('-r', '--rate', dest='rate', type='float',
+                      default=50., help='maximum mails per second, 0 for '
+                                        'no limit')
+    parser.add_option('-c', '--checkpoint', dest='checkpoint', default=None,
+                      help='file saving the progress, to resume from')
+    parser.add_option('--failed', dest='failed', default=None,
+                      help='file receiving the users that got no mail')
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('You need to provide the configuration file and the '
+                     'list of users')
+    if options.host is None:
+        parser.error('You need to provide --host')
+
+    config = read_config(args[0])
+    auth = load_and_configure(config, 'auth')
+    reset = load_and_configure(config, 'reset_codes')
+    dispatcher = MailDispatcher(config.get('smtp.host', 'localhost'),
+                                int(config.get('smtp.port', 25)),
+                                config.get('smtp.user'),
+                                config.get('smtp.password'),
+                                options.workers, options.rate or None)
+    campaign = Campaign(auth, reset, dispatcher, options.host.rstrip('/'),
+                        config['smtp.sender'], options.batch_size)
+
+    start = 0
+    if options.checkpoint is not None:
+        start = read_checkpoint(options.checkpoint)[0] or 0
+
+    began = time.time()
+
+    def _progress(position):
+        elapsed = time.time() - began
+        print >> sys.stderr, ('%d users, %d mails sent (%.1f/s)' %
+                              (position, dispatcher.sent,
+                               dispatcher.sent / max(elapsed, 0.001)))
+
+    if args[1] == '-':
+        lines = sys.stdin
+    else:
+        lines = open(args[1])
+    try:
+        position = campaign.run(lines, start, options.checkpoint, _progress)
+    finally:
+        dispatcher.close()
+        if lines is not sys.stdin:
+            lines.close()
+
+    failed = dispatcher.failures + campaign.unknown + campaign.no_email
+    if options.failed is not None:
+        f = open(options.failed, 'w')
+        try:
+            for username in failed:
+                f.write('%s\n' % username)
+        finally:
+            f.close()
+    print ('%d users processed, %d mails sent, %d failed, %d unknown, '
+           '%d without e-mail' % (position - start, dispatcher.sent,
+                                  len(dispatcher.failures),
+                                  len(campaign.unknown),
+                                  len(campaign.no_email)))
+    return 0
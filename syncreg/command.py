@@ -0,0 +1,90 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+The syncreg command line.
+
+Usage: syncreg <command> [options]
+
+Each command lives in its own module and receives the remaining arguments.
+"""
+import sys
+
+
+# name -> (module, function, description)
+_COMMANDS = {'serve': ('syncreg.server', 'serve_command',
+                       'Runs the pre-fork server'),
+             'bench': ('syncreg.bench', 'bench_command',
+                       'Runs a benchmark'),
+             'campaign': ('syncreg.campaign', 'campaign_command',
+                          'Forces a password reset for a list of users'),
+             'populate': ('syncreg.populate', 'populate_command',
+                          'Writes synthetic users'),
+             'pwned': ('syncreg.pwned', 'pwned_command',
+                       'Builds the corpus of breached passwords'),
+             'rebalance': ('syncreg.backends.sharded', 'rebalance_command',
+                           'Moves the users to their shard'),
+             'export': ('syncreg.export', 'export_command',
+                        'Exports the users'),
+             'replay': ('syncreg.replay', 'replay_command',
+                        'Replays an access log against a server'),
+             'snapshot': ('syncreg.snapshot', 'snapshot_command',
+                          'Writes the snapshot of the node assignments'),
+             'stubs': ('syncreg.stubs', 'stubs_command',
+                       'Runs local SMTP and captcha servers')}
+
+
+def _usage():
+    lines = ['Usage: syncreg <command> [options]', '', 'Commands:']
+    for name in sorted(_COMMANDS):
+        lines.append('  %-16s %s' % (name, _COMMANDS[name][2]))
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    if not args or args[0] not in _COMMANDS:
+        print >> sys.stderr, _usage()
+        return 1
+
+    module, function, __ = _COMMANDS[args[0]]
+    module = __import__(module, globals(), locals(), [function])
+    return getattr(module, function)(args[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Status controller: pages used by the load balancers and the operators.
+"""
+import traceback
+
+from webob.exc import (HTTPServiceUnavailable, HTTPForbidden,
+                       HTTPInternalServerError, HTTPNotFound)
+
+from services import logger
+from services.formatters import json_response
+from syncreg.health import OK
+from syncreg.reload import RESTART_SECTIONS
+
+
+class StatusController(object):
+
+    def __init__(self, app):
+        self.app = app
+
+    def ready(self, request):
+        """Returns 200 once the application is warmed up, 503 before."""
+        warmup = self.app.warmup
+        if not warmup.ready:
+            raise HTTPServiceUnavailable('Warming up')
+        return json_response({'ready': True, 'duration': warmup.duration})
+
+    def health(self, request):
+        """Returns the cached health of the backends.
+
+        The answer is a 503 when a critical backend failed or was not
+        checked recently enough.
+        """
+        healthy, details = self.app.health.status()
+        response = json_response({'status': healthy and OK or 'failed',
+                                  'checks': details})
+        if not healthy:
+            response.status = 503
+        return response
+
+    def stats(self, request):
+        """Returns the counters of the process."""
+        return json_response({'counters': self.app.counters.snapshot(),
+                              'admission': self.app.admission.stats(),
+                              'pools': self.app.pools.stats()})
+
+    def _check_secret(self, request):
+        secret = self.app.config.get('global.shared_secret')
+        if secret is None or request.headers.get('X-Weave-Secret') != secret:
+            raise HTTPForbidden()
+
+    def reload(self, request):
+        """Reloads the configuration file, see syncreg.reload.
+
+        Needs the shared secret. Only the process serving the request is
+        reloaded: the pre-fork server reloads all its workers on HUP.
+        """
+        self._check_secret(request)
+        try:
+            changed = self.app.reloader.reload()
+        except Exception:
+            logger.error(traceback.format_exc())
+            raise HTTPInternalServerError('Reload failed, the current '
+                                          'configuration is kept')
+        restart = [section for section in changed
+                   if section in RESTART_SECTIONS]
+        return json_response({'changed': changed, 'restart': restart})
+
+    def memory(self, request):
+        """Returns the memory allocated by the process, see syncreg.memory.
+
+        Needs the shared secret, and "memory.enabled".
+        """
+        if self.app.memory is None:
+            raise HTTPNotFound()
+        self._check_secret(request)
+        report = self.app.memory.report()
+        if request.GET.get('reset'):
+            self.app.memory.reset()
+        return json_response(report)
@@ -40,19 +40,25 @@ https://wiki.mozilla.org/Labs/Weave/User/1.0/API
 
 """
 import os
+import fcntl
+import tempfile
+import threading
 import traceback
+from hashlib import sha1
 import simplejson as json
 
 from webob.exc import (HTTPServiceUnavailable, HTTPBadRequest,
                        HTTPInternalServerError, HTTPNotFound,
-                       HTTPUnauthorized)
+                       HTTPUnauthorized, HTTPConflict,
+                       HTTPUnprocessableEntity)
+from webob import Response
 
 from recaptcha.client import captcha
 from cef import log_cef, AUTH_FAILURE, PASSWD_RESET_CLR
 
 from services import logger
 from services.util import HTTPJsonBadRequest, valid_password
-from services.emailer import send_email, valid_email
+from services.emailer import valid_email
 from services.exceptions import BackendError
 from services.formatters import text_response, json_response
 from services.user import extract_username
@@ -67,34 +73,225 @@ from services.respcodes import (ERROR_MISSING_PASSWORD,
                                 ERROR_INVALID_CAPTCHA,
                                 ERROR_USERNAME_EMAIL_MISMATCH)
 from services.pluginreg import load_and_configure
-from syncreg.util import render_mako
+from syncreg import deadline, eventlog, remote
+from syncreg.breaker import CircuitBreaker
+from syncreg.cache import get_cache
+from syncreg.deadline import DeadlineBackend
+from syncreg.idempotency import get_store
+from syncreg.snapshot import NodeSnapshot
+from syncreg.pwned import PasswordCorpus
+from syncreg.util import render_mako, LRUCache, changed_sections
 from services.user import User
 
 _TPL_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+_MISSING = object()
+
+# keys of the shared cache, replaced by _WRITTEN when the user is written
+_UID = 'uid:'
+_USER_KEYS = (_UID,)
+_WRITTEN = 'written'
 
 
 class UserController(object):
 
-    def __init__(self, app):
+    def __init__(self, app, config=None, previous=None):
+        """
+        Args:
+            app: the application
+            config: the configuration, defaults to the application's one
+            previous: the controller being replaced by a configuration
+                      reload, see syncreg.reload. Its resources are reused
+                      when their section did not change.
+        """
+        if config is None:
+            config = app.config
         self.app = app
-        self.strict_usernames = app.config.get('auth.strict_usernames', True)
-        self.shared_secret = app.config.get('global.shared_secret')
-        self.auth = self.app.auth.backend
+        self.config = config
+        self.strict_usernames = config.get('auth.strict_usernames', True)
+        self.shared_secret = config.get('global.shared_secret')
+        # every call to the backends respects the request's deadline
+        self.auth = DeadlineBackend(self.app.auth.backend)
         self.fallback_node = \
-                    self.clean_location(app.config.get('nodes.fallback_node'))
+                    self.clean_location(config.get('nodes.fallback_node'))
+
+        if previous is None:
+            changed = None
+        else:
+            changed = changed_sections(previous.config, config)
+
+        def _reuse(section):
+            return changed is not None and section not in changed
+
+        if _reuse('reset_codes'):
+            self.reset = previous.reset
+        else:
+            try:
+                self.reset = load_and_configure(config, 'reset_codes')
+            except Exception:
+                logger.debug(traceback.format_exc())
+                logger.debug("No reset code library in place")
+                self.reset = None
+            else:
+                self.reset = DeadlineBackend(self.reset)
 
+        # the lookups are answered from the last known values while the
+        # auth backend is failing
+        if _reuse('breaker'):
+            self.breaker = previous.breaker
+            self.known_users = previous.known_users
+        else:
+            self.breaker = CircuitBreaker(
+                    config.get('breaker.failure_threshold', 5),
+                    config.get('breaker.reset_timeout', 10))
+            self.known_users = LRUCache(config.get('breaker.cache_size',
+                                                   100000))
+
+        # node assignments answered without querying the backend
+        path = config.get('snapshot.path')
+        if _reuse('snapshot'):
+            self.snapshot = previous.snapshot
+        elif path is None:
+            self.snapshot = None
+        else:
+            interval = config.get('snapshot.check_interval', 5)
+            self.snapshot = NodeSnapshot(path, interval)
+
+        # registration events, for the other services
+        directory = config.get('eventlog.directory')
+        if _reuse('eventlog'):
+            self.events = previous.events
+        elif directory is None:
+            self.events = None
+        else:
+            self.events = eventlog.EventLog(
+                directory,
+                segment_size=config.get('eventlog.segment_size',
+                                        64 * 1024 * 1024),
+                commit_interval=config.get('eventlog.commit_interval', 0.01),
+                wait=config.get('eventlog.wait', True))
+
+        # lets the captcha be checked by a stub, see syncreg.stubs
+        self.captcha_verify_server = config.get('captcha.verify_server')
+
+        # known breached passwords
+        path = config.get('pwned.path')
+        if _reuse('pwned'):
+            self.pwned = previous.pwned
+        elif path is None:
+            self.pwned = None
+        else:
+            self.pwned = PasswordCorpus(path, config.get('pwned.bloom'))
+
+        # shared by the workers and the nodes
+        if _reuse('cache'):
+            self.cache = previous.cache
+        else:
+            self.cache = get_cache(config)
+        self.cache_ttl = config.get('cache.ttl', 300)
+        self.cache_negative_ttl = config.get('cache.negative_ttl', 30)
+        # longer than a lookup can take
+        self.cache_written_ttl = config.get('cache.written_ttl', 60)
+
+        # responses replayed to the retries of create_user
+        if _reuse('idempotency') and _reuse('cache'):
+            self.idempotency = previous.idempotency
+        else:
+            self.idempotency = get_store(config, self.cache)
+
+        # used when the reset code backend can't use a code atomically:
+        # the threads of a process, then the processes of a server, lock
+        # a slot per user
+        if previous is not None:
+            self._reset_locks = previous._reset_locks
+        else:
+            self._reset_locks = [threading.Lock() for i in range(64)]
+        self._reset_lock_file = config.get(
+                'global.reset_lock_file',
+                os.path.join(tempfile.gettempdir(), 'syncreg-reset.lock'))
+
+    def _compromised(self, password):
+        """Returns True if the password appeared in a data breach."""
+        return self.pwned is not None and self.pwned.is_compromised(password)
+
+    def _user_written(self, type_, username, data=''):
+        """Called after each write of a user: drops what the caches know
+        about the user, and logs the event."""
+        self.known_users.delete(username)
+        if self.cache is not None:
+            # marked rather than deleted: a lookup that read the backend
+            # before the write can't add its stale answer over the mark
+            for prefix in _USER_KEYS:
+                self.cache.set(prefix + username, _WRITTEN,
+                               self.cache_written_ttl)
+        if self.events is None:
+            return
+        # the write is done, the request succeeds whatever happens here
         try:
-            self.reset = load_and_configure(app.config, 'reset_codes')
+            written = self.events.append(type_, username, data)
         except Exception:
-            logger.debug(traceback.format_exc())
-            logger.debug("No reset code library in place")
-            self.reset = None
+            logger.error(traceback.format_exc())
+            written = False
+        if not written:
+            logger.error('Event %s of %s not written' %
+                         (eventlog.EVENT_NAMES[type_], username))
+
+    def _lookup_user_id(self, request):
+        """Returns the user id, for the read-only routes.
+
+        When the auth backend fails, or while the circuit breaker is open,
+        the last known value is used and request.stale is set.
+        """
+        username = request.user['username']
+        if self.cache is not None:
+            uid = self.cache.get(_UID + username, _MISSING)
+            if uid is not _MISSING and uid != _WRITTEN:
+                return uid
+
+        if self.breaker.allow():
+            try:
+                uid = self.auth.get_user_id(request.user)
+            except BackendError:
+                self.breaker.failure()
+                uid = self.known_users.get(username, _MISSING)
+                if uid is _MISSING:
+                    raise
+            except Exception:
+                self.breaker.cancel()
+                raise
+            else:
+                self.breaker.success()
+                self.known_users.set(username, uid)
+                if self.cache is not None:
+                    # fails if the user was written since
+                    if uid is None:
+                        ttl = self.cache_negative_ttl
+                    else:
+                        ttl = self.cache_ttl
+                    self.cache.add(_UID + username, uid, ttl)
+                return uid
+        else:
+            uid = self.known_users.get(username, _MISSING)
+            if uid is _MISSING:
+                raise HTTPServiceUnavailable(
+                        retry_after=self.breaker.reset_timeout)
+
+        request.stale = True
+        return uid
+
+    def _flag_stale(self, request, response):
+        if not getattr(request, 'stale', False):
+            return response
+        if isinstance(response, basestring):
+            response = Response(response)
+        response.headers['X-Weave-Stale'] = '1'
+        return response
 
     def user_exists(self, request):
         if request.user.get('username') is None:
             raise HTTPNotFound()
-        uid = self.auth.get_user_id(request.user)
-        return text_response(int(uid is not None))
+        uid = self._lookup_user_id(request)
+        return self._flag_stale(request,
+                                text_response(int(uid is not None)))
 
     def return_fallback(self):
         if self.fallback_node is None:
@@ -122,13 +319,19 @@ class UserController(object):
         # Install that and point your server at it for
         # the node assignment call
 
-        if request.user.get('username') is None:
+        username = request.user.get('username')
+        if username is None:
             raise HTTPNotFound()
 
-        if not self.auth.get_user_id(request.user):
+        if self.snapshot is not None:
+            node = self.snapshot.get(username)
+            if node is not None:
+                return self.clean_location(node)
+
+        if not self._lookup_user_id(request):
             raise HTTPNotFound()
 
-        return self.return_fallback()
+        return self._flag_stale(request, self.return_fallback())
 
     def password_reset(self, request, **data):
         """Sends an e-mail for a password reset request."""
@@ -162,10 +365,15 @@ class UserController(object):
             password = request.config.get('smtp.password')
 
             subject = 'Resetting your Services password'
-            res, msg = send_email(sender, request.user['mail'], subject, body,
-                                  host, port, user, password)
+            timeout = float(request.config.get('smtp.timeout', 5))
+            res, msg = remote.send_email(sender, request.user['mail'],
+                                         subject, body, host, port, user,
+                                         password,
+                                         timeout=deadline.timeout(timeout))
 
             if not res:
+                # a timeout due to the deadline is reported as such
+                deadline.check()
                 raise HTTPServiceUnavailable(msg)
         except AlreadySentError:
             #backend handled the reset code email. Keep going
@@ -173,6 +381,41 @@ class UserController(object):
 
         return text_response('success')
 
+    def _use_reset_code(self, user, code, update):
+        """Checks a reset code, calls update, then clears the code.
+
+        Of concurrent submissions of the same code, only one calls update,
+        and the code is kept when update raises. Backends providing
+        use_reset_code claim the code atomically. For the others, the
+        calls are serialized per user across the processes of the server,
+        through a lock file: this does not cover several hosts sharing the
+        reset code backend, which need a backend with use_reset_code.
+
+        Returns:
+            False if the code is not the live code of the user
+        """
+        use = getattr(self.reset, 'use_reset_code', None)
+        if use is not None:
+            return use(user, code, update)
+
+        slot = hash(user['username']) % len(self._reset_locks)
+        lock = self._reset_locks[slot]
+        lock.acquire()
+        try:
+            fd = os.open(self._reset_lock_file, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX, 1, slot)
+                if not self.reset.verify_reset_code(user, code):
+                    return False
+                update()
+                self.reset.clear_reset_code(user)
+                return True
+            finally:
+                # closing the file releases the lock
+                os.close(fd)
+        finally:
+            lock.release()
+
     def delete_password_reset(self, request, **data):
         """Forces a password reset clear"""
         if self.reset is None:
@@ -183,30 +426,87 @@ class UserController(object):
         self.auth.get_user_id(request.user)
         self.reset.clear_reset_code(request.user)
         log_cef("User requested password reset clear", 9, request.environ,
-                self.app.config, request.user.get('username'),
+                self.config, request.user.get('username'),
                 PASSWD_RESET_CLR)
         return text_response('success')
 
     def _check_captcha(self, request, data):
         # check if captcha info are provided
-        if not self.app.config['captcha.use']:
+        if not self.config['captcha.use']:
             return
 
         challenge = data.get('captcha-challenge')
         response = data.get('captcha-response')
 
         if challenge is not None and response is not None:
-            resp = captcha.submit(challenge, response,
-                                  self.app.config['captcha.private_key'],
-                                  remoteip=request.remote_addr)
+            timeout = float(self.config.get('captcha.timeout', 5))
+            try:
+                resp = remote.submit_captcha(
+                        challenge, response,
+                        self.config['captcha.private_key'],
+                        request.remote_addr,
+                        timeout=deadline.timeout(timeout),
+                        verify_server=self.captcha_verify_server)
+            except IOError, e:
+                deadline.check()
+                logger.error('Could not check the captcha: %s' % str(e))
+                raise HTTPServiceUnavailable()
             if not resp.is_valid:
                 raise HTTPJsonBadRequest(ERROR_INVALID_CAPTCHA)
         else:
             raise HTTPJsonBadRequest(ERROR_INVALID_CAPTCHA)
 
     def create_user(self, request):
-        """Creates a user."""
-        if self.auth.get_user_id(request.user):
+        """Creates a user.
+
+        A retry sent with the same Idempotency-Key header gets the response
+        of the first request, which is not run again.
+        """
+        key = request.headers.get('Idempotency-Key')
+        if key is None or self.idempotency is None:
+            return self._create_user(request)
+        if not key or len(key) > 255:
+            raise HTTPBadRequest('Invalid Idempotency-Key')
+
+        key = '%s:%s' % (request.user['username'], key)
+        fingerprint = sha1(request.body).hexdigest()
+        record = self.idempotency.claim(key, fingerprint)
+        if record is not None:
+            return self._replay(record, fingerprint)
+
+        try:
+            result = self._create_user(request)
+        except HTTPJsonBadRequest, e:
+            self.idempotency.complete(key, fingerprint, e.code,
+                                      'application/json',
+                                      json.dumps(e.detail))
+            raise
+        except Exception:
+            # the other errors are worth retrying
+            self.idempotency.release(key)
+            raise
+        self.idempotency.complete(key, fingerprint, 200, None,
+                                  json.dumps(result))
+        return result
+
+    def _replay(self, record, fingerprint):
+        """Returns the response stored for an idempotency key."""
+        first, status, content_type, body = record
+        if first != fingerprint:
+            raise HTTPUnprocessableEntity('The Idempotency-Key was used for '
+                                          'another request')
+        if status is None:
+            raise HTTPConflict('The first request with this Idempotency-Key '
+                               'is still running')
+        if status == 200:
+            return json.loads(body)
+        return Response(body=body, status=status, content_type=content_type)
+
+    def _create_user(self, request):
+        # not from a replica, which may lag behind
+        get_user_id = getattr(self.auth, 'get_user_id_for_write',
+                              self.auth.get_user_id)
+        if get_user_id(request.user):
             raise HTTPJsonBadRequest(ERROR_INVALID_WRITE)
         username = request.user['username']
 
@@ -228,7 +528,8 @@ class UserController(object):
         if not password:
             raise HTTPJsonBadRequest(ERROR_MISSING_PASSWORD)
 
-        if not valid_password(username, password):
+        if (not valid_password(username, password) or
+            self._compromised(password)):
             raise HTTPJsonBadRequest(ERROR_WEAK_PASSWORD)
 
         # check if captcha info are provided or if we bypass it
@@ -241,6 +542,7 @@ class UserController(object):
                                      email):
             raise HTTPInternalServerError('User creation failed.')
 
+        self._user_written(eventlog.USER_CREATED, username)
         return request.user['username']
 
     def change_email(self, request):
@@ -259,6 +561,8 @@ class UserController(object):
                                       'mail', email):
             raise HTTPInternalServerError('User update failed.')
 
+        self._user_written(eventlog.EMAIL_CHANGED, request.user['username'],
+                           email)
         return text_response(email)
 
     def change_password(self, request):
@@ -266,6 +570,11 @@ class UserController(object):
 
         Takes a classical authentication or a reset code
         """
+        key = request.headers.get('X-Weave-Password-Reset')
+        if key is None:
+            # before anything is computed from the passwords
+            self.app.auth.check_throttle(request, request.user['username'])
+
         # the body is in plain text utf8 string
         new_password = request.body.decode('utf8')
 
@@ -274,7 +583,9 @@ class UserController(object):
                                  'characters and not the same as your '
                                  'username')
 
-        key = request.headers.get('X-Weave-Password-Reset')
+        if self._compromised(new_password):
+            raise HTTPBadRequest('This password appeared in a data breach. '
+                                 'Please choose another one')
 
         if key is not None:
             user_id = self.auth.get_user_id(request.user)
@@ -282,25 +593,26 @@ class UserController(object):
             if user_id is None:
                 raise HTTPNotFound()
 
-            if not self.reset.verify_reset_code(request.user, key):
+            def _update():
+                if not self.auth.admin_update_password(request.user,
+                                                       new_password, key):
+                    raise HTTPInternalServerError('Password change failed '
+                                                  'unexpectedly.')
+
+            if not self._use_reset_code(request.user, key, _update):
                 log_cef('Invalid Reset Code submitted', 5, request.environ,
-                        self.app.config, request.user['username'],
+                        self.config, request.user['username'],
                         'InvalidResetCode', submitedtoken=key)
 
                 raise HTTPJsonBadRequest(ERROR_INVALID_RESET_CODE)
-
-            if not self.auth.admin_update_password(request.user,
-                                                   new_password, key):
-                raise HTTPInternalServerError('Password change failed '
-                                              'unexpectedly.')
         else:
             # classical auth
-            self.app.auth.authenticate_user(request, self.app.config,
+            self.app.auth.authenticate_user(request, self.config,
                                             request.user['username'])
 
             if request.user['userid'] is None:
                 log_cef('User Authentication Failed', 5, request.environ,
-                        self.app.config, request.user['username'],
+                        self.config, request.user['username'],
                         AUTH_FAILURE)
                 raise HTTPUnauthorized()
 
@@ -310,6 +622,7 @@ class UserController(object):
                 raise HTTPInternalServerError('Password change failed '
                                               'unexpectedly.')
 
+        self._user_written(eventlog.PASSWORD_CHANGED, request.user['username'])
         return text_response('success')
 
     def password_reset_form(self, request, **kw):
@@ -382,16 +695,23 @@ class UserController(object):
                                 'characters and not the same as your '
                                 'username')
 
-        if not self.reset.verify_reset_code(user, key):
-            return self._repost(request, 'Key does not match with username. '
-                                'Please request a new key.')
+        if self._compromised(password):
+            return self._repost(request, 'This password appeared in a data '
+                                'breach. Please choose another one')
+
+        def _update():
+            if not self.auth.admin_update_password(user, password, key):
+                raise HTTPInternalServerError()
 
-        # everything looks fine
-        if not self.auth.admin_update_password(user, 'password', password):
+        try:
+            if not self._use_reset_code(user, key, _update):
+                return self._repost(request, 'Key does not match with '
+                                    'username. Please request a new key.')
+        except HTTPInternalServerError:
             return self._repost(request, 'Password change failed '
                                          'unexpectedly.')
 
-        self.reset.clear_reset_code(user)
+        self._user_written(eventlog.PASSWORD_RESET, user_name)
         return render_mako('password_changed.mako')
 
     def delete_user(self, request):
@@ -401,16 +721,18 @@ class UserController(object):
             raise HTTPBadRequest()
 
         res = self.auth.delete_user(request.user, request.user_password)
+        if res:
+            self._user_written(eventlog.USER_DELETED, request.user['username'])
         return text_response(int(res))
 
     def _captcha(self):
         """Return HTML string for inserting recaptcha into a form."""
-        return captcha.displayhtml(self.app.config['captcha.public_key'],
-                                   use_ssl=self.app.config['captcha.use_ssl'])
+        return captcha.displayhtml(self.config['captcha.public_key'],
+                                   use_ssl=self.config['captcha.use_ssl'])
 
     def captcha_form(self, request):
         """Renders the captcha form"""
-        if not self.app.config['captcha.use']:
+        if not self.config['captcha.use']:
             raise HTTPNotFound('No captcha configured')
 
         return render_mako('captcha.mako', captcha=self._captcha())
@@ -0,0 +1,173 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Request deadlines.
+
+nginx gives up on a request after its proxy timeout. Past that point,
+whatever the worker does for that request is wasted, so each request gets
+a deadline, and the calls to the backends, the captcha and the SMTP
+server are skipped once it has passed. The request then fails fast with a
+503.
+
+The timeout comes from the [deadline] section:
+
+- timeout: default timeout of a request, in seconds. When not set,
+  requests only get a deadline if they provide the header.
+- header: header carrying the timeout, in seconds (default:
+  X-Weave-Timeout). The smallest of both values is used.
+- retry_after: Retry-After of the 503 (default: 5)
+
+The number of requests that ran out of time is counted per route.
+"""
+import time
+import threading
+
+from webob.exc import HTTPServiceUnavailable
+
+from syncreg import logger
+from syncreg.util import BackendProxy
+
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request has no time left."""
+
+
+class Deadline(object):
+
+    def __init__(self, timeout):
+        self.expires = time.time() + timeout
+
+    def remaining(self):
+        return max(self.expires - time.time(), 0.)
+
+    def expired(self):
+        return time.time() >= self.expires
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded()
+
+
+def current():
+    """Returns the deadline of the current request, or None."""
+    return getattr(_local, 'deadline', None)
+
+
+def check():
+    """Raises DeadlineExceeded if the current request has no time left."""
+    deadline = current()
+    if deadline is not None:
+        deadline.check()
+
+
+def remaining(default=None):
+    """Returns the time left to the current request, or default."""
+    deadline = current()
+    if deadline is None:
+        return default
+    return deadline.remaining()
+
+
+def timeout(default):
+    """Returns the timeout of a remote call made for the current request.
+
+    Raises DeadlineExceeded if the request has no time left.
+
+    Returns:
+        the time left to the request, at most default
+    """
+    deadline = current()
+    if deadline is None:
+        return default
+    deadline.check()
+    return min(deadline.remaining(), default)
+
+
+class DeadlineBackend(BackendProxy):
+    """Checks the deadline of the current request before each call."""
+
+    def _wrap_method(self, name, method):
+        def _call(*args, **kw):
+            check()
+            return method(*args, **kw)
+        return _call
+
+
+class DeadlinePolicy(object):
+    """Gives their deadline to the requests."""
+
+    def __init__(self, config, counters):
+        self.timeout = config.get('deadline.timeout')
+        self.header = config.get('deadline.header', 'X-Weave-Timeout')
+        self.retry_after = config.get('deadline.retry_after', 5)
+        self.counters = counters
+
+    def get_timeout(self, request):
+        """Returns the timeout of a request, or None."""
+        timeout = self.timeout
+        value = request.headers.get(self.header)
+        if value is not None:
+            try:
+                value = float(value)
+            except ValueError:
+                logger.debug('Invalid %s header: %r' % (self.header, value))
+            else:
+                if timeout is None or value < timeout:
+                    timeout = value
+        return timeout
+
+    def wrap(self, action, function):
+        """Returns function, running under the deadline of the request."""
+        def _deadline(request, *args, **kw):
+            timeout = self.get_timeout(request)
+            if timeout is None:
+                return function(request, *args, **kw)
+
+            _local.deadline = Deadline(timeout)
+            try:
+                try:
+                    return function(request, *args, **kw)
+                except DeadlineExceeded:
+                    self.counters.incr('deadline_exceeded.%s' % action)
+                    logger.info('Deadline exceeded on %s' % action)
+                    raise HTTPServiceUnavailable(
+                                retry_after=self.retry_after)
+            finally:
+                _local.deadline = None
+        return _deadline
@@ -0,0 +1,533 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Log of the registration events.
+
+The user controller appends a record to the log when an account is created,
+deleted, or has its e-mail or password changed. Other services tail the
+log instead of polling the auth database.
+
+    [eventlog]
+    directory = /var/lib/syncreg/events
+    segment_size = 67108864
+    commit_interval = 0.01
+    wait = true
+
+The log is a directory of segments, numbered from 1, written by all the
+workers of a server. A segment is closed when it reaches segment_size
+bytes.
+
+Records are written by a background thread in each process. It waits
+commit_interval seconds to gather the records of concurrent requests, then
+writes them with a single write and a single fsync, under a file lock
+shared with the other processes. With wait, a request returns once its
+record is on disk, and append returns False when the write failed. A
+failed write is truncated away, and so is the torn tail a crashed writer
+may have left in the last segment, when a process first opens it. Once
+the log is closed, the records appended by the requests still running are
+written by their own thread.
+
+A record is a header followed by the username and the event data:
+
+    size      uint32   size of the record after the crc
+    crc       uint32   crc32 of the record after the crc
+    type      uint8    one of the event types below
+    timestamp uint64   milliseconds since the epoch
+    length    uint16   size of the username
+    username  bytes
+    data      bytes    the rest of the record
+
+All integers are big-endian. EventReader reads the segments through mmap,
+and gives the offset to resume from. A corrupted record is skipped, up to
+the next valid one.
+"""
+import os
+import time
+import mmap
+import fcntl
+import struct
+import threading
+import traceback
+from zlib import crc32
+
+from syncreg import logger
+
+
+USER_CREATED = 1
+USER_DELETED = 2
+EMAIL_CHANGED = 3
+PASSWORD_CHANGED = 4
+PASSWORD_RESET = 5
+
+EVENT_NAMES = {USER_CREATED: 'user_created',
+               USER_DELETED: 'user_deleted',
+               EMAIL_CHANGED: 'email_changed',
+               PASSWORD_CHANGED: 'password_changed',
+               PASSWORD_RESET: 'password_reset'}
+
+_PREFIX = struct.Struct('>II')
+_HEADER = struct.Struct('>BQH')
+
+
+def segment_path(directory, number):
+    return os.path.join(directory, '%010d.log' % number)
+
+
+def _segments(directory):
+    """Returns the sorted numbers of the segments in directory."""
+    numbers = []
+    for name in os.listdir(directory):
+        if name.endswith('.log') and name[:-4].isdigit():
+            numbers.append(int(name[:-4]))
+    return sorted(numbers)
+
+
+def encode_event(type_, username, data='', timestamp=None):
+    """Returns the binary record of an event."""
+    if timestamp is None:
+        timestamp = time.time()
+    if isinstance(username, unicode):
+        username = username.encode('utf8')
+    if isinstance(data, unicode):
+        data = data.encode('utf8')
+    body = _HEADER.pack(type_, int(timestamp * 1000), len(username))
+    body += username + data
+    return _PREFIX.pack(len(body), crc32(body) & 0xffffffff) + body
+
+
+def _valid_size(path):
+    """Returns the size of the complete records at the start of a
+    segment."""
+    f = open(path, 'rb')
+    try:
+        size = 0
+        while True:
+            prefix = f.read(_PREFIX.size)
+            if len(prefix) < _PREFIX.size:
+                return size
+            length, crc = _PREFIX.unpack(prefix)
+            body = f.read(length)
+            if len(body) < length or crc32(body) & 0xffffffff != crc:
+                return size
+            size += _PREFIX.size + length
+    finally:
+        f.close()
+
+
+class _Batch(object):
+    """Records written together, and the outcome of the write."""
+    __slots__ = ('records', 'done', 'written')
+
+    def __init__(self):
+        self.records = []
+        self.done = False
+        self.written = False
+
+
+class Event(object):
+    """An event read from the log.
+
+    offset is where the next event starts, as (segment, position).
+    """
+    __slots__ = ('type', 'timestamp', 'username', 'data', 'offset')
+
+    def __init__(self, type_, timestamp, username, data, offset):
+        self.type = type_
+        self.timestamp = timestamp
+        self.username = username
+        self.data = data
+        self.offset = offset
+
+    @property
+    def name(self):
+        return EVENT_NAMES.get(self.type, str(self.type))
+
+    def __repr__(self):
+        return '<Event %s %s>' % (self.name, self.username)
+
+
+class EventLog(object):
+    """Appends events to the log, with group commits.
+
+    Args:
+        directory: location of the segments
+        segment_size: size after which a new segment is started
+        commit_interval: seconds during which records are gathered
+        wait: if True, append returns once the record is on disk
+        timeout: maximum seconds append waits
+    """
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 commit_interval=0.01, wait=True, timeout=5.):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.wait = wait
+        self.timeout = timeout
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock_path = os.path.join(directory, 'lock')
+        self._cond = threading.Condition()
+        self._batch = _Batch()
+        self._pid = None
+        self._fd = None
+        self._segment = None
+        self._thread = None
+        self._closed = False
+        self._repaired = False
+        self._write_lock = threading.Lock()
+        self.errors = 0
+
+    def start(self):
+        """Starts the writer thread, once per process."""
+        if self._pid == os.getpid():
+            return
+        self._cond.acquire()
+        try:
+            if self._pid == os.getpid():
+                return
+            # the records and the files of the parent are not ours
+            self._pid = os.getpid()
+            self._batch = _Batch()
+            self._fd = self._segment = None
+            self._repaired = False
+            if self._closed:
+                return
+            self._thread = threading.Thread(target=self._loop,
+                                            args=(self._pid,))
+            self._thread.setDaemon(True)
+            self._thread.start()
+        finally:
+            self._cond.release()
+
+    def close(self, timeout=None):
+        """Writes the pending records, stops the writer thread and closes
+        the segment.
+
+        Args:
+            timeout: maximum seconds to wait for the writer thread
+        """
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._cond.notifyAll()
+            thread = self._thread
+        finally:
+            self._cond.release()
+        if thread is not None and self._pid == os.getpid():
+            thread.join(timeout)
+        self._write_lock.acquire()
+        try:
+            self._close_segment()
+        finally:
+            self._write_lock.release()
+
+    def append(self, type_, username, data=''):
+        """Adds an event to the log.
+
+        Returns:
+            False if the record could not be written, or not in time
+        """
+        record = encode_event(type_, username, data)
+        self.start()
+        if self._closed:
+            batch = _Batch()
+            batch.records.append(record)
+            self._write_lock.acquire()
+            try:
+                self._commit(batch)
+                self._close_segment()
+            finally:
+                self._write_lock.release()
+            return batch.written
+
+        self._cond.acquire()
+        try:
+            batch = self._batch
+            batch.records.append(record)
+            self._cond.notifyAll()
+            if not self.wait:
+                return True
+            end = time.time() + self.timeout
+            while not batch.done:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return batch.written
+        finally:
+            self._cond.release()
+
+    def _loop(self, pid):
+        while self._pid == pid:
+            self._cond.acquire()
+            try:
+                while not self._batch.records and not self._closed:
+                    self._cond.wait()
+                if not self._batch.records:
+                    # closed, and nothing left to write
+                    return
+            finally:
+                self._cond.release()
+
+            # lets the concurrent requests join the commit
+            if self.commit_interval and not self._closed:
+                time.sleep(self.commit_interval)
+
+            self._cond.acquire()
+            try:
+                batch, self._batch = self._batch, _Batch()
+            finally:
+                self._cond.release()
+
+            self._write_lock.acquire()
+            try:
+                self._commit(batch)
+            finally:
+                self._write_lock.release()
+
+    def _commit(self, batch):
+        """Writes a batch, and wakes up the requests waiting for it."""
+        try:
+            self._write(''.join(batch.records))
+        except Exception:
+            self.errors += 1
+            logger.error('Could not write %d events' % len(batch.records))
+            logger.error(traceback.format_exc())
+        else:
+            batch.written = True
+
+        self._cond.acquire()
+        try:
+            batch.done = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _open(self, segment):
+        self._close_segment()
+        self._fd = os.open(segment_path(self.directory, segment),
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self._segment = segment
+
+    def _close_segment(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._segment = None
+
+    def _repair(self):
+        """Truncates the torn record a crashed writer may have left at the
+        end of the current segment. Called under the file lock."""
+        size = os.fstat(self._fd).st_size
+        valid = _valid_size(segment_path(self.directory, self._segment))
+        if valid < size:
+            logger.error('Truncating %d bytes of torn record at %d in '
+                         'segment %d' % (size - valid, valid, self._segment))
+            os.ftruncate(self._fd, valid)
+
+    def _write(self, data):
+        lock = os.open(self._lock_path, os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self._segment is None:
+                segments = _segments(self.directory)
+                self._open(segments and segments[-1] or 1)
+                if not self._repaired:
+                    self._repair()
+                    self._repaired = True
+            # another process may have started a new segment
+            segment = self._segment
+            while os.path.exists(segment_path(self.directory, segment + 1)):
+                segment += 1
+            if os.fstat(self._fd).st_size >= self.segment_size:
+                segment += 1
+            if segment != self._segment:
+                self._open(segment)
+
+            size = os.fstat(self._fd).st_size
+            try:
+                while data:
+                    data = data[os.write(self._fd, data):]
+                os.fsync(self._fd)
+            except Exception:
+                # the readers stop at a partial record
+                os.ftruncate(self._fd, size)
+                raise
+        finally:
+            # closing the file releases the lock
+            os.close(lock)
+
+
+class EventReader(object):
+    """Reads the events of a log.
+
+    Args:
+        directory: location of the segments
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._maps = {}
+
+    def _slice(self, segment, start, end):
+        """Returns the bytes of a segment between start and end, or None
+        if the segment is shorter."""
+        mapping = self._maps.get(segment)
+        if mapping is None or len(mapping) < end:
+            # the segment grew since it was mapped
+            self._close(segment)
+            try:
+                f = open(segment_path(self.directory, segment), 'rb')
+            except IOError:
+                return None
+            try:
+                size = os.fstat(f.fileno()).st_size
+                if size < end:
+                    return None
+                mapping = mmap.mmap(f.fileno(), size,
+                                    access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+            self._maps[segment] = mapping
+        return mapping[start:end]
+
+    def first_offset(self):
+        segments = _segments(self.directory)
+        return (segments and segments[0] or 1, 0)
+
+    def read(self, offset=None, limit=1000):
+        """Returns up to limit events, starting at offset.
+
+        Args:
+            offset: (segment, position) to start from, None for the start
+                    of the log
+
+        Returns:
+            (events, offset), the offset being where to resume
+        """
+        if offset is None:
+            offset = self.first_offset()
+        segment, position = offset
+        events = []
+        while len(events) < limit:
+            # a segment is complete once the next one exists, so this is
+            # checked before reading
+            complete = os.path.exists(segment_path(self.directory,
+                                                   segment + 1))
+            event = self._read_event(segment, position)
+            if event is None:
+                if not complete:
+                    break
+                self._close(segment)
+                segment, position = segment + 1, 0
+                continue
+            events.append(event)
+            position = event.offset[1]
+        return events, (segment, position)
+
+    def _read_event(self, segment, position):
+        prefix = self._slice(segment, position, position + _PREFIX.size)
+        if prefix is None:
+            return None
+        size, crc = _PREFIX.unpack(prefix)
+        start = position + _PREFIX.size
+        body = self._slice(segment, start, start + size)
+        if body is None:
+            # being written
+            return None
+        if crc32(body) & 0xffffffff != crc:
+            following = self._resync(segment, position + 1)
+            if following is None:
+                logger.error('Corrupted event at %d in segment %d, '
+                             'skipping the rest of the segment' %
+                             (position, segment))
+                return None
+            logger.error('Corrupted event at %d in segment %d, skipping '
+                         '%d bytes' % (position, segment,
+                                       following - position))
+            return self._read_event(segment, following)
+        type_, timestamp, length = _HEADER.unpack(body[:_HEADER.size])
+        username = body[_HEADER.size:_HEADER.size + length]
+        data = body[_HEADER.size + length:]
+        return Event(type_, timestamp / 1000., username, data,
+                     (segment, start + size))
+
+    def _resync(self, segment, position):
+        """Returns the position of the next valid record of a segment,
+        starting at position, or None."""
+        mapping = self._maps.get(segment)
+        if mapping is None:
+            return None
+        end = len(mapping)
+        while position + _PREFIX.size + _HEADER.size <= end:
+            size, crc = _PREFIX.unpack(
+                    mapping[position:position + _PREFIX.size])
+            start = position + _PREFIX.size
+            if (size >= _HEADER.size and start + size <= end and
+                    crc32(mapping[start:start + size]) & 0xffffffff == crc):
+                return position
+            position += 1
+        return None
+
+    def _close(self, segment):
+        mapping = self._maps.pop(segment, None)
+        if mapping is not None:
+            mapping.close()
+
+    def close(self):
+        for segment in list(self._maps):
+            self._close(segment)
+
+
+def read_offset(path):
+    """Returns the offset saved by a consumer, or None."""
+    if not os.path.exists(path):
+        return None
+    f = open(path)
+    try:
+        segment, position = f.read().split()
+    finally:
+        f.close()
+    return int(segment), int(position)
+
+
+def write_offset(path, offset):
+    temp = path + '.tmp'
+    f = open(temp, 'w')
+    try:
+        f.write('%d %d\n' % offset)
+    finally:
+        f.close()
+    os.rename(temp, path)
@@ -0,0 +1,293 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Export of the user registry.
+
+    $ syncreg export sync.conf -f csv -o users.csv --checkpoint users.ckpt
+
+Every account is written, ordered by id, as JSON lines or CSV. The rows
+are read in batches of a fixed size, each one starting after the last id
+of the previous one, so the memory used doesn't depend on the number of
+users.
+
+With --checkpoint, the last exported id is saved after every batch, with
+the size of the output at that point. Running the same command again
+truncates the output to that size, dropping what a crashed run wrote
+after the checkpoint, then resumes after the id.
+
+The database is the one of the [auth] section. --section points to another
+section, like one describing a replica. If the section lists
+replica_sqluris, the first replica is used.
+
+With a sharded section (sqluris, and previous_sqluris while a rebalance is
+running), every shard is read and the rows are merged by id. The shards
+use disjoint id ranges, so the checkpoint works the same way, and a user
+found on two shards in the middle of its move is written once.
+"""
+import os
+import sys
+import csv
+import time
+from optparse import OptionParser
+
+import simplejson as json
+from sqlalchemy import create_engine, MetaData, Table, select
+
+from syncreg import logger
+from syncreg.util import read_config_section, split_list
+
+
+# exported field -> column of the users table
+FIELDS = (('id', 'id'),
+          ('username', 'username'),
+          ('mail', 'email'),
+          ('node', 'primary_node'),
+          ('status', 'status'))
+
+FORMATS = ('jsonl', 'csv')
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
+
+
+class Exporter(object):
+    """Streams the users table.
+
+    Args:
+        sqluris: the database to read, or a list of shards
+        batch_size: rows read at once
+        pause: seconds to sleep between two batches, to limit the load
+    """
+    def __init__(self, sqluris, batch_size=1000, pause=0.):
+        self.shards = []
+        for sqluri in split_list(sqluris):
+            engine = create_engine(sqluri)
+            table = Table('users', MetaData(), autoload=True,
+                          autoload_with=engine)
+            self.shards.append((engine, table))
+        # the schema varies between deployments
+        self.fields = [field for field, column in FIELDS
+                       if not [table for __, table in self.shards
+                               if column not in table.c]]
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def _read(self, engine, table, after):
+        columns = dict(FIELDS)
+        query = select([table.c[columns[field]].label(field)
+                        for field in self.fields])
+        query = query.order_by(table.c.id).limit(self.batch_size)
+        if after is not None:
+            query = query.where(table.c.id > after)
+        conn = engine.connect()
+        try:
+            conn = conn.execution_options(stream_results=True)
+            result = conn.execute(query)
+            return [dict(row.items()) for row in result]
+        finally:
+            conn.close()
+
+    def iter_batches(self, after=None):
+        """Yields lists of rows, as mappings of the exported fields."""
+        while True:
+            if len(self.shards) == 1:
+                batch = self._read(self.shards[0][0], self.shards[0][1],
+                                   after)
+            else:
+                # the first rows of every shard, merged by id
+                rows = {}
+                for engine, table in self.shards:
+                    for row in self._read(engine, table, after):
+                        rows[row['id']] = row
+                batch = [rows[id_] for id_ in
+                         sorted(rows)[:self.batch_size]]
+            if not batch:
+                break
+            yield batch
+            after = batch[-1]['id']
+            if self.pause:
+                time.sleep(self.pause)
+
+    def export(self, stream, format='jsonl', after=None, checkpoint=None):
+        """Writes the users after the id `after` to stream.
+
+        Args:
+            stream: file-like object
+            format: one of FORMATS
+            after: id to start after, None to export everything
+            checkpoint: file receiving the last exported id after every
+                        batch
+
+        Returns:
+            the number of users written
+        """
+        if format not in FORMATS:
+            raise ValueError('Unknown format %r' % format)
+
+        names = self.fields
+        if format == 'csv':
+            writer = csv.writer(stream)
+            if after is None:
+                writer.writerow(names)
+
+        count = 0
+        for batch in self.iter_batches(after):
+            if format == 'csv':
+                writer.writerows([[_encode(row[name]) for name in names]
+                                  for row in batch])
+            else:
+                stream.write(''.join([json.dumps(row) + '\n'
+                                      for row in batch]))
+            stream.flush()
+            count += len(batch)
+            if checkpoint is not None:
+                write_checkpoint(checkpoint, batch[-1]['id'],
+                                 _sync(stream))
+            logger.info('%d users exported' % count)
+        return count
+
+
+def _sync(stream):
+    """Puts what was written to a file on disk, and returns its size, or
+    None for a stream that isn't a file."""
+    try:
+        os.fsync(stream.fileno())
+        return stream.tell()
+    except (AttributeError, IOError, OSError):
+        return None
+
+
+def read_checkpoint(path):
+    """Returns the (id, output size) saved in a checkpoint file, or
+    (None, None)."""
+    if not os.path.exists(path):
+        return None, None
+    f = open(path)
+    try:
+        values = f.read().split()
+    finally:
+        f.close()
+    if len(values) < 2:
+        return int(values[0]), None
+    return int(values[0]), int(values[1])
+
+
+def write_checkpoint(path, last_id, offset=None):
+    temp = path + '.tmp'
+    f = open(temp, 'w')
+    try:
+        if offset is None:
+            f.write('%d\n' % last_id)
+        else:
+            f.write('%d %d\n' % (last_id, offset))
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(temp, path)
+
+
+def resume_output(path, offset=None):
+    """Opens the output of an interrupted export, truncated to offset, for
+    appending."""
+    stream = open(path, 'r+b')
+    if offset is not None:
+        # what a crashed run wrote after its last checkpoint
+        stream.truncate(offset)
+    stream.seek(0, 2)
+    return stream
+
+
+def export_command(args):
+    """Exports the users of the registry."""
+    parser = OptionParser(usage='%prog [options] sync.conf',
+                          prog='syncreg export')
+    parser.add_option('-s', '--section', dest='section', default='auth',
+                      help='section holding the sqluri(s)')
+    parser.add_option('-f', '--format', dest='format', default='jsonl',
+                      choices=FORMATS, help='|'.join(FORMATS))
+    parser.add_option('-o', '--output', dest='output', default='-',
+                      help='output file, - for stdout')
+    parser.add_option('-c', '--checkpoint', dest='checkpoint', default=None,
+                      help='file keeping the last exported id')
+    parser.add_option('-b', '--batch-size', dest='batch_size', type='int',
+                      default=1000, help='users read at once')
+    parser.add_option('-p', '--pause', dest='pause', type='float',
+                      default=0., help='seconds between two batches')
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('You need to provide the configuration file')
+
+    config = read_config_section(args[0], options.section)
+    replicas = split_list(config.get('replica_sqluris'))
+    if config.get('sqluris'):
+        # rows still on their previous shard are read there
+        sqluri = []
+        for shard in (split_list(config['sqluris']) +
+                      split_list(config.get('previous_sqluris'))):
+            if shard not in sqluri:
+                sqluri.append(shard)
+    elif replicas:
+        sqluri = replicas[0]
+    else:
+        sqluri = config.get('sqluri')
+    if not sqluri:
+        print >> sys.stderr, 'No sqluri in [%s]' % options.section
+        return 1
+
+    after = offset = None
+    if options.checkpoint is not None:
+        after, offset = read_checkpoint(options.checkpoint)
+
+    if options.output == '-':
+        stream = sys.stdout
+    elif after is None:
+        stream = open(options.output, 'wb')
+    else:
+        stream = resume_output(options.output, offset)
+
+    exporter = Exporter(sqluri, options.batch_size, options.pause)
+    try:
+        count = exporter.export(stream, options.format, after,
+                                options.checkpoint)
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+    print >> sys.stderr, '%d users exported' % count
+    return 0
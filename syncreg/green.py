@@ -0,0 +1,207 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Cooperative front end, based on gevent.
+
+The registration flows mostly wait on the network: the captcha
+verification, the SMTP server and the databases. Instead of one thread per
+request, a green worker serves each request in a greenlet:
+
+- the standard library is monkey-patched, so the captcha HTTP call and the
+  SMTP session yield to the other requests while they wait;
+- the backends, which may use C drivers that can't be patched, are called
+  through a bounded thread pool.
+
+The routes and the controllers are the same as the threaded application's.
+gevent is an optional dependency, only needed by the green workers.
+
+    $ syncreg serve production.ini --worker-class green
+"""
+import os
+import signal
+
+from syncreg import logger
+from syncreg.util import unwrap_app, BackendProxy
+
+
+def patch():
+    """Monkey-patches the standard library. Call it as early as possible."""
+    from gevent import monkey
+    monkey.patch_all()
+
+
+class BlockingBackend(BackendProxy):
+    """Calls the methods of a backend through a thread pool.
+
+    Args:
+        backend: the wrapped backend
+        pool: a pool providing apply(func, args, kwds), like the gevent
+              ThreadPool. The greenlet calling the backend waits for the
+              result, the others keep running.
+    """
+    def __init__(self, backend, pool):
+        super(BlockingBackend, self).__init__(backend)
+        self._pool = pool
+
+    def _wrap_method(self, name, method):
+        def _call(*args, **kw):
+            return self._pool.apply(method, args, kw)
+        return _call
+
+
+def _under_proxies(backend, pool):
+    # the other proxies work in the greenlet, only the real backend calls
+    # go to the pool
+    if isinstance(backend, BlockingBackend):
+        # kept by a configuration reload
+        return backend
+    if isinstance(backend, BackendProxy):
+        backend._backend = _under_proxies(backend._backend, pool)
+        return backend
+    return BlockingBackend(backend, pool)
+
+
+def wrap_backends(app, size=10):
+    """Makes all the backends of the application go through a thread pool.
+
+    Args:
+        app: the application, wrapped or not
+        size: maximum number of backend calls running at the same time
+
+    Returns:
+        the thread pool
+    """
+    from gevent.threadpool import ThreadPool
+
+    app = unwrap_app(app)
+    pool = ThreadPool(size)
+    app.auth.backend = _under_proxies(app.auth.backend, pool)
+    wrap_controller(app.controllers['user'], pool)
+    # the controllers built by a configuration reload too
+    reloader = getattr(app, 'reloader', None)
+    if reloader is not None:
+        reloader.callbacks.append(lambda user: wrap_controller(user, pool))
+    return pool
+
+
+def wrap_controller(user, pool):
+    """Makes the backends of a user controller go through a thread pool.
+    """
+    user.auth = _under_proxies(user.auth, pool)
+    if user.reset is not None:
+        user.reset = _under_proxies(user.reset, pool)
+
+
+class GreenWorker(object):
+    """Worker process serving every request in its own greenlet.
+
+    Args:
+        sock: the listening socket
+        app: the WSGI application
+        max_requests: the worker stops after that many requests,
+                      0 disables recycling
+        connections: maximum number of requests served at the same time
+        executor_size: maximum number of backend calls running at the
+                       same time
+        graceful_timeout: seconds given to the current requests to finish
+                          when the worker stops
+    """
+    def __init__(self, sock, app, max_requests=0, connections=1000,
+                 executor_size=10, graceful_timeout=30):
+        self.sock = sock
+        self.app = app
+        self.max_requests = max_requests
+        self.connections = connections
+        self.executor_size = executor_size
+        self.graceful_timeout = graceful_timeout
+        self.handled = 0
+        self.ppid = os.getppid()
+        self.server = None
+        self.reloader = getattr(unwrap_app(app), 'reloader', None)
+
+    def _app(self, environ, start_response):
+        self.handled += 1
+        if self.max_requests and self.handled == self.max_requests:
+            logger.info('Worker %d recycled after %d requests' %
+                        (os.getpid(), self.handled))
+            self.stop()
+        return self.app(environ, start_response)
+
+    def stop(self, *args):
+        import gevent
+        # the current requests are given some time to finish
+        gevent.spawn(self.server.stop, self.graceful_timeout)
+
+    def reload(self, *args):
+        """Reloads the configuration, the current requests finish with the
+        previous one."""
+        import gevent
+        if self.reloader is not None:
+            gevent.spawn(self.reloader.run)
+
+    def _watch_master(self):
+        import gevent
+        while os.getppid() == self.ppid:
+            gevent.sleep(1.)
+        logger.info('Master is gone, worker %d leaving' % os.getpid())
+        self.stop()
+
+    def run(self):
+        import gevent
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+        from gevent import socket
+
+        wrap_backends(self.app, self.executor_size)
+        for signum in (signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU,
+                       signal.SIGCHLD, signal.SIGTERM):
+            signal.signal(signum, signal.SIG_DFL)
+        # renamed in gevent 1.5, gevent.signal is now a module
+        signal_handler = getattr(gevent, 'signal_handler', None)
+        if signal_handler is None:
+            signal_handler = gevent.signal
+        signal_handler(signal.SIGTERM, self.stop)
+        signal_handler(signal.SIGHUP, self.reload)
+
+        sock = self.sock
+        if not isinstance(sock, socket.socket):
+            sock = socket.socket(_sock=getattr(sock, '_sock', sock))
+        self.server = WSGIServer(sock, self._app,
+                                 spawn=Pool(self.connections), log=None)
+        gevent.spawn(self._watch_master)
+        # serve_forever stops the server again when it returns, and the
+        # worker exits right after
+        self.server.serve_forever(stop_timeout=self.graceful_timeout)
@@ -0,0 +1,207 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Backend health checks.
+
+Each backend is checked periodically by its own thread and the results are
+cached, so reading the health of the application costs nothing and never
+waits on a sick dependency: a check that hangs just gets stale.
+"""
+import os
+import time
+import socket
+import smtplib
+import threading
+import traceback
+
+from recaptcha.client import captcha
+
+from services.user import User
+
+from syncreg import logger
+from syncreg.util import iter_engines, split_list
+
+
+OK = 'ok'
+FAILED = 'failed'
+DISABLED = 'disabled'
+UNKNOWN = 'unknown'
+
+
+class HealthChecker(object):
+    """Checks the backends in the background.
+
+    Options, from the [health] section:
+
+    - interval: seconds between two checks of a backend (default: 10)
+    - timeout: network timeout of the SMTP and captcha checks (default: 5)
+    - stale_after: age after which a result is not trusted anymore
+      (default: 3 intervals)
+    - critical: checks that make the whole application unhealthy when
+      they fail (default: auth)
+    - canary_user: the user looked up by the auth check
+      (default: __health__)
+    """
+    def __init__(self, app):
+        self.app = app
+        config = app.config
+        self.interval = config.get('health.interval', 10)
+        self.timeout = config.get('health.timeout', 5)
+        self.stale_after = config.get('health.stale_after',
+                                      self.interval * 3)
+        self.critical = split_list(config.get('health.critical', 'auth'))
+        self.canary_user = config.get('health.canary_user', '__health__')
+        self.checks = [('auth', self.check_auth),
+                       ('reset_codes', self.check_reset_codes),
+                       ('smtp', self.check_smtp),
+                       ('captcha', self.check_captcha)]
+        self.results = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Starts the checking threads, once per process.
+
+        Threads don't survive a fork, so this is called again lazily by
+        the first status() call of each worker.
+        """
+        if self._pid == os.getpid():
+            return
+
+        self._lock.acquire()
+        try:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.results = {}
+            for name, check in self.checks:
+                thread = threading.Thread(target=self._loop,
+                                          args=(name, check, self._pid))
+                thread.setDaemon(True)
+                thread.start()
+        finally:
+            self._lock.release()
+
+    def _loop(self, name, check, pid):
+        while self._pid == pid:
+            self.run_check(name, check)
+            time.sleep(self.interval)
+
+    def run_check(self, name, check):
+        """Runs a check and stores its result."""
+        start = time.time()
+        error = None
+        try:
+            status = check()
+        except Exception, e:
+            logger.debug(traceback.format_exc())
+            status = FAILED
+            error = '%s: %s' % (e.__class__.__name__, e)
+
+        result = {'status': status, 'checked': time.time(),
+                  'duration': time.time() - start}
+        if error is not None:
+            result['error'] = error
+        # replacing the whole entry keeps the readers lock-free
+        self.results[name] = result
+        return result
+
+    def status(self):
+        """Returns (healthy, details) from the cached results."""
+        self.start()
+        now = time.time()
+        healthy = True
+        details = {}
+        for name, __ in self.checks:
+            result = self.results.get(name)
+            if result is None:
+                result = {'status': UNKNOWN}
+            else:
+                result = dict(result)
+                result['age'] = now - result['checked']
+                result['stale'] = result['age'] > self.stale_after
+
+            if name in self.critical and (result['status'] != OK or
+                                          result.get('stale', True)):
+                healthy = False
+            details[name] = result
+        return healthy, details
+
+    #
+    # checks
+    #
+    def check_auth(self):
+        self.app.auth.backend.get_user_id(User(self.canary_user))
+        return OK
+
+    def check_reset_codes(self):
+        user = self.app.controllers['user']
+        if user.reset is None:
+            return DISABLED
+
+        engines = [engine for name, engine in iter_engines(self.app)
+                   if name.startswith('reset_codes')]
+        if not engines:
+            ping = getattr(user.reset, 'ping', None)
+            if ping is None:
+                # nothing we can check without side effects
+                return UNKNOWN
+            ping()
+        for engine in engines:
+            engine.execute('SELECT 1')
+        return OK
+
+    def check_smtp(self):
+        config = self.app.config
+        server = smtplib.SMTP(config['smtp.host'], int(config['smtp.port']),
+                              timeout=self.timeout)
+        try:
+            server.noop()
+        finally:
+            server.quit()
+        return OK
+
+    def check_captcha(self):
+        if not self.app.config['captcha.use']:
+            return DISABLED
+        server = self.app.config.get('captcha.verify_server')
+        if server is None:
+            server = captcha.VERIFY_SERVER
+        host, __, port = server.partition(':')
+        conn = socket.create_connection((host, int(port or 80)),
+                                        self.timeout)
+        conn.close()
+        return OK
@@ -0,0 +1,322 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Responses of the requests made with an Idempotency-Key header.
+
+The first request with a key claims it, and its response is stored once
+it is known. The retries of that request get the stored response back
+without running it again, or a 409 while the first one is still running.
+
+    [idempotency]
+    max_keys = 10000
+    ttl = 86400
+    path = /var/lib/syncreg/idempotency.db
+
+Without a path, the responses are kept in the memory of each process, and
+a retry served by another worker of a pre-fork server runs the request
+again. With a path, they are stored in an SQLite database shared by the
+workers, and each process keeps the ones it already read in memory. With
+"shared = true", they are stored in the [cache] backend, shared by the
+nodes too (see syncreg.cache).
+"""
+import os
+import time
+import sqlite3
+import threading
+
+from syncreg.util import LRUCache
+
+
+_SCHEMA = """\
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    status INTEGER,
+    content_type TEXT,
+    body TEXT,
+    expires REAL NOT NULL
+)"""
+
+_INDEX = """\
+CREATE INDEX IF NOT EXISTS idempotency_expires
+ON idempotency_keys (expires)"""
+
+
+class IdempotencyStore(object):
+    """Responses kept in the memory of the process.
+
+    The records are (fingerprint, status, content_type, body) tuples. The
+    status is None while the first request is running.
+
+    Args:
+        max_keys: maximum number of keys kept
+        ttl: seconds during which a response is replayed
+        pending_ttl: seconds after which a key claimed by a request that
+                     never completed can be claimed again
+    """
+    def __init__(self, max_keys=10000, ttl=86400, pending_ttl=60):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self._cache = LRUCache(max_keys, ttl)
+        self._lock = threading.Lock()
+
+    def claim(self, key, fingerprint):
+        """Claims a key for a request.
+
+        Args:
+            key: the idempotency key
+            fingerprint: identifies the payload of the request
+
+        Returns:
+            None if the caller now owns the key, or the record found
+        """
+        self._lock.acquire()
+        try:
+            record = self._cache.get(key)
+            if record is None:
+                self._cache.set(key, (fingerprint, None, None, None),
+                                self.pending_ttl)
+            return record
+        finally:
+            self._lock.release()
+
+    def complete(self, key, fingerprint, status, content_type, body):
+        """Stores the response of the request owning the key."""
+        self._cache.set(key, (fingerprint, status, content_type, body))
+
+    def release(self, key):
+        """Forgets a key, so that the request can be retried."""
+        self._cache.delete(key)
+
+
+class SQLiteIdempotencyStore(IdempotencyStore):
+    """Responses stored in an SQLite database shared by the workers.
+
+    Args:
+        path: location of the database file
+        max_keys: maximum number of keys kept in the database, and in the
+                  memory of each process
+        ttl: seconds during which a response is replayed
+        pending_ttl: seconds after which a key claimed by a request that
+                     never completed can be claimed again
+        purge_interval: number of claims between two purges of the
+                        expired keys
+        timeout: seconds to wait for a lock on the database
+    """
+    def __init__(self, path, max_keys=10000, ttl=86400, pending_ttl=60,
+                 purge_interval=1000, timeout=5.):
+        super(SQLiteIdempotencyStore, self).__init__(max_keys, ttl,
+                                                     pending_ttl)
+        self.path = path
+        self.purge_interval = purge_interval
+        self.timeout = timeout
+        self._claims = 0
+        self._local = threading.local()
+        # the connections of all the threads, closed by close()
+        self._connections = []
+        self._generation = 0
+        self._lock = threading.Lock()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(_SCHEMA)
+        conn.execute(_INDEX)
+
+    def _conn(self):
+        """Returns the connection of the current thread and process."""
+        pid = os.getpid()
+        if (getattr(self._local, 'pid', None) != pid or
+                self._local.generation != self._generation):
+            # closed by close() from another thread
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._lock.acquire()
+            try:
+                self._connections.append((pid, conn))
+                self._local.generation = self._generation
+            finally:
+                self._lock.release()
+            self._local.conn = conn
+            self._local.pid = pid
+        return self._local.conn
+
+    def close(self):
+        """Closes the connections of all the threads of the process.
+
+        A thread using the store afterwards opens a new connection.
+        """
+        pid = os.getpid()
+        self._lock.acquire()
+        try:
+            connections, self._connections = self._connections, []
+            self._generation += 1
+        finally:
+            self._lock.release()
+        for owner, conn in connections:
+            # the connections of the parent process are not ours
+            if owner == pid:
+                conn.close()
+
+    def claim(self, key, fingerprint):
+        # completed responses don't change anymore
+        record = self._cache.get(key)
+        if record is not None:
+            return record
+
+        conn = self._conn()
+        now = time.time()
+        self._claims += 1
+        if self._claims % self.purge_interval == 0:
+            self.purge()
+
+        # the key can be released by its owner between the two queries
+        for attempt in range(3):
+            conn.execute('DELETE FROM idempotency_keys WHERE key = ? AND '
+                         'expires <= ?', (key, now))
+            cursor = conn.execute('INSERT OR IGNORE INTO idempotency_keys '
+                                  '(key, fingerprint, expires) '
+                                  'VALUES (?, ?, ?)',
+                                  (key, fingerprint, now + self.pending_ttl))
+            if cursor.rowcount == 1:
+                return None
+            row = conn.execute('SELECT fingerprint, status, content_type, '
+                               'body, expires FROM idempotency_keys '
+                               'WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                break
+        else:
+            return None
+
+        record = (str(row[0]), row[1], row[2], row[3])
+        if record[1] is not None:
+            self._cache.set(key, record, max(row[4] - now, 0))
+        return record
+
+    def complete(self, key, fingerprint, status, content_type, body):
+        self._conn().execute('UPDATE idempotency_keys SET status = ?, '
+                             'content_type = ?, body = ?, expires = ? '
+                             'WHERE key = ?',
+                             (status, content_type, body,
+                              time.time() + self.ttl, key))
+        self._cache.set(key, (fingerprint, status, content_type, body))
+
+    def release(self, key):
+        self._conn().execute('DELETE FROM idempotency_keys WHERE key = ? '
+                             'AND status IS NULL', (key,))
+        self._cache.delete(key)
+
+    def purge(self):
+        """Deletes the expired keys, and the oldest ones past max_keys.
+
+        Returns:
+            the number of deleted keys
+        """
+        conn = self._conn()
+        deleted = conn.execute('DELETE FROM idempotency_keys WHERE '
+                               'expires <= ?', (time.time(),)).rowcount
+        count = conn.execute('SELECT COUNT(*) FROM '
+                             'idempotency_keys').fetchone()[0]
+        if count > self.max_keys:
+            deleted += conn.execute(
+                'DELETE FROM idempotency_keys WHERE key IN (SELECT key '
+                'FROM idempotency_keys ORDER BY expires LIMIT ?)',
+                (count - self.max_keys,)).rowcount
+        return deleted
+
+
+class CacheIdempotencyStore(IdempotencyStore):
+    """Responses stored in a shared cache, see syncreg.cache.
+
+    Args:
+        cache: the cache backend
+        ttl: seconds during which a response is replayed
+        pending_ttl: seconds after which a key claimed by a request that
+                     never completed can be claimed again
+    """
+    def __init__(self, cache, ttl=86400, pending_ttl=60):
+        self.cache = cache
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+
+    def _key(self, key):
+        return 'idempotency:%s' % key
+
+    def claim(self, key, fingerprint):
+        key = self._key(key)
+        # the key can be released by its owner between the two calls
+        for attempt in range(3):
+            if self.cache.add(key, [fingerprint, None, None, None],
+                              self.pending_ttl):
+                return None
+            record = self.cache.get(key)
+            if record is not None:
+                # the strings come back decoded from JSON
+                return tuple([isinstance(item, unicode) and
+                              item.encode('utf8') or item
+                              for item in record])
+        return None
+
+    def complete(self, key, fingerprint, status, content_type, body):
+        self.cache.set(self._key(key),
+                       [fingerprint, status, content_type, body], self.ttl)
+
+    def release(self, key):
+        self.cache.delete(self._key(key))
+
+
+def get_store(config, cache=None):
+    """Returns the store described by the [idempotency] section.
+
+    Args:
+        config: the application configuration
+        cache: the shared cache, if any
+
+    Returns:
+        an IdempotencyStore, or None when disabled
+    """
+    if not config.get('idempotency.enabled', True):
+        return None
+    max_keys = config.get('idempotency.max_keys', 10000)
+    ttl = config.get('idempotency.ttl', 86400)
+    pending_ttl = config.get('idempotency.pending_ttl', 60)
+    if cache is not None and config.get('idempotency.shared', False):
+        return CacheIdempotencyStore(cache, ttl, pending_ttl)
+    path = config.get('idempotency.path')
+    if path is None:
+        return IdempotencyStore(max_keys, ttl, pending_ttl)
+    return SQLiteIdempotencyStore(path, max_keys, ttl, pending_ttl)
@@ -0,0 +1,304 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Memory accounting of a worker.
+
+    [memory]
+    enabled = true
+    frames = 1
+    signal = true
+
+When enabled, the allocations are traced by tracemalloc from the start of
+the application, and GET /__memory__ (with the shared secret) returns the
+memory allocated since the baseline, grouped by category: controllers,
+templates, backends, caches... ?reset=1 takes a new baseline. With
+"signal", a USR1 sent to a worker logs the same report.
+
+Tracing slows the allocations down, so it is meant for a few workers at a
+time. Without tracemalloc (Python 2 without pytracemalloc), only the RSS
+of the process is reported.
+
+    $ syncreg bench memory -n 100000
+
+measures the size of the entries of the in-memory caches.
+"""
+import os
+import gc
+import sys
+import time
+import signal
+import threading
+from optparse import OptionParser
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from syncreg import logger
+
+
+# first match wins: (category, path fragments)
+CATEGORIES = (('controllers', ('/syncreg/controllers/',)),
+              ('templates', ('/mako/', '/syncreg/templates/')),
+              ('backends', ('/syncreg/backends/', '/services/user/',
+                            '/services/resetcodes/', '/services/pluginreg',
+                            '/sqlalchemy/', '/ldap/')),
+              ('caches', ('/syncreg/util.py', '/syncreg/idempotency.py',
+                          '/syncreg/breaker.py', '/syncreg/snapshot.py',
+                          '/syncreg/pwned.py')),
+              ('syncreg', ('/syncreg/',)),
+              ('services', ('/services/',)),
+              ('web', ('/webob/', '/paste/', '/routes/', '/webtest/')))
+
+
+def categorize(filename):
+    """Returns the category of the code in filename."""
+    filename = filename.replace(os.sep, '/')
+    for category, fragments in CATEGORIES:
+        for fragment in fragments:
+            if fragment in filename:
+                return category
+    if filename.startswith('<'):
+        return 'other'
+    if '/site-packages/' in filename or '/dist-packages/' in filename:
+        return 'libraries'
+    return 'stdlib'
+
+
+def rss():
+    """Returns the resident memory of the process, in bytes, or None."""
+    try:
+        f = open('/proc/self/statm')
+    except IOError:
+        return None
+    try:
+        pages = int(f.read().split()[1])
+    finally:
+        f.close()
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class MemoryProfiler(object):
+    """Snapshots of the traced allocations, diffed against a baseline.
+
+    Args:
+        frames: number of frames kept per allocation
+        top: number of files listed in the reports
+    """
+    def __init__(self, frames=1, top=10):
+        self.frames = frames
+        self.top = top
+        self.baseline = None
+        self.baseline_time = None
+        self._lock = threading.Lock()
+
+    @property
+    def tracing(self):
+        return tracemalloc is not None and tracemalloc.is_tracing()
+
+    def start(self):
+        """Starts tracing, and takes the baseline."""
+        if tracemalloc is None:
+            return False
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.reset()
+        return True
+
+    def _snapshot(self):
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>')))
+
+    def reset(self):
+        """Takes a new baseline."""
+        if not self.tracing:
+            return
+        self._lock.acquire()
+        try:
+            self.baseline = self._snapshot()
+            self.baseline_time = time.time()
+        finally:
+            self._lock.release()
+
+    def report(self):
+        """Returns the memory allocated since the baseline.
+
+        Returns:
+            a mapping with the RSS, and when tracing, the size and count of
+            the live allocations of each category, with their difference
+            to the baseline, and the files that grew the most
+        """
+        report = {'rss': rss(), 'tracing': self.tracing}
+        if not report['tracing']:
+            return report
+
+        self._lock.acquire()
+        try:
+            snapshot = self._snapshot()
+            stats = snapshot.compare_to(self.baseline, 'filename')
+        finally:
+            self._lock.release()
+
+        categories = {}
+        for stat in stats:
+            filename = stat.traceback[0].filename
+            totals = categories.setdefault(categorize(filename),
+                                           {'size': 0, 'size_diff': 0,
+                                            'count': 0, 'count_diff': 0})
+            totals['size'] += stat.size
+            totals['size_diff'] += stat.size_diff
+            totals['count'] += stat.count
+            totals['count_diff'] += stat.count_diff
+
+        top = sorted(stats, key=lambda stat: -stat.size_diff)[:self.top]
+        current, peak = tracemalloc.get_traced_memory()
+        report.update({'traced': current, 'peak': peak,
+                       'since': time.time() - self.baseline_time,
+                       'categories': categories,
+                       'top': [{'file': stat.traceback[0].filename,
+                                'size': stat.size,
+                                'size_diff': stat.size_diff}
+                               for stat in top]})
+        return report
+
+    def log_report(self):
+        """Logs the report, biggest categories first."""
+        report = self.report()
+        lines = ['Memory: rss %s' % report['rss']]
+        categories = report.get('categories', {})
+        for name, totals in sorted(categories.items(),
+                                   key=lambda item: -item[1]['size']):
+            lines.append('  %-12s %12d bytes (%+d) %9d blocks (%+d)' %
+                         (name, totals['size'], totals['size_diff'],
+                          totals['count'], totals['count_diff']))
+        logger.info('\n'.join(lines))
+
+    def _signal(self, signum, frame):
+        thread = threading.Thread(target=self.log_report)
+        thread.setDaemon(True)
+        thread.start()
+
+    def install(self, signum=signal.SIGUSR1):
+        """Logs a report when signum is received. Must be called from the
+        main thread."""
+        signal.signal(signum, self._signal)
+
+
+def get_profiler(config):
+    """Returns the profiler described by the [memory] section, started,
+    or None when disabled."""
+    if not config.get('memory.enabled', False):
+        return None
+    profiler = MemoryProfiler(config.get('memory.frames', 1),
+                              config.get('memory.top', 10))
+    if not profiler.start():
+        logger.warning('tracemalloc is not available, only the RSS will '
+                       'be reported')
+    if config.get('memory.signal', False):
+        try:
+            profiler.install()
+        except ValueError:
+            logger.warning('The USR1 signal can only be handled when the '
+                           'application is loaded in the main thread')
+    return profiler
+
+
+def _measure(build):
+    """Returns the bytes allocated by build(), and what it returned."""
+    gc.collect()
+    if tracemalloc is not None:
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0] - before
+        if started:
+            tracemalloc.stop()
+        return size, result
+    before = rss()
+    result = build()
+    gc.collect()
+    return rss() - before, result
+
+
+def bench_memory(count=100000):
+    """Measures the size of the entries of the caches.
+
+    Returns:
+        a list of (name, bytes per entry) tuples
+    """
+    from syncreg.util import LRUCache
+    from syncreg.idempotency import IdempotencyStore
+
+    usernames = ['user%08d' % i for i in range(count)]
+
+    def _known_users():
+        cache = LRUCache(count, ttl=60)
+        for index, username in enumerate(usernames):
+            cache.set(username, index)
+        return cache
+
+    def _idempotency():
+        store = IdempotencyStore(count)
+        for username in usernames:
+            store.claim(username, 'f' * 40)
+            store.complete(username, 'f' * 40, 200, None, '"%s"' % username)
+        return store
+
+    results = []
+    for name, build in (('LRUCache entry', _known_users),
+                        ('idempotency record', _idempotency)):
+        size, __ = _measure(build)
+        results.append((name, size / float(count)))
+    return results
+
+
+def bench_memory_command(args):
+    parser = OptionParser(usage='%prog [options]',
+                          prog='syncreg bench memory')
+    parser.add_option('-n', '--count', dest='count', type='int',
+                      default=100000, help='number of entries')
+    options, args = parser.parse_args(args)
+    if tracemalloc is None:
+        print >> sys.stderr, 'tracemalloc not available, using the RSS'
+    for name, size in bench_memory(options.count):
+        print '%-20s %8.1f bytes' % (name, size)
+    return 0
@@ -0,0 +1,305 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Connection pool metrics and adaptive sizing.
+
+Every SQLAlchemy engine of the backends (auth, reset codes, shards and
+replicas) is instrumented, and its metrics are shown on /__stats__:
+
+- size, max_overflow, checked_out, overflow: the current state
+- checkouts, wait_total, wait_max: the successful checkouts, and the
+  time they spent waiting for a connection
+- timeouts: checkouts that gave up waiting
+- connects, connect_failures: new database connections
+- reconnects: connections replaced by a recycle or an invalidation
+
+Options, from the [pool] section:
+
+- adaptive: if true, the overflow of the pools is adjusted to the wait
+  times (default: false)
+- target_wait: average checkout wait above which a pool grows, in
+  seconds (default: 0.005)
+- adaptive_interval: seconds between two adjustments (default: 10)
+- adaptive_max_overflow: the largest overflow allowed (default: 50)
+- warn_interval: minimum seconds between two warnings about the requests
+  outnumbering the connections (default: 60)
+
+The adaptive mode only moves max_overflow, between its configured value
+and adaptive_max_overflow: pool_size connections are kept, and the extra
+ones are closed when they are returned.
+"""
+import time
+import threading
+import weakref
+
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+from syncreg import logger
+from syncreg.util import iter_engines
+
+
+class PoolStats(object):
+    """Metrics and adaptive sizing of one pool.
+
+    Args:
+        name: name of the engine
+        adaptive: if True, max_overflow follows the wait times
+        target_wait: see the module docstring
+        interval: see adaptive_interval
+        max_overflow: see adaptive_max_overflow
+    """
+    def __init__(self, name, adaptive=False, target_wait=0.005,
+                 interval=10, max_overflow=50):
+        self.name = name
+        self.adaptive = adaptive
+        self.target_wait = target_wait
+        self.interval = interval
+        self.adaptive_max_overflow = max_overflow
+        self.pool = None
+        self.min_overflow = None
+        self.checkouts = 0
+        self.wait_total = 0.
+        self.wait_max = 0.
+        self.timeouts = 0
+        self.connects = 0
+        self.connect_failures = 0
+        self.reconnects = 0
+        self.resized = 0
+        self._records = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._window_checkouts = 0
+        self._window_wait = 0.
+        self._window_peak = 0
+
+    def instrument(self, pool):
+        """Wraps a pool. Pools recreated by a dispose keep the listener and
+        the creator, so they are not wrapped twice."""
+        if pool is self.pool:
+            return
+        self.pool = pool
+        if self.min_overflow is None and isinstance(pool, QueuePool):
+            self.min_overflow = pool._max_overflow
+            if self.min_overflow < 0:
+                # no limit, nothing to adapt
+                self.adaptive = False
+        if self not in pool.listeners:
+            pool.add_listener(self)
+
+        creator = pool._creator
+        if getattr(creator, 'pool_stats', None) is not self:
+            creator = getattr(creator, 'wrapped', creator)
+
+            def _create():
+                try:
+                    return creator()
+                except Exception:
+                    self.connect_failures += 1
+                    raise
+            _create.pool_stats = self
+            _create.wrapped = creator
+            pool._creator = _create
+
+        # 0.6 checks out through get(), later versions through _do_get()
+        name = hasattr(pool, 'do_get') and 'get' or '_do_get'
+        get = getattr(pool.__class__, name)
+
+        def _timed_get():
+            start = time.time()
+            try:
+                conn = get(pool)
+            except TimeoutError:
+                self._timed_out(time.time() - start)
+                raise
+            # the connect failures are counted by the creator
+            self._checked_out(time.time() - start)
+            return conn
+        setattr(pool, name, _timed_get)
+
+    # PoolListener interface
+    def connect(self, dbapi_con, con_record):
+        self.connects += 1
+        if con_record in self._records:
+            self.reconnects += 1
+        else:
+            self._records[con_record] = True
+
+    def _timed_out(self, wait):
+        self._lock.acquire()
+        try:
+            self.timeouts += 1
+            # the pool still has to grow
+            self._window_wait += wait
+        finally:
+            self._lock.release()
+
+    def _checked_out(self, wait):
+        self._lock.acquire()
+        try:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self._window_checkouts += 1
+            self._window_wait += wait
+            if self.pool is not None:
+                self._window_peak = max(self._window_peak,
+                                        self.pool.checkedout())
+            if time.time() - self._window_start < self.interval:
+                return
+            if self.adaptive:
+                self._adapt()
+            self._window_start = time.time()
+            self._window_checkouts = 0
+            self._window_wait = 0.
+            self._window_peak = 0
+        finally:
+            self._lock.release()
+
+    def _adapt(self):
+        """Grows the overflow when the checkouts waited, shrinks it when
+        the connections were not all used."""
+        pool = self.pool
+        average = self._window_wait / max(self._window_checkouts, 1)
+        step = max(1, pool.size() // 10)
+        current = pool._max_overflow
+        if average > self.target_wait:
+            new = min(current + step, self.adaptive_max_overflow)
+        elif self._window_peak < pool.size() + current - step:
+            new = max(current - step, self.min_overflow)
+        else:
+            return
+        if new != current:
+            pool._max_overflow = new
+            self.resized += 1
+            logger.info('Pool %s: max_overflow %d -> %d (average wait '
+                        '%.1fms)' % (self.name, current, new,
+                                     average * 1000))
+
+    def capacity(self):
+        """Returns the maximum number of connections, or None."""
+        pool = self.pool
+        if not isinstance(pool, QueuePool) or pool._max_overflow < 0:
+            return None
+        return pool.size() + pool._max_overflow
+
+    def stats(self):
+        stats = {'checkouts': self.checkouts,
+                 'wait_total': self.wait_total,
+                 'wait_max': self.wait_max,
+                 'timeouts': self.timeouts,
+                 'connects': self.connects,
+                 'connect_failures': self.connect_failures,
+                 'reconnects': self.reconnects,
+                 'resized': self.resized}
+        pool = self.pool
+        if isinstance(pool, QueuePool):
+            stats.update({'size': pool.size(),
+                          'max_overflow': pool._max_overflow,
+                          'checked_out': pool.checkedout(),
+                          'overflow': pool.overflow()})
+        return stats
+
+
+class PoolMonitor(object):
+    """Instruments the pools of an application, and warns when there are
+    more requests in flight than connections."""
+
+    def __init__(self, app):
+        self.app = app
+        config = app.config
+        self.adaptive = config.get('pool.adaptive', False)
+        self.target_wait = config.get('pool.target_wait', 0.005)
+        self.interval = config.get('pool.adaptive_interval', 10)
+        self.max_overflow = config.get('pool.adaptive_max_overflow', 50)
+        self.warn_interval = config.get('pool.warn_interval', 60)
+        self.pools = {}
+        self.in_flight = 0
+        self.in_flight_max = 0
+        self._warned = 0
+        self._lock = threading.Lock()
+        self.instrument()
+
+    def instrument(self):
+        """Instruments the current pools. Called again after the engines
+        are disposed, since that replaces their pools."""
+        for name, engine in iter_engines(self.app):
+            stats = self.pools.get(name)
+            if stats is None:
+                stats = PoolStats(name, self.adaptive, self.target_wait,
+                                  self.interval, self.max_overflow)
+                self.pools[name] = stats
+            stats.instrument(engine.pool)
+
+    def _check_capacity(self, in_flight):
+        now = time.time()
+        if now - self._warned < self.warn_interval:
+            return
+        for name, stats in self.pools.items():
+            capacity = stats.capacity()
+            if capacity is not None and in_flight > capacity:
+                self._warned = now
+                logger.warning('%d requests in flight, but the %s pool only '
+                               'has %d connections: raise its pool_size or '
+                               'lower the number of worker threads' %
+                               (in_flight, name, capacity))
+
+    def wrap(self, action, function):
+        """Returns function, counting the requests in flight."""
+        def _counted(request, *args, **kw):
+            self._lock.acquire()
+            try:
+                self.in_flight += 1
+                in_flight = self.in_flight
+                self.in_flight_max = max(self.in_flight_max, in_flight)
+            finally:
+                self._lock.release()
+            try:
+                self._check_capacity(in_flight)
+                return function(request, *args, **kw)
+            finally:
+                self._lock.acquire()
+                try:
+                    self.in_flight -= 1
+                finally:
+                    self._lock.release()
+        return _counted
+
+    def stats(self):
+        return {'in_flight': self.in_flight,
+                'in_flight_max': self.in_flight_max,
+                'pools': dict([(name, stats.stats())
+                               for name, stats in self.pools.items()])}
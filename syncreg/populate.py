@@ -0,0 +1,237 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Generator of synthetic users, for tests at scale.
+
+    $ syncreg populate sync.conf -n 10000000
+
+The users are written straight into the users table of the [auth]
+section, in bulk inserts. When the section lists several sqluris, like
+the sharded backend, each user goes to its shard.
+
+One user is first created through the backend. Its row is the template
+of all the others, which only differ by their username and e-mail: the
+password hash is computed once. The users are named like the real ones,
+from their e-mail (populate<N>@example.com by default), and they all
+have the password given by --password.
+
+With --reset-every N, one user out of N also gets a reset code from the
+[reset_codes] backend. The codes are written to --reset-output.
+"""
+import sys
+import time
+from optparse import OptionParser
+
+from sqlalchemy import create_engine, MetaData, Table, select
+
+from services.user import User, extract_username
+from services.user.sql import SQLUser
+
+from syncreg import logger
+from syncreg.backends.sharded import HashRing, shard_id
+from syncreg.util import split_list, read_config_section
+
+# columns that differ between the generated users
+_OWN_COLUMNS = ('id', 'username', 'email')
+
+
+def make_template(sqluri, password):
+    """Creates a user through the backend, and returns its row without
+    the columns of _OWN_COLUMNS."""
+    backend = SQLUser(sqluri=sqluri, create_tables=True)
+    email = 'template-%d@example.com' % (time.time() * 1000)
+    username = extract_username(email)
+    if not backend.create_user(username, password, email):
+        raise ValueError('Could not create the template user')
+
+    engine = create_engine(sqluri)
+    table = Table('users', MetaData(), autoload=True, autoload_with=engine)
+    row = engine.execute(select([table]).where(
+                         table.c.username == username)).fetchone()
+    engine.execute(table.delete().where(table.c.username == username))
+    return dict([(key, value) for key, value in row.items()
+                 if key not in _OWN_COLUMNS])
+
+
+class Populator(object):
+    """Writes synthetic users.
+
+    Args:
+        sqluris: the databases. With several of them, the users are
+                 spread as the sharded backend does.
+        template: values of the columns shared by all the users
+        batch_size: rows inserted at once
+        prefix: the e-mail of user N is <prefix><N>@<domain>
+        domain: see prefix
+        replicas: must be the value used by the sharded backend
+    """
+    def __init__(self, sqluris, template, batch_size=10000,
+                 prefix='populate', domain='example.com', replicas=100):
+        sqluris = split_list(sqluris)
+        self.engines = {}
+        self.tables = {}
+        for sqluri in sqluris:
+            engine = create_engine(sqluri)
+            self.engines[shard_id(sqluri)] = engine
+            self.tables[shard_id(sqluri)] = Table(
+                'users', MetaData(), autoload=True, autoload_with=engine)
+        if len(sqluris) > 1:
+            self.ring = HashRing([shard_id(sqluri) for sqluri in sqluris],
+                                 replicas)
+        else:
+            self.ring = None
+        self.default = shard_id(sqluris[0])
+        self.template = template
+        self.batch_size = batch_size
+        self.prefix = prefix
+        self.domain = domain
+
+    def user(self, index):
+        """Returns the username and e-mail of user index."""
+        email = '%s%d@%s' % (self.prefix, index, self.domain)
+        return extract_username(email), email
+
+    def _flush(self, shard, rows, callback=None):
+        conn = self.engines[shard].connect()
+        trans = conn.begin()
+        try:
+            conn.execute(self.tables[shard].insert(), rows)
+            trans.commit()
+        except Exception:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+        if callback is not None:
+            for row in rows:
+                callback(row['username'])
+        return len(rows)
+
+    def run(self, count, start=0, callback=None):
+        """Writes users start to start + count - 1.
+
+        Args:
+            callback: if given, called with the username of every user,
+                      once it is written
+
+        Returns:
+            the number of users written
+        """
+        buffers = dict([(shard, []) for shard in self.engines])
+        template = self.template
+        written = 0
+        started = time.time()
+        for index in xrange(start, start + count):
+            username, email = self.user(index)
+            row = template.copy()
+            row['username'] = username
+            row['email'] = email
+            if self.ring is None:
+                shard = self.default
+            else:
+                shard = self.ring.get_node(username)
+            rows = buffers[shard]
+            rows.append(row)
+            if len(rows) >= self.batch_size:
+                written += self._flush(shard, rows, callback)
+                buffers[shard] = []
+                logger.info('%d users written, %.0f/s' %
+                            (written, written / (time.time() - started)))
+
+        for shard, rows in buffers.items():
+            if rows:
+                written += self._flush(shard, rows, callback)
+        return written
+
+
+def populate_command(args):
+    """Writes synthetic users into the auth database."""
+    parser = OptionParser(usage='%prog [options] sync.conf',
+                          prog='syncreg populate')
+    parser.add_option('-n', '--count', dest='count', type='int',
+                      default=10000, help='number of users')
+    parser.add_option('--start', dest='start', type='int', default=0,
+                      help='index of the first user')
+    parser.add_option('-s', '--section', dest='section', default='auth',
+                      help='section of the auth backend')
+    parser.add_option('-b', '--batch-size', dest='batch_size', type='int',
+                      default=10000, help='rows inserted at once')
+    parser.add_option('--prefix', dest='prefix', default='populate',
+                      help='prefix of the e-mails')
+    parser.add_option('--password', dest='password', default='x' * 9,
+                      help='password of every user')
+    parser.add_option('--reset-every', dest='reset_every', type='int',
+                      default=0, help='one user out of N gets a reset code')
+    parser.add_option('--reset-output', dest='reset_output',
+                      default='reset_codes.txt',
+                      help='file receiving "username code" lines')
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('You need to provide the configuration file')
+
+    config = read_config_section(args[0], options.section)
+    sqluris = split_list(config.get('sqluris') or config.get('sqluri'))
+    if not sqluris:
+        print >> sys.stderr, 'No sqluri in [%s]' % options.section
+        return 1
+
+    template = make_template(sqluris[0], options.password)
+    populator = Populator(sqluris, template, options.batch_size,
+                          options.prefix, replicas=int(config.get('replicas',
+                                                                  100)))
+
+    callback = output = None
+    if options.reset_every:
+        from services.pluginreg import load_and_configure
+        from syncreg.benchroutes import load_config
+        reset = load_and_configure(load_config(args[0]), 'reset_codes')
+        output = open(options.reset_output, 'w')
+        seen = [0]
+
+        def callback(username):
+            seen[0] += 1
+            if seen[0] % options.reset_every == 0:
+                code = reset.generate_reset_code(User(username), True)
+                output.write('%s %s\n' % (username, code))
+
+    start = time.time()
+    try:
+        count = populator.run(options.count, options.start, callback)
+    finally:
+        if output is not None:
+            output.close()
+    print '%d users written in %.1fs' % (count, time.time() - start)
+    return 0
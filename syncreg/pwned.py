@@ -0,0 +1,261 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Check of the passwords against a corpus of breached passwords.
+
+    [pwned]
+    path = /var/lib/syncreg/pwned.sha1
+    bloom = /var/lib/syncreg/pwned.bloom
+
+The corpus is a file of sorted 20-byte SHA-1 digests, without separators.
+It is memory-mapped, so every worker shares the page cache instead of
+holding it, and searched with a binary search: about 30 probes for
+hundreds of millions of hashes.
+
+The optional Bloom filter answers most lookups of passwords that are not
+in the corpus without touching it.
+
+Both files are built from a list of hexadecimal SHA-1 hashes sorted by
+hash, like the "ordered by hash" download of Pwned Passwords, where each
+line may be followed by ":count":
+
+    $ syncreg pwned pwned-passwords-sha1-ordered-by-hash.txt \
+        /var/lib/syncreg/pwned.sha1 --bloom /var/lib/syncreg/pwned.bloom
+"""
+import os
+import sys
+import mmap
+import struct
+from hashlib import sha1
+from binascii import unhexlify
+from optparse import OptionParser
+
+
+DIGEST_SIZE = 20
+BLOOM_MAGIC = 'PWBLOOM2'
+# magic, number of bits, number of hashes
+_BLOOM_HEADER = struct.Struct('>8sQI')
+# the digests are uniformly distributed: two 64-bit slices of them give
+# the hashes of the Bloom filter, h1 + i * h2, which also index filters of
+# more than 2 ** 32 bits
+_SLICES = struct.Struct('>QQ')
+
+
+class CorpusError(Exception):
+    pass
+
+
+def _map(path):
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return None
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def _bloom_bits(digest, bits, hashes):
+    first, second = _SLICES.unpack(digest[:_SLICES.size])
+    return [(first + i * second) % bits for i in xrange(hashes)]
+
+
+class BloomFilter(object):
+    """A memory-mapped Bloom filter of SHA-1 digests."""
+
+    def __init__(self, path):
+        self.data = _map(path)
+        if self.data is None or len(self.data) < _BLOOM_HEADER.size:
+            raise CorpusError('%r is not a Bloom filter' % path)
+        magic, self.bits, self.hashes = \
+            _BLOOM_HEADER.unpack(self.data[:_BLOOM_HEADER.size])
+        if magic != BLOOM_MAGIC or \
+           len(self.data) < _BLOOM_HEADER.size + (self.bits + 7) // 8:
+            raise CorpusError('%r is not a Bloom filter' % path)
+
+    def __contains__(self, digest):
+        data = self.data
+        offset = _BLOOM_HEADER.size
+        for bit in _bloom_bits(digest, self.bits, self.hashes):
+            if not ord(data[offset + bit // 8]) & (1 << (bit % 8)):
+                return False
+        return True
+
+
+class PasswordCorpus(object):
+    """Looks passwords up in a corpus of SHA-1 digests.
+
+    Args:
+        path: location of the sorted digests
+        bloom: location of the Bloom filter, if any
+    """
+    def __init__(self, path, bloom=None):
+        self.data = _map(path)
+        size = self.data is not None and len(self.data) or 0
+        if size % DIGEST_SIZE:
+            raise CorpusError('The size of %r is not a multiple of %d' %
+                              (path, DIGEST_SIZE))
+        self.count = size // DIGEST_SIZE
+        if bloom is None:
+            self.bloom = None
+        else:
+            self.bloom = BloomFilter(bloom)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, digest):
+        if self.bloom is not None and digest not in self.bloom:
+            return False
+        data = self.data
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = middle * DIGEST_SIZE
+            current = data[start:start + DIGEST_SIZE]
+            if current < digest:
+                low = middle + 1
+            elif current > digest:
+                high = middle
+            else:
+                return True
+        return False
+
+    def is_compromised(self, password):
+        """Returns True if the password is in the corpus."""
+        if isinstance(password, unicode):
+            password = password.encode('utf8')
+        return sha1(password).digest() in self
+
+
+def _iter_digests(stream):
+    """Yields the digests of a sorted list of hexadecimal hashes."""
+    previous = ''
+    for line in stream:
+        line = line.split(':', 1)[0].strip()
+        if not line:
+            continue
+        digest = unhexlify(line)
+        if len(digest) != DIGEST_SIZE:
+            raise CorpusError('Not a SHA-1 hash: %r' % line)
+        if digest < previous:
+            raise CorpusError('The hashes are not sorted, at %r' % line)
+        if digest != previous:
+            yield digest
+        previous = digest
+
+
+def build_corpus(stream, path, bloom=None, bits_per_hash=10, hashes=5):
+    """Writes the corpus, and its Bloom filter if bloom is given.
+
+    Args:
+        stream: iterable of lines holding sorted hexadecimal SHA-1 hashes
+        path: location of the corpus
+        bloom: location of the Bloom filter
+        bits_per_hash: size of the filter, per hash. 10 gives about 1% of
+                       false positives with 5 hashes.
+        hashes: number of hashes of the Bloom filter, up to 5
+
+    Returns:
+        the number of hashes written
+    """
+    temp = path + '.tmp'
+    count = 0
+    f = open(temp, 'wb')
+    try:
+        for digest in _iter_digests(stream):
+            f.write(digest)
+            count += 1
+    finally:
+        f.close()
+    os.rename(temp, path)
+
+    if bloom is not None:
+        write_bloom(path, bloom, bits_per_hash, hashes)
+    return count
+
+
+def write_bloom(path, bloom, bits_per_hash=10, hashes=5):
+    """Writes the Bloom filter of a corpus."""
+    corpus = PasswordCorpus(path)
+    bits = max(corpus.count * bits_per_hash, 8)
+    array = bytearray((bits + 7) // 8)
+    data = corpus.data
+    for index in xrange(corpus.count):
+        start = index * DIGEST_SIZE
+        digest = data[start:start + DIGEST_SIZE]
+        for bit in _bloom_bits(digest, bits, hashes):
+            array[bit // 8] |= 1 << (bit % 8)
+
+    temp = bloom + '.tmp'
+    f = open(temp, 'wb')
+    try:
+        f.write(_BLOOM_HEADER.pack(BLOOM_MAGIC, bits, hashes))
+        f.write(array)
+    finally:
+        f.close()
+    os.rename(temp, bloom)
+
+
+def pwned_command(args):
+    """Builds the corpus of breached passwords."""
+    parser = OptionParser(usage='%prog [options] hashes.txt corpus',
+                          prog='syncreg pwned')
+    parser.add_option('-b', '--bloom', dest='bloom', default=None,
+                      help='location of the Bloom filter to write')
+    parser.add_option('--bits-per-hash', dest='bits_per_hash', type='int',
+                      default=10, help='size of the Bloom filter')
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('You need to provide the list of hashes and the '
+                     'location of the corpus')
+
+    if args[0] == '-':
+        stream = sys.stdin
+    else:
+        stream = open(args[0])
+    try:
+        count = build_corpus(stream, args[1], options.bloom,
+                             options.bits_per_hash)
+    except CorpusError, e:
+        print >> sys.stderr, str(e)
+        return 1
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    print '%d hashes written to %s' % (count, args[1])
+    return 0
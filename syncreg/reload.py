@@ -0,0 +1,222 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Configuration reload without a restart.
+
+The configuration file is parsed again and a new user controller is built
+from it, reusing the backends, caches and files of the current one when
+their section did not change. The new controller is then swapped in: the
+requests already dispatched finish on the old one. The event log,
+idempotency store and cache it does not reuse are closed
+"reload.close_delay" seconds later (default: 60), once these requests
+are done; a late straggler still gets served, on a new connection.
+
+A reload is triggered by a HUP signal when "reload.signal" is set, by
+the pre-fork server when started with "hot_reload", or by a POST on
+/__reload__ with the shared secret.
+
+Only the user controller and the options read at request time are
+reloaded; the sections in RESTART_SECTIONS still need a restart.
+"""
+import signal
+import threading
+import time
+import traceback
+from ConfigParser import ConfigParser
+
+from services.util import convert_config
+
+from syncreg import logger
+from syncreg.util import changed_sections, backend_engines
+
+
+# read once, when the application starts
+RESTART_SECTIONS = ('admission', 'auth', 'deadline', 'health', 'memory',
+                    'pool', 'reload', 'throttle', 'warmup')
+
+
+class ReloadError(Exception):
+    pass
+
+
+def read_config(path):
+    """Reads a configuration file like sync.conf.
+
+    Returns:
+        a flat mapping of the converted 'section.option' values
+    """
+    parser = ConfigParser()
+    if not parser.read([path]):
+        raise IOError('Could not read %r' % path)
+    config = {}
+    for section in parser.sections():
+        for key, value in parser.items(section):
+            config['%s.%s' % (section, key)] = value
+    return convert_config(config)
+
+
+def _config_file(config):
+    path = config.get('reload.config_file')
+    if path is not None:
+        return path
+    configuration = config.get('configuration')
+    if not isinstance(configuration, basestring):
+        return None
+    if configuration.startswith('file:'):
+        return configuration[len('file:'):]
+    return None
+
+
+def _close_all(resources):
+    for resource in resources:
+        try:
+            resource.close()
+        except Exception:
+            logger.error('Could not close %r' % resource)
+            logger.error(traceback.format_exc())
+
+
+class ConfigReloader(object):
+    """Reloads the configuration of an application.
+
+    Args:
+        app: the application
+        path: the configuration file, defaults to "reload.config_file" or
+              to the file the application was loaded from
+    """
+    def __init__(self, app, path=None):
+        self.app = app
+        if path is None:
+            path = _config_file(app.config)
+        self.path = path
+        # called with the new user controller, before it is swapped in
+        self.callbacks = []
+        self.reloads = 0
+        self.last_reload = None
+        # seconds given to the requests running on a replaced controller
+        self.close_delay = app.config.get('reload.close_delay', 60)
+        self._lock = threading.Lock()
+
+    def read(self):
+        """Returns the new configuration of the application.
+
+        The options without a section, which don't come from the
+        configuration file, are kept.
+        """
+        if self.path is None:
+            raise ReloadError('No configuration file to reload')
+        config = dict([(key, value) for key, value in self.app.config.items()
+                       if '.' not in key])
+        config.update(read_config(self.path))
+        return config
+
+    def reload(self):
+        """Reloads the configuration file.
+
+        Returns:
+            the list of the sections that changed
+        """
+        self._lock.acquire()
+        try:
+            config = self.read()
+            changed = changed_sections(self.app.config, config)
+            if not changed:
+                return changed
+
+            old = self.app.controllers['user']
+            new = old.__class__(self.app, config, previous=old)
+            for callback in self.callbacks:
+                callback(new)
+
+            self.app.controllers['user'] = new
+            self.app.config = config
+            if old.reset is not None and new.reset is not old.reset:
+                # connections in use go back to the old pool, and are
+                # closed with it
+                for __, engine in backend_engines('reset_codes', old.reset):
+                    engine.dispose()
+            # the writer thread, files and connections of the replaced
+            # event log, idempotency store and cache, once the requests
+            # running on the old controller are done with them
+            closing = []
+            for name in ('events', 'idempotency', 'cache'):
+                resource = getattr(old, name, None)
+                if resource is None or resource is getattr(new, name, None):
+                    continue
+                if getattr(resource, 'close', None) is not None:
+                    closing.append(resource)
+            if closing:
+                timer = threading.Timer(self.close_delay, _close_all,
+                                        [closing])
+                timer.setDaemon(True)
+                timer.start()
+            self.app.pools.instrument()
+
+            self.reloads += 1
+            self.last_reload = time.time()
+            logger.info('Configuration reloaded, changed sections: %s' %
+                        ', '.join(changed))
+            restart = [section for section in changed
+                       if section in RESTART_SECTIONS]
+            if restart:
+                logger.warning('Changes to %s need a restart' %
+                               ', '.join(restart))
+            return changed
+        finally:
+            self._lock.release()
+
+    def run(self):
+        """Reloads, logging the failures."""
+        try:
+            self.reload()
+        except Exception:
+            logger.error('Reload failed, keeping the current configuration')
+            logger.error(traceback.format_exc())
+
+    def start(self):
+        """Reloads in a background thread."""
+        thread = threading.Thread(target=self.run)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def _signal(self, signum, frame):
+        self.start()
+
+    def install(self, signum=signal.SIGHUP):
+        """Reloads when signum is received. Must be called from the main
+        thread."""
+        signal.signal(signum, self._signal)
@@ -0,0 +1,128 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Calls to the SMTP server and to the reCAPTCHA verify server.
+
+services.emailer and recaptcha.client open their connections without a
+timeout, so a server that hangs holds the worker. These versions take the
+timeout of each call, see syncreg.deadline.timeout.
+"""
+import socket
+import smtplib
+import urllib
+import urllib2
+from email.mime.text import MIMEText
+from email.header import Header
+
+from recaptcha.client import captcha
+
+
+def send_email(sender, rcpt, subject, body, smtp_host='localhost',
+               smtp_port=25, smtp_user=None, smtp_password=None,
+               timeout=None):
+    """Sends a mail, like services.emailer.send_email.
+
+    Returns:
+        (True, None), or (False, the error)
+    """
+    message = MIMEText(body.encode('utf8'), 'plain', 'utf8')
+    message['From'] = sender
+    message['To'] = rcpt
+    message['Subject'] = Header(subject, 'utf8')
+    try:
+        if timeout is None:
+            server = smtplib.SMTP(smtp_host, smtp_port)
+        else:
+            server = smtplib.SMTP(smtp_host, smtp_port, timeout=timeout)
+    except (smtplib.SMTPException, socket.error), e:
+        return False, str(e)
+    try:
+        try:
+            if smtp_user is not None and smtp_password is not None:
+                server.login(smtp_user, smtp_password)
+            server.sendmail(sender, [rcpt], message.as_string())
+        except (smtplib.SMTPException, socket.error), e:
+            return False, str(e)
+    finally:
+        try:
+            server.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+    return True, None
+
+
+def submit_captcha(challenge, response, private_key, remoteip,
+                   timeout=None, verify_server=None):
+    """Checks a captcha solution, like recaptcha.client.captcha.submit.
+
+    Args:
+        verify_server: host:port of the verification API, defaults to
+                       recaptcha's
+
+    Raises IOError when the verify server can't be reached in time.
+    """
+    if not challenge or not response:
+        return captcha.RecaptchaResponse(is_valid=False,
+                                         error_code='incorrect-captcha-sol')
+
+    def _encode(value):
+        if isinstance(value, unicode):
+            return value.encode('utf8')
+        return value
+
+    params = urllib.urlencode({'privatekey': _encode(private_key),
+                               'remoteip': _encode(remoteip),
+                               'challenge': _encode(challenge),
+                               'response': _encode(response)})
+    if verify_server is None:
+        verify_server = captcha.VERIFY_SERVER
+    request = urllib2.Request(
+        'http://%s/recaptcha/api/verify' % verify_server, params,
+        {'Content-type': 'application/x-www-form-urlencoded',
+         'User-agent': 'reCAPTCHA Python'})
+    if timeout is None:
+        answer = urllib2.urlopen(request)
+    else:
+        answer = urllib2.urlopen(request, timeout=timeout)
+    try:
+        lines = answer.read().splitlines()
+    finally:
+        answer.close()
+    if lines and lines[0] == 'true':
+        return captcha.RecaptchaResponse(is_valid=True)
+    return captcha.RecaptchaResponse(is_valid=False,
+                                     error_code=lines[1:] and lines[1] or
+                                     None)
@@ -0,0 +1,328 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Replay of recorded nginx access logs against a running server.
+
+    $ syncreg replay access.log http://localhost:5000 -c 50 --speedup 10
+
+The requests of the log (in the default "combined" format) are sent at
+the pace they were recorded, accelerated by --speedup. The arrivals don't
+wait for the responses, so a slow server sees its queue grow as it would
+in production, and the latency of a request is counted from its planned
+start. --rate replaces the recorded pace with random arrivals at a fixed
+mean rate. --closed sends the requests as fast as --concurrency clients
+can, each waiting for its previous response.
+
+Only the GET requests are replayed by default, as the logs don't have
+the bodies of the others. When the logs are anonymised, --users gives a
+file of existing usernames: every username of the log is then replaced by
+one of them, always the same.
+
+The results are reported per route, with the error rate and the latency
+percentiles. syncreg.stubs provides local SMTP and captcha servers, so
+that the password resets of the log can be replayed offline.
+"""
+import re
+import sys
+import time
+import random
+import httplib
+import urlparse
+import threading
+from Queue import Queue
+from hashlib import md5
+from optparse import OptionParser
+
+from syncreg.bench import summarize, print_summary
+from syncreg.util import split_list
+
+_LINE = re.compile(r'\[(?P<time>[^\]]+)\] "(?P<method>[A-Z]+) '
+                   r'(?P<path>\S+)[^"]*"')
+_PLACEHOLDER = re.compile(r'\{(\w+)(?::([^}]+))?\}')
+_USERNAME = re.compile(r'^(/user/[^/]+/)([^/?]+)')
+_STOP = object()
+
+
+def parse_time(value):
+    """Returns the timestamp of an nginx $time_local, ignoring the zone."""
+    return time.mktime(time.strptime(value.split()[0],
+                                     '%d/%b/%Y:%H:%M:%S'))
+
+
+def parse_log(lines, methods=('GET',)):
+    """Yields (timestamp, method, path) for the requests of a log."""
+    for line in lines:
+        match = _LINE.search(line)
+        if match is None:
+            continue
+        method = match.group('method')
+        if method not in methods:
+            continue
+        try:
+            when = parse_time(match.group('time'))
+        except ValueError:
+            continue
+        yield when, method, match.group('path')
+
+
+class RouteMatcher(object):
+    """Names the route of a request, from the application urls."""
+
+    def __init__(self, urls):
+        self.routes = []
+        for url in urls:
+            methods, pattern, action = url[0], url[1], url[3]
+            if isinstance(methods, basestring):
+                methods = (methods,)
+            regex = '^%s$' % _PLACEHOLDER.sub(self._group,
+                                              pattern.replace('.', r'\.'))
+            self.routes.append((methods, re.compile(regex), action))
+
+    def _group(self, match):
+        return '(?:%s)' % (match.group(2) or '[^/]+')
+
+    def match(self, method, path):
+        path = path.split('?', 1)[0]
+        for methods, regex, action in self.routes:
+            if method in methods and regex.match(path):
+                return '%s %s' % (method, action)
+        return 'other'
+
+
+class UserMapper(object):
+    """Replaces the usernames of the paths by existing ones."""
+
+    def __init__(self, usernames):
+        self.usernames = usernames
+
+    def __call__(self, path):
+        match = _USERNAME.match(path)
+        if match is None:
+            return path
+        username = match.group(2)
+        index = int(md5(username).hexdigest()[:8], 16) % len(self.usernames)
+        return '%s%s%s' % (match.group(1), self.usernames[index],
+                           path[match.end():])
+
+
+def schedule(requests, speedup=1., rate=None):
+    """Yields (delay, method, path), delay being the seconds from the
+    start of the replay at which the request is sent.
+
+    Args:
+        requests: (timestamp, method, path) as given by parse_log
+        speedup: the recorded pace is multiplied by it
+        rate: if given, mean number of requests per second, with random
+              arrivals
+    """
+    start = None
+    delay = 0.
+    for when, method, path in requests:
+        if rate:
+            delay += random.expovariate(rate)
+        else:
+            if start is None:
+                start = when
+            delay = (when - start) / speedup
+        yield delay, method, path
+
+
+class Replayer(object):
+    """Sends the requests to a server and measures them per route.
+
+    Args:
+        url: root url of the server
+        matcher: a RouteMatcher
+        concurrency: number of clients
+        timeout: socket timeout, in seconds
+        rewrite: optional function applied to every path
+    """
+    def __init__(self, url, matcher, concurrency=10, timeout=30.,
+                 rewrite=None):
+        parsed = urlparse.urlparse(url)
+        self.netloc = parsed.netloc
+        self.prefix = parsed.path.rstrip('/')
+        if parsed.scheme == 'https':
+            self.conn_class = httplib.HTTPSConnection
+        else:
+            self.conn_class = httplib.HTTPConnection
+        self.matcher = matcher
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.rewrite = rewrite
+        self._lock = threading.Lock()
+        self.durations = {}
+        self.errors = {}
+
+    def _record(self, route, spent, ok):
+        self._lock.acquire()
+        try:
+            if ok:
+                self.durations.setdefault(route, []).append(spent)
+                self.errors.setdefault(route, 0)
+            else:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        finally:
+            self._lock.release()
+
+    def _worker(self, queue, started):
+        conn = None
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                break
+            delay, method, path = item
+            if delay is None:
+                # closed loop: the request starts when a client is free
+                planned = time.time()
+            else:
+                planned = started + delay
+            route = self.matcher.match(method, path)
+            if self.rewrite is not None:
+                path = self.rewrite(path)
+            try:
+                if conn is None:
+                    conn = self.conn_class(self.netloc,
+                                           timeout=self.timeout)
+                conn.request(method, self.prefix + path)
+                resp = conn.getresponse()
+                resp.read()
+                ok = resp.status < 500
+            except Exception:
+                ok = False
+                if conn is not None:
+                    conn.close()
+                conn = None
+            # the time spent in the queue counts
+            self._record(route, time.time() - planned, ok)
+        if conn is not None:
+            conn.close()
+
+    def run(self, scheduled, closed=False):
+        """Replays scheduled requests, as given by schedule().
+
+        Args:
+            scheduled: (delay, method, path) as given by schedule()
+            closed: if True, the requests are sent as soon as a client
+                    is free
+
+        Returns:
+            a mapping of the routes to their summaries
+        """
+        self.durations = {}
+        self.errors = {}
+        if closed:
+            # the log is not read faster than it is replayed
+            queue = Queue(self.concurrency * 2)
+        else:
+            queue = Queue()
+        started = time.time()
+        threads = [threading.Thread(target=self._worker,
+                                    args=(queue, started))
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+
+        for delay, method, path in scheduled:
+            if closed:
+                delay = None
+            else:
+                wait = started + delay - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            queue.put((delay, method, path))
+
+        for thread in threads:
+            queue.put(_STOP)
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.time() - started
+        return dict([(route, summarize(self.durations.get(route, []),
+                                       self.errors[route], elapsed))
+                     for route in self.errors])
+
+
+def replay_command(args):
+    """Replays an access log against a server."""
+    parser = OptionParser(usage='%prog [options] access.log url',
+                          prog='syncreg replay')
+    parser.add_option('-c', '--concurrency', dest='concurrency', type='int',
+                      default=10, help='concurrent clients')
+    parser.add_option('-s', '--speedup', dest='speedup', type='float',
+                      default=1., help='acceleration of the recorded pace')
+    parser.add_option('-r', '--rate', dest='rate', type='float',
+                      default=None, help='random arrivals at this mean rate '
+                      'per second, instead of the recorded pace')
+    parser.add_option('--closed', dest='closed', action='store_true',
+                      default=False, help='each client waits for its '
+                      'response before sending the next request')
+    parser.add_option('-m', '--methods', dest='methods', default='GET',
+                      help='methods replayed, comma separated')
+    parser.add_option('-u', '--users', dest='users', default=None,
+                      help='file of usernames replacing the ones of the log')
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('You need to provide the log and the url')
+
+    from syncreg.wsgiapp import urls
+
+    rewrite = None
+    if options.users is not None:
+        f = open(options.users)
+        try:
+            usernames = split_list(f.read())
+        finally:
+            f.close()
+        rewrite = UserMapper(usernames)
+
+    if args[0] == '-':
+        lines = sys.stdin
+    else:
+        lines = open(args[0])
+    try:
+        requests = parse_log(lines, split_list(options.methods))
+        scheduled = schedule(requests, options.speedup, options.rate)
+        replayer = Replayer(args[1], RouteMatcher(urls),
+                            options.concurrency, rewrite=rewrite)
+        results = replayer.run(scheduled, options.closed)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+    for route in sorted(results):
+        print_summary(route, results[route])
+    return 0
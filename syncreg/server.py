@@ -0,0 +1,576 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Pre-fork WSGI server.
+
+The master process loads the application once, compiles the templates and
+builds its caches, then forks the workers. Everything built before the fork
+is shared by the workers through copy-on-write.
+
+Signals handled by the master:
+
+- HUP: graceful reload. The application is loaded again, new workers are
+  forked and the old ones finish their current request before exiting.
+  With hot_reload, the configuration is reloaded in place instead, in the
+  master and in every worker, keeping their pools and caches (see
+  syncreg.reload).
+- TERM: graceful shutdown.
+- INT, QUIT: immediate shutdown.
+- TTIN, TTOU: adds or removes a worker.
+"""
+import errno
+import gc
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+from ConfigParser import ConfigParser, NoSectionError
+from logging.config import fileConfig
+from optparse import OptionParser
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from syncreg import logger
+from syncreg.util import preload_templates, dispose_engines, unwrap_app
+
+
+DEFAULT_BIND = 'unix:/tmp/gunicorn-syncreg.sock'
+
+
+def parse_bind(bind):
+    """Parses a bind string
+
+    Args:
+        bind: 'unix:/path/to/socket' or 'host:port'
+
+    Returns:
+        (family, address) tuple
+    """
+    if bind.startswith('unix:'):
+        return socket.AF_UNIX, bind[len('unix:'):]
+    host, port = bind.rsplit(':', 1)
+    return socket.AF_INET, (host or '0.0.0.0', int(port))
+
+
+def create_socket(bind, backlog=1024):
+    """Creates the listening socket shared by all workers."""
+    family, address = parse_bind(bind)
+    if family == socket.AF_UNIX and os.path.exists(address):
+        os.remove(address)
+
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family != socket.AF_UNIX:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    if family == socket.AF_UNIX:
+        os.chmod(address, 0777)
+    sock.listen(backlog)
+    # workers compete on accept(), the losers must not block
+    sock.setblocking(0)
+    return sock
+
+
+class _RequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class _WorkerServer(WSGIServer):
+    """WSGI server working on an already bound socket."""
+
+    def __init__(self, sock, app, worker):
+        self.address_family = sock.family
+        WSGIServer.__init__(self, ('', 0), _RequestHandler,
+                            bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        address = sock.getsockname()
+        if isinstance(address, tuple):
+            self.server_name = socket.getfqdn(address[0])
+            self.server_port = address[1]
+        else:
+            self.server_name = 'localhost'
+            self.server_port = 80
+        self.setup_environ()
+        self.set_app(app)
+        self.worker = worker
+
+    def get_request(self):
+        conn, address = self.socket.accept()
+        # some platforms make the accepted socket inherit O_NONBLOCK
+        conn.setblocking(1)
+        # unix sockets don't give any peer address
+        if not isinstance(address, tuple):
+            address = ('', 0)
+        return conn, address
+
+    def process_request(self, request, client_address):
+        WSGIServer.process_request(self, request, client_address)
+        self.worker.handled += 1
+
+
+class Worker(object):
+    """A forked process serving requests until it is told to stop."""
+
+    def __init__(self, sock, app, max_requests=0):
+        self.sock = sock
+        self.app = app
+        self.max_requests = max_requests
+        self.handled = 0
+        self.alive = True
+        self.reload_pending = False
+        self.ppid = os.getppid()
+
+    def _stop(self, signum, frame):
+        self.alive = False
+
+    def _hup(self, signum, frame):
+        self.reload_pending = True
+
+    def reload(self):
+        """Reloads the configuration, between two requests."""
+        self.reload_pending = False
+        reloader = getattr(unwrap_app(self.app), 'reloader', None)
+        if reloader is None:
+            return
+        try:
+            reloader.reload()
+        except Exception:
+            logger.error('Reload failed in worker %d' % os.getpid())
+            logger.error(traceback.format_exc())
+
+    def _quit(self, signum, frame):
+        sys.exit(0)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        # a graceful stop must not break the request being served
+        signal.siginterrupt(signal.SIGTERM, False)
+        signal.signal(signal.SIGQUIT, self._quit)
+        signal.signal(signal.SIGINT, self._quit)
+        signal.signal(signal.SIGHUP, self._hup)
+        signal.siginterrupt(signal.SIGHUP, False)
+        for signum in (signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+
+        server = _WorkerServer(self.sock, self.app, self)
+        while self.alive:
+            if self.max_requests and self.handled >= self.max_requests:
+                logger.info('Worker %d recycled after %d requests' %
+                            (os.getpid(), self.handled))
+                break
+
+            if os.getppid() != self.ppid:
+                logger.info('Master is gone, worker %d leaving' %
+                            os.getpid())
+                break
+
+            if self.reload_pending:
+                self.reload()
+
+            try:
+                ready = select.select([self.sock], [], [], 1.)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if ready:
+                server._handle_request_noblock()
+
+
+class Arbiter(object):
+    """Master process: forks, watches and recycles the workers.
+
+    Args:
+        loader: callable returning the WSGI application
+        bind: where to listen, see parse_bind
+        workers: number of worker processes
+        max_requests: a worker is replaced after serving that many requests,
+                      0 disables recycling
+        max_requests_jitter: random amount added to max_requests for each
+                             worker, so they don't all restart together
+        graceful_timeout: seconds given to the workers to finish their
+                          current request when stopping or reloading
+        worker_class: 'sync' serves one request at a time per worker,
+                      'green' serves them concurrently in greenlets (see
+                      syncreg.green)
+        worker_connections: concurrent requests of a green worker
+        executor_size: concurrent backend calls of a green worker
+        hot_reload: on HUP, reloads the configuration in the running
+                    workers instead of replacing them
+    """
+    def __init__(self, loader, bind=DEFAULT_BIND, workers=4, max_requests=0,
+                 max_requests_jitter=0, graceful_timeout=30, backlog=1024,
+                 worker_class='sync', worker_connections=1000,
+                 executor_size=10, hot_reload=False):
+        if worker_class not in ('sync', 'green'):
+            raise ValueError('Unknown worker class %r' % worker_class)
+        self.loader = loader
+        self.bind = bind
+        self.num_workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.worker_class = worker_class
+        self.worker_connections = worker_connections
+        self.executor_size = executor_size
+        self.hot_reload = hot_reload
+        self.workers = {}
+        self.app = None
+        self.sock = None
+        self._signals = []
+
+    def load(self):
+        """Loads and warms up the application in the master."""
+        app = self.loader()
+        templates = preload_templates()
+        logger.info('Compiled %d templates' % len(templates))
+        # the warm-up must not be running anymore when forking: a thread
+        # stuck in a connect may hold pool locks the workers would inherit
+        warmup = getattr(unwrap_app(app), 'warmup', None)
+        if warmup is not None:
+            warmup.wait(self.graceful_timeout)
+            if not warmup.join(self.graceful_timeout):
+                raise RuntimeError('The warm-up is still running, '
+                                   'not forking')
+        # whatever the master opened must not be shared with the workers
+        dispose_engines(app)
+        # collecting now avoids the workers touching (and copying) the
+        # pages of objects that would be freed right after the fork
+        gc.collect()
+        return app
+
+    def _signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def run(self):
+        """Runs the master loop until told to stop."""
+        self.app = self.load()
+        self.sock = create_socket(self.bind, self.backlog)
+        logger.info('Listening on %s (pid %d)' % (self.bind, os.getpid()))
+
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                       signal.SIGQUIT, signal.SIGTTIN, signal.SIGTTOU,
+                       signal.SIGCHLD):
+            signal.signal(signum, self._signal)
+
+        try:
+            self.manage_workers()
+            while True:
+                while self._signals:
+                    signum = self._signals.pop(0)
+                    if signum == signal.SIGHUP and self.hot_reload:
+                        self.reload_in_place()
+                    elif signum == signal.SIGHUP:
+                        self.reload()
+                    elif signum == signal.SIGTERM:
+                        self.stop(graceful=True)
+                        return
+                    elif signum in (signal.SIGINT, signal.SIGQUIT):
+                        self.stop(graceful=False)
+                        return
+                    elif signum == signal.SIGTTIN:
+                        self.num_workers += 1
+                    elif signum == signal.SIGTTOU:
+                        self.num_workers = max(self.num_workers - 1, 1)
+                self.reap_workers()
+                self.manage_workers()
+                # any signal interrupts the sleep
+                time.sleep(1.)
+        finally:
+            self._close_socket()
+
+    def _close_socket(self):
+        if self.sock is None:
+            return
+        family, address = parse_bind(self.bind)
+        self.sock.close()
+        self.sock = None
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+
+    def reload(self):
+        """Reloads the application and replaces all the workers."""
+        logger.info('Reloading')
+        try:
+            app = self.load()
+        except Exception:
+            logger.error('Reload failed, keeping the current workers')
+            logger.error(traceback.format_exc())
+            return
+
+        self.app = app
+        old_workers = self.workers.keys()
+        for i in range(self.num_workers):
+            self.spawn_worker()
+        for pid in old_workers:
+            self.kill_worker(pid, signal.SIGTERM)
+
+    def reload_in_place(self):
+        """Reloads the configuration of the master and of the workers.
+
+        The workers forked later start with the new configuration.
+        """
+        reloader = getattr(unwrap_app(self.app), 'reloader', None)
+        if reloader is None:
+            logger.warning('The application can not reload its '
+                           'configuration, replacing the workers')
+            self.reload()
+            return
+
+        logger.info('Reloading the configuration')
+        try:
+            reloader.reload()
+        except Exception:
+            logger.error('Reload failed, keeping the current configuration')
+            logger.error(traceback.format_exc())
+            return
+        # whatever the reload opened must not be shared with the workers
+        dispose_engines(self.app)
+        for pid in self.workers.keys():
+            self.kill_worker(pid, signal.SIGHUP)
+
+    def stop(self, graceful=True):
+        """Stops all the workers."""
+        signum = graceful and signal.SIGTERM or signal.SIGQUIT
+        for pid in self.workers.keys():
+            self.kill_worker(pid, signum)
+
+        limit = time.time() + self.graceful_timeout
+        while self.workers and time.time() < limit:
+            self.reap_workers()
+            time.sleep(.1)
+
+        for pid in self.workers.keys():
+            self.kill_worker(pid, signal.SIGKILL)
+        self.reap_workers()
+
+    def kill_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                self.workers.pop(pid, None)
+            else:
+                raise
+
+    def reap_workers(self):
+        """Forgets about the workers that exited."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            self.workers.pop(pid, None)
+
+    def manage_workers(self):
+        """Keeps the number of workers at the configured value."""
+        while len(self.workers) < self.num_workers:
+            self.spawn_worker()
+
+        # oldest workers go first when the pool shrinks
+        extra = len(self.workers) - self.num_workers
+        if extra > 0:
+            by_age = sorted(self.workers.items(), key=lambda item: item[1])
+            for pid, __ in by_age[:extra]:
+                self.kill_worker(pid, signal.SIGTERM)
+                # the worker is on its way out, don't count it anymore
+                self.workers.pop(pid, None)
+
+    def spawn_worker(self):
+        max_requests = self.max_requests
+        if max_requests and self.max_requests_jitter:
+            max_requests += random.randint(0, self.max_requests_jitter)
+
+        pid = os.fork()
+        if pid != 0:
+            self.workers[pid] = time.time()
+            return pid
+
+        # in the worker
+        status = 0
+        try:
+            random.seed()
+            after_fork = getattr(unwrap_app(self.app), 'after_fork', None)
+            if after_fork is not None:
+                after_fork()
+            if self.worker_class == 'green':
+                from syncreg.green import GreenWorker
+                worker = GreenWorker(self.sock, self.app, max_requests,
+                                     self.worker_connections,
+                                     self.executor_size,
+                                     self.graceful_timeout)
+            else:
+                worker = Worker(self.sock, self.app, max_requests)
+            worker.run()
+        except SystemExit:
+            pass
+        except Exception:
+            logger.error(traceback.format_exc())
+            status = 1
+        os._exit(status)
+
+
+def _int(value, default):
+    if value is None:
+        return default
+    return int(value)
+
+
+def _bool(value):
+    if isinstance(value, basestring):
+        return value.lower() in ('true', 'yes', 'on', '1')
+    return bool(value)
+
+
+def run_prefork(wsgi_app, global_conf, bind=DEFAULT_BIND, workers=4,
+                max_requests=0, max_requests_jitter=0, graceful_timeout=30,
+                backlog=1024, host=None, port=None, worker_class='sync',
+                worker_connections=1000, executor_size=10, hot_reload=False,
+                **kw):
+    """Paste server runner, for "use = egg:SyncReg#prefork"
+
+    A reload forks new workers from the already loaded application. Green
+    workers are better started with "syncreg serve", which patches the
+    standard library before loading the application.
+    """
+    if host is not None and port is not None and bind == DEFAULT_BIND:
+        bind = '%s:%s' % (host, port)
+
+    if worker_class == 'green':
+        from syncreg.green import patch
+        patch()
+
+    arbiter = Arbiter(lambda: wsgi_app, bind, _int(workers, 4),
+                      _int(max_requests, 0), _int(max_requests_jitter, 0),
+                      _int(graceful_timeout, 30), _int(backlog, 1024),
+                      worker_class, _int(worker_connections, 1000),
+                      _int(executor_size, 10), _bool(hot_reload))
+    arbiter.run()
+
+
+def _read_server_section(ini_file, name='server:main'):
+    """Returns the options of the server section of an ini file."""
+    here = os.path.dirname(ini_file)
+    parser = ConfigParser({'here': here, '__file__': ini_file})
+    parser.read([ini_file])
+    if not parser.has_section(name):
+        return {}
+    return dict(parser.items(name))
+
+
+def serve_command(args):
+    """Runs the pre-fork server on a Paste Deploy ini file."""
+    parser = OptionParser(usage='%prog [options] config.ini',
+                          prog='syncreg serve')
+    parser.add_option('-b', '--bind', dest='bind',
+                      help='unix:/path or host:port to listen on')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+                      help='number of worker processes')
+    parser.add_option('--max-requests', dest='max_requests', type='int',
+                      help='requests served by a worker before it is '
+                           'replaced, 0 to disable')
+    parser.add_option('--max-requests-jitter', dest='max_requests_jitter',
+                      type='int', help='random amount added to '
+                                       'max-requests for each worker')
+    parser.add_option('--graceful-timeout', dest='graceful_timeout',
+                      type='int', help='seconds given to the workers to '
+                                       'finish on stop or reload')
+    parser.add_option('-k', '--worker-class', dest='worker_class',
+                      type='choice', choices=['sync', 'green'],
+                      help='sync or green (needs gevent)')
+    parser.add_option('--worker-connections', dest='worker_connections',
+                      type='int', help='concurrent requests of a green '
+                                       'worker')
+    parser.add_option('--executor-size', dest='executor_size', type='int',
+                      help='concurrent backend calls of a green worker')
+    parser.add_option('--hot-reload', dest='hot_reload', action='store_true',
+                      help='reload the configuration in place on HUP, '
+                           'instead of replacing the workers')
+
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('You need to provide the ini file')
+
+    ini_file = os.path.abspath(args[0])
+    try:
+        fileConfig(ini_file)
+    except NoSectionError:
+        pass
+
+    # the [server:main] section provides the defaults
+    settings = _read_server_section(ini_file)
+    if 'bind' not in settings and 'port' in settings:
+        settings['bind'] = '%s:%s' % (settings.get('host', ''),
+                                      settings['port'])
+    for option in ('bind', 'workers', 'max_requests', 'max_requests_jitter',
+                   'graceful_timeout', 'worker_class', 'worker_connections',
+                   'executor_size', 'hot_reload'):
+        value = getattr(options, option)
+        if value is not None:
+            settings[option] = value
+
+    worker_class = settings.get('worker_class', 'sync')
+    if worker_class == 'green':
+        # before anything opens a socket
+        from syncreg.green import patch
+        patch()
+
+    def _loader():
+        from paste.deploy import loadapp
+        return loadapp('config:%s' % ini_file)
+
+    arbiter = Arbiter(_loader, settings.get('bind', DEFAULT_BIND),
+                      _int(settings.get('workers'), 4),
+                      _int(settings.get('max_requests'), 0),
+                      _int(settings.get('max_requests_jitter'), 0),
+                      _int(settings.get('graceful_timeout'), 30),
+                      _int(settings.get('backlog'), 1024), worker_class,
+                      _int(settings.get('worker_connections'), 1000),
+                      _int(settings.get('executor_size'), 10),
+                      _bool(settings.get('hot_reload', False)))
+    arbiter.run()
+    return 0
@@ -0,0 +1,346 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Local stand-ins for the SMTP server, the reCAPTCHA verification API and
+memcached, so the application can be loaded without reaching the outside
+world.
+
+    $ syncreg stubs --smtp-port 2525 --captcha-port 8025 \
+                    --memcache unix:/tmp/memcache.sock
+
+The application is then pointed at them:
+
+    [smtp]
+    host = localhost
+    port = 2525
+
+    [captcha]
+    use = true
+    verify_server = localhost:8025
+
+    [cache]
+    backend = syncreg.cache.MemcacheClient
+    servers = unix:/tmp/memcache.sock
+
+The SMTP stub accepts and drops every message. The captcha stub accepts
+every answer, except "invalid". The memcached stub implements the
+commands used by syncreg.cache, keeping the values in memory.
+"""
+import os
+import sys
+import time
+import smtpd
+import socket
+import asyncore
+import threading
+from urlparse import parse_qs
+from optparse import OptionParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import (ThreadingMixIn, TCPServer, UnixStreamServer,
+                          StreamRequestHandler)
+
+from syncreg.server import parse_bind
+
+
+class SMTPStub(smtpd.SMTPServer):
+    """SMTP server counting and dropping the messages."""
+
+    def __init__(self, host='localhost', port=2525):
+        smtpd.SMTPServer.__init__(self, (host, port), None)
+        self.port = self.socket.getsockname()[1]
+        self.received = 0
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received += 1
+
+    def start(self):
+        thread = threading.Thread(target=asyncore.loop,
+                                  kwargs={'timeout': 1, 'use_poll': True})
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.close()
+
+
+class _CaptchaHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        size = int(self.headers.get('Content-Length', 0))
+        params = parse_qs(self.rfile.read(size))
+        self.server.received += 1
+        if params.get('response') == ['invalid']:
+            body = 'false\nincorrect-captcha-sol'
+        else:
+            body = 'true\nsuccess'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CaptchaStub(ThreadingMixIn, HTTPServer):
+    """Answers the reCAPTCHA verify calls."""
+    daemon_threads = True
+
+    def __init__(self, host='localhost', port=8025):
+        HTTPServer.__init__(self, (host, port), _CaptchaHandler)
+        self.port = self.server_address[1]
+        self.received = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _MemcacheHandler(StreamRequestHandler):
+
+    def _reply(self, noreply, line):
+        if not noreply:
+            self.wfile.write(line + '\r\n')
+
+    def handle(self):
+        stub = self.server.stub
+        stub.connections.add(self.connection)
+        try:
+            try:
+                self._handle(stub)
+            except socket.error:
+                pass
+        finally:
+            stub.connections.discard(self.connection)
+
+    def _handle(self, stub):
+        while True:
+            line = self.rfile.readline()
+            if not line.endswith('\r\n'):
+                return
+            parts = line.split()
+            if not parts:
+                continue
+            command = parts[0]
+            stub.count(command)
+            noreply = parts[-1] == 'noreply'
+            if command == 'get':
+                items = []
+                for key in parts[1:]:
+                    item = stub.get(key)
+                    if item is not None:
+                        items.append('VALUE %s %d %d\r\n%s\r\n' %
+                                     (key, item[0], len(item[1]), item[1]))
+                items.append('END\r\n')
+                self.wfile.write(''.join(items))
+            elif command in ('set', 'add'):
+                key, flags, ttl, size = parts[1:5]
+                data = self.rfile.read(int(size) + 2)[:-2]
+                if stub.store(command == 'add', key, int(flags), int(ttl),
+                              data):
+                    self._reply(noreply, 'STORED')
+                else:
+                    self._reply(noreply, 'NOT_STORED')
+            elif command == 'delete':
+                if stub.delete(parts[1]):
+                    self._reply(noreply, 'DELETED')
+                else:
+                    self._reply(noreply, 'NOT_FOUND')
+            elif command == 'incr':
+                value = stub.incr(parts[1], int(parts[2]))
+                if value is None:
+                    self._reply(noreply, 'NOT_FOUND')
+                else:
+                    self._reply(noreply, str(value))
+            elif command == 'flush_all':
+                stub.flush()
+                self._reply(noreply, 'OK')
+            elif command == 'version':
+                self._reply(False, 'VERSION syncreg-stub')
+            elif command == 'quit':
+                return
+            else:
+                self._reply(False, 'ERROR')
+
+
+class _TCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class MemcacheStub(object):
+    """memcached stand-in, on a TCP port or a unix socket.
+
+    Args:
+        bind: 'host:port' or 'unix:/path', see syncreg.server.parse_bind
+    """
+    def __init__(self, bind='localhost:11311'):
+        family, address = parse_bind(bind)
+        self.path = None
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = _UnixServer(address, _MemcacheHandler)
+            self.bind = bind
+            self.path = address
+        else:
+            self.server = _TCPServer(address, _MemcacheHandler)
+            self.bind = '%s:%d' % self.server.server_address[:2]
+        self.server.stub = self
+        self.connections = set()
+        self.commands = {}
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def count(self, command):
+        self._lock.acquire()
+        try:
+            self.commands[command] = self.commands.get(command, 0) + 1
+        finally:
+            self._lock.release()
+
+    def _live(self, key):
+        item = self._data.get(key)
+        if item is not None and item[2] and item[2] < time.time():
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            return self._live(key)
+        finally:
+            self._lock.release()
+
+    def store(self, only_missing, key, flags, ttl, data):
+        self._lock.acquire()
+        try:
+            if only_missing and self._live(key) is not None:
+                return False
+            expires = ttl and time.time() + ttl or 0
+            self._data[key] = (flags, data, expires)
+            return True
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            return self._data.pop(key, None) is not None
+        finally:
+            self._lock.release()
+
+    def incr(self, key, delta):
+        self._lock.acquire()
+        try:
+            item = self._live(key)
+            if item is None:
+                return None
+            value = int(item[1]) + delta
+            self._data[key] = (item[0], str(value), item[2])
+            return value
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        # drop the clients, like a memcached going away would
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def stubs_command(args):
+    """Runs the stubs until interrupted."""
+    parser = OptionParser(usage='%prog [options]', prog='syncreg stubs')
+    parser.add_option('--host', dest='host', default='localhost',
+                      help='interface to listen on')
+    parser.add_option('--smtp-port', dest='smtp_port', type='int',
+                      default=2525, help='port of the SMTP stub')
+    parser.add_option('--captcha-port', dest='captcha_port', type='int',
+                      default=8025, help='port of the captcha stub')
+    parser.add_option('--memcache', dest='memcache',
+                      default='localhost:11311',
+                      help='host:port or unix:/path of the memcached stub')
+    options, args = parser.parse_args(args)
+
+    smtp = SMTPStub(options.host, options.smtp_port)
+    captcha = CaptchaStub(options.host, options.captcha_port)
+    memcache = MemcacheStub(options.memcache)
+    smtp.start()
+    captcha.start()
+    memcache.start()
+    print 'SMTP on %s:%d, captcha on %s:%d, memcached on %s' % (
+        options.host, smtp.port, options.host, captcha.port, memcache.bind)
+    try:
+        while True:
+            time.sleep(10)
+            print >> sys.stderr, '%d e-mails, %d captchas' % (
+                smtp.received, captcha.received)
+    except KeyboardInterrupt:
+        pass
+    memcache.stop()
+    captcha.stop()
+    smtp.stop()
+    return 0
@@ -0,0 +1,172 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Tests for the status pages.
+"""
+import os
+import tempfile
+
+from services.tests.support import get_app
+
+from syncreg.memory import MemoryProfiler
+from syncreg.tests.functional import support
+
+
+class TestStatus(support.TestWsgiApp):
+
+    def test_ready(self):
+        # the test configuration warms up in the foreground
+        res = self.app.get('/__ready__')
+        self.assertTrue(res.json['ready'])
+
+        app = get_app(self.app)
+        app.warmup.ready = False
+        try:
+            self.app.get('/__ready__', status=503)
+        finally:
+            app.warmup.ready = True
+
+    def test_warmup_retries(self):
+        app = get_app(self.app)
+        old = app.auth.backend.get_user_id
+
+        def _broken(*args):
+            raise ValueError()
+
+        app.auth.backend.get_user_id = _broken
+        try:
+            self.assertFalse(app.warmup.run())
+            self.assertEquals(app.warmup.errors, ['canary'])
+            self.app.get('/__ready__', status=503)
+        finally:
+            app.auth.backend.get_user_id = old
+
+        self.assertTrue(app.warmup.run())
+        self.app.get('/__ready__', status=200)
+
+    def test_health(self):
+        health = get_app(self.app).health
+        # no background threads, the checks are run by hand
+        health._pid = os.getpid()
+
+        # never checked yet
+        res = self.app.get('/__health__', status=503)
+        self.assertEquals(res.json['checks']['auth']['status'], 'unknown')
+
+        health.run_check('auth', health.check_auth)
+        res = self.app.get('/__health__')
+        self.assertEquals(res.json['status'], 'ok')
+        self.assertFalse(res.json['checks']['auth']['stale'])
+
+        # a result that is too old is not trusted anymore
+        health.results['auth']['checked'] -= health.stale_after + 1
+        res = self.app.get('/__health__', status=503)
+        self.assertTrue(res.json['checks']['auth']['stale'])
+
+        # a failing check that is not critical doesn't matter
+        def _fail():
+            raise IOError('boom')
+
+        health.run_check('auth', health.check_auth)
+        health.run_check('smtp', _fail)
+        res = self.app.get('/__health__')
+        self.assertEquals(res.json['checks']['smtp']['status'], 'failed')
+        self.assertEquals(res.json['checks']['smtp']['error'],
+                          'IOError: boom')
+
+    def test_reload(self):
+        app = get_app(self.app)
+        old = app.controllers['user']
+        here = os.path.dirname(os.path.dirname(__file__))
+        f = open(os.path.join(here, 'sync.conf'))
+        try:
+            conf = f.read()
+        finally:
+            f.close()
+
+        fd, path = tempfile.mkstemp(suffix='.conf')
+        os.close(fd)
+        app.reloader.path = path
+        try:
+            f = open(path, 'w')
+            try:
+                f.write(conf.replace('fallback_node = blah',
+                                     'fallback_node = http://newnode'))
+            finally:
+                f.close()
+
+            # needs the shared secret
+            self.app.post('/__reload__', status=403)
+            self.app.post('/__reload__', status=403,
+                          headers={'X-Weave-Secret': 'xxx'})
+
+            res = self.app.post('/__reload__',
+                                headers={'X-Weave-Secret': 'CHANGEME'})
+            self.assertTrue('nodes' in res.json['changed'])
+            self.assertEquals(res.json['restart'], [])
+        finally:
+            os.remove(path)
+
+        new = app.controllers['user']
+        self.assertTrue(new is not old)
+        self.assertEquals(new.fallback_node, 'http://newnode/')
+        self.assertEquals(app.config['nodes.fallback_node'],
+                          'http://newnode')
+        # the unchanged resources are kept
+        self.assertTrue(new.reset is old.reset)
+        self.assertTrue(new.known_users is old.known_users)
+
+        # a broken file leaves everything in place
+        app.reloader.path = path
+        self.app.post('/__reload__', status=500,
+                      headers={'X-Weave-Secret': 'CHANGEME'})
+        self.assertTrue(app.controllers['user'] is new)
+
+    def test_memory(self):
+        app = get_app(self.app)
+        # disabled by default
+        self.app.get('/__memory__', status=404)
+
+        app.memory = MemoryProfiler()
+        app.memory.start()
+        try:
+            self.app.get('/__memory__', status=403)
+            res = self.app.get('/__memory__',
+                               headers={'X-Weave-Secret': 'CHANGEME'})
+            self.assertTrue(res.json['rss'] > 0)
+            self.assertEquals(res.json['tracing'], app.memory.tracing)
+        finally:
+            app.memory = None
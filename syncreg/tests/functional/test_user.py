@@ -36,17 +36,26 @@
 """
 Basic tests to verify that the dispatching mechanism works.
 """
+import os
 import base64
 import json
 import time
 import random
+import shutil
 import smtplib
+import tempfile
+from hashlib import sha1
 from email import message_from_string
 
 from webtest import AppError
-from recaptcha.client import captcha
 
+from syncreg import remote
 from syncreg.tests.functional import support
+from syncreg.snapshot import write_snapshot, NodeSnapshot
+from syncreg.eventlog import EventLog, EventReader, USER_CREATED
+from syncreg.pwned import PasswordCorpus, build_corpus
+from syncreg.cache import MemoryCache
+from syncreg.throttle import FailureThrottle
 from services.user import User
 from services.tests.support import get_app
 from services.user import extract_username
@@ -91,13 +100,13 @@ class TestUser(support.TestWsgiApp):
         smtplib.SMTP = FakeSMTP
 
         # we don't want to call recaptcha either
-        self.old_submit = captcha.submit
-        captcha.submit = self._submit
+        self.old_submit = remote.submit_captcha
+        remote.submit_captcha = self._submit
 
     def tearDown(self):
         # setting back smtp and recaptcha
         smtplib.SMTP = self.old
-        captcha.submit = self.old_submit
+        remote.submit_captcha = self.old_submit
         FakeSMTP.msgs[:] = []
         super(TestUser, self).tearDown()
 
@@ -374,6 +383,44 @@ class TestUser(support.TestWsgiApp):
         res = self.app.post(self.root + '/email', params=body)
         self.assertEquals(res.body, 'new@email.com')
 
+    def test_events(self):
+        controller = get_app(self.app).controllers['user']
+        directory = tempfile.mkdtemp()
+        controller.events = EventLog(directory, commit_interval=0)
+        try:
+            self.app.post(self.root + '/email', params='newemail.com',
+                          status=400)
+            self.app.post(self.root + '/email', params='new@email.com')
+            self.app.post(self.root + '/password', params='newpasswordhere')
+
+            events, __ = EventReader(directory).read()
+            self.assertEqual([(event.name, event.username, event.data)
+                              for event in events],
+                             [('email_changed', self.user_name,
+                               'new@email.com'),
+                              ('password_changed', self.user_name, '')])
+        finally:
+            controller.events = None
+            shutil.rmtree(directory)
+
+    def test_compromised_password(self):
+        controller = get_app(self.app).controllers['user']
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, 'pwned.sha1')
+        hashes = sorted([sha1(password).hexdigest() + '\n'
+                         for password in ('password123', 'letmein1234')])
+        build_corpus(hashes, path)
+        controller.pwned = PasswordCorpus(path)
+        try:
+            self.app.post(self.root + '/password', params='password123',
+                          status=400)
+            res = self.app.post(self.root + '/password',
+                                params='newpasswordhere')
+            self.assertEquals(res.body, 'success')
+        finally:
+            controller.pwned = None
+            shutil.rmtree(tempdir)
+
     def test_change_password(self):
         body = 'newpasswordhere'
         res = self.app.post(self.root + '/password', params=body)
@@ -466,10 +513,112 @@ class TestUser(support.TestWsgiApp):
         finally:
             app.auth.backend.get_user_id = old_auth
 
+    def test_deadline(self):
+        # no time left: the backend is not even called
+        app = get_app(self.app)
+        old_auth = app.auth.backend.get_user_id
+        calls = []
+
+        def _get_id(*args):
+            calls.append(args)
+            return old_auth(*args)
+
+        app.auth.backend.get_user_id = _get_id
+        try:
+            extra = {'X-Weave-Timeout': '0'}
+            self.app.get(self.root, headers=extra, status=503)
+            self.assertEquals(calls, [])
+
+            # enough time
+            extra = {'X-Weave-Timeout': '30'}
+            res = self.app.get(self.root, headers=extra)
+            self.assertTrue(json.loads(res.body))
+            self.assertEquals(len(calls), 1)
+        finally:
+            app.auth.backend.get_user_id = old_auth
+
+        res = self.app.get('/__stats__')
+        counters = res.json['counters']
+        self.assertEquals(counters['deadline_exceeded.user_exists'], 1)
+
+    def test_stale_lookups(self):
+        app = get_app(self.app)
+        controller = app.controllers['user']
+        controller.fallback_node = 'http://myhappy/proxy/'
+        node_url = self.root + '/node/weave'
+
+        # the lookups are remembered
+        res = self.app.get(self.root)
+        self.assertTrue(json.loads(res.body))
+        self.assertFalse('X-Weave-Stale' in res.headers)
+
+        old_auth = app.auth.backend.get_user_id
+        calls = []
+
+        def _get_id(*args):
+            calls.append(args)
+            raise BackendError()
+
+        app.auth.backend.get_user_id = _get_id
+        try:
+            # the auth backend fails, the last known value is used
+            for i in range(controller.breaker.failure_threshold + 1):
+                res = self.app.get(self.root)
+                self.assertTrue(json.loads(res.body))
+                self.assertEquals(res.headers['X-Weave-Stale'], '1')
+
+            res = self.app.get(node_url)
+            self.assertEquals(res.body, 'http://myhappy/proxy/')
+            self.assertEquals(res.headers['X-Weave-Stale'], '1')
+
+            # the circuit is open, the backend is not called anymore
+            self.assertEquals(len(calls),
+                              controller.breaker.failure_threshold)
+
+            # unknown users and writes fail
+            self.app.get('/user/1.0/unknown', status=503)
+            payload = json.dumps({'email': 'x@example.com',
+                                  'password': 'x' * 9})
+            self.app.put('/user/1.0/%s' % extract_username('x@example.com'),
+                         params=payload, status=503)
+        finally:
+            app.auth.backend.get_user_id = old_auth
+
+        # once the backend is back, the probe closes the circuit
+        controller.breaker.opened_at -= controller.breaker.reset_timeout
+        res = self.app.get(self.root)
+        self.assertFalse('X-Weave-Stale' in res.headers)
+        self.assertEquals(controller.breaker.state, 'closed')
+
     def test_unkown_user_node(self):
         # make sure asking for a node of an unexisting user leads to a 404
         self.app.get('/user/1.0/__xx__/weave/node', status=404)
 
+    def test_node_snapshot(self):
+        app = get_app(self.app)
+        controller = app.controllers['user']
+        controller.fallback_node = 'http://myhappy/proxy/'
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, 'nodes.snapshot')
+        write_snapshot(path, [(self.user_name, 'node1.example.com')])
+        controller.snapshot = NodeSnapshot(path)
+
+        old_auth = app.auth.backend.get_user_id
+
+        def _get_id(*args):
+            raise BackendError()
+
+        # the assigned users are answered without the backend
+        app.auth.backend.get_user_id = _get_id
+        try:
+            res = self.app.get(self.root + '/node/weave')
+            self.assertEqual(res.body, 'https://node1.example.com/')
+        finally:
+            app.auth.backend.get_user_id = old_auth
+            controller.snapshot = None
+            controller.fallback_node = None
+            shutil.rmtree(tempdir)
+
     def test_change_password_with_header(self):
         body = 'newpasswordhere'
 
@@ -493,6 +642,47 @@ class TestUser(support.TestWsgiApp):
                             headers=extra)
         self.assertEqual(res.body, 'success')
 
+    def test_reset_code_used_once(self):
+        user = User(self.user_name)
+        self.auth.get_user_id(user)
+        key = str(self.reset.generate_reset_code(user))
+
+        extra = {'X-Weave-Password-Reset': key}
+        res = self.app.post(self.root + '/password',
+                            params='newpasswordhere', headers=extra)
+        self.assertEqual(res.body, 'success')
+
+        # the code was consumed by the first call
+        res = self.app.post(self.root + '/password',
+                            params='anotherpassword', headers=extra,
+                            status=400)
+        self.assertEquals(res.body, '10')
+
+        res = self.app.post('/weave-password-reset',
+                            params={'username': self.user_name, 'key': key,
+                                    'password': 'anotherpassword',
+                                    'confirm': 'anotherpassword'})
+        self.assertTrue('Key does not match with username' in res)
+
+    def test_reset_code_kept_on_failure(self):
+        user = User(self.user_name)
+        self.auth.get_user_id(user)
+        key = str(self.reset.generate_reset_code(user))
+        extra = {'X-Weave-Password-Reset': key}
+
+        controller = get_app(self.app).controllers['user']
+        controller.auth.admin_update_password = lambda *args: False
+        try:
+            self.app.post(self.root + '/password', params='newpasswordhere',
+                          headers=extra, status=500)
+        finally:
+            del controller.auth.admin_update_password
+
+        # the code can be used again
+        res = self.app.post(self.root + '/password',
+                            params='newpasswordhere', headers=extra)
+        self.assertEqual(res.body, 'success')
+
     def test_shared_secret(self):
         # creating a user
         email = 'test_user%d%d@moz.com' % (time.time(),
@@ -507,7 +697,7 @@ class TestUser(support.TestWsgiApp):
         def _failed(self, *args, **kw):
             return FakeCaptchaResponse(False)
 
-        captcha.submit = _failed
+        remote.submit_captcha = _failed
         extra = {'X-Weave-Secret': 'xxx'}
 
         try:
@@ -529,3 +719,157 @@ class TestUser(support.TestWsgiApp):
             self.assertTrue(json.loads(res.body))
         finally:
             self.auth.delete_user(User(name), 'x' * 9)
+
+    def test_idempotency_key(self):
+        email = 'test_user%d%d@moz.com' % (time.time(),
+                                           random.randint(1, 100))
+        name = extract_username(email)
+        user_url = '/user/1.0/%s' % name
+        payload = json.dumps({'email': email, 'password': 'x' * 9})
+        extra = {'X-Weave-Secret': 'CHANGEME', 'Idempotency-Key': 'abc'}
+
+        controller = get_app(self.app).controllers['user']
+        calls = []
+        create_user = controller.auth.create_user
+
+        def _create_user(*args):
+            calls.append(args)
+            return create_user(*args)
+
+        controller.auth.create_user = _create_user
+        try:
+            res = self.app.put(user_url, params=payload, headers=extra)
+            self.assertEquals(res.body, name)
+
+            # the retry gets the same answer, without creating the user
+            res = self.app.put(user_url, params=payload, headers=extra)
+            self.assertEquals(res.body, name)
+            self.assertEquals(len(calls), 1)
+
+            # without the key, the user already exists
+            del extra['Idempotency-Key']
+            res = self.app.put(user_url, params=payload, headers=extra,
+                               status=400)
+            self.assertEquals(res.json, ERROR_INVALID_WRITE)
+
+            # the same key can't be used for another payload
+            extra['Idempotency-Key'] = 'abc'
+            other = json.dumps({'email': email, 'password': 'y' * 9})
+            self.app.put(user_url, params=other, headers=extra, status=422)
+
+            # while the first request runs, the retries are refused
+            extra['Idempotency-Key'] = 'def'
+            controller.idempotency.claim('%s:def' % name,
+                                         sha1(payload).hexdigest())
+            self.app.put(user_url, params=payload, headers=extra,
+                         status=409)
+
+            # errors are replayed too
+            extra['Idempotency-Key'] = 'ghi'
+            res = self.app.put(user_url, params=payload, headers=extra,
+                               status=400)
+            self.assertEquals(res.json, ERROR_INVALID_WRITE)
+            controller.auth.get_user_id = None
+            res = self.app.put(user_url, params=payload, headers=extra,
+                               status=400)
+            self.assertEquals(res.json, ERROR_INVALID_WRITE)
+        finally:
+            controller.auth.create_user = create_user
+            del controller.auth.get_user_id
+            self.auth.delete_user(User(name), 'x' * 9)
+
+    def test_shared_cache(self):
+        email = 'test_user%d%d@moz.com' % (time.time(),
+                                           random.randint(1, 100))
+        name = extract_username(email)
+        user_url = '/user/1.0/%s' % name
+        payload = json.dumps({'email': email, 'password': 'x' * 9})
+        extra = {'X-Weave-Secret': 'CHANGEME'}
+
+        controller = get_app(self.app).controllers['user']
+        old = controller.cache
+        controller.cache = MemoryCache()
+        try:
+            # the answer is cached, misses included
+            self.assertEquals(self.app.get(user_url).body, '0')
+            self.assertEquals(controller.cache.get('uid:' + name, 'x'),
+                              None)
+
+            # and replaced when the user is written
+            self.app.put(user_url, params=payload, headers=extra)
+            self.assertEquals(controller.cache.get('uid:' + name),
+                              'written')
+            self.assertEquals(self.app.get(user_url).body, '1')
+            controller.cache.delete('uid:' + name)
+            self.assertEquals(self.app.get(user_url).body, '1')
+            self.assertNotEquals(controller.cache.get('uid:' + name), None)
+        finally:
+            controller.cache = old
+            self.auth.delete_user(User(name), 'x' * 9)
+
+    def test_shared_cache_race(self):
+        email = 'test_user%d%d@moz.com' % (time.time(),
+                                           random.randint(1, 100))
+        name = extract_username(email)
+        user_url = '/user/1.0/%s' % name
+
+        controller = get_app(self.app).controllers['user']
+        old = controller.cache
+        controller.cache = MemoryCache()
+        get_user_id = controller.auth.get_user_id
+
+        def _get_user_id(user):
+            # the user is created by another node right after the read
+            uid = get_user_id(user)
+            self.auth.create_user(name, 'x' * 9, email)
+            controller._user_written(USER_CREATED, name)
+            return uid
+
+        controller.auth.get_user_id = _get_user_id
+        try:
+            self.assertEquals(self.app.get(user_url).body, '0')
+        finally:
+            controller.auth.get_user_id = get_user_id
+        try:
+            # the stale answer was not cached
+            self.assertEquals(self.app.get(user_url).body, '1')
+        finally:
+            controller.cache = old
+            self.auth.delete_user(User(name), 'x' * 9)
+
+    def test_auth_throttle(self):
+        auth = get_app(self.app).auth
+        auth.throttle = FailureThrottle(max_failures=3, window=60)
+        good = self.app.extra_environ
+        token = base64.encodestring('%s:%s' % (self.user_name, 'y' * 9))
+        bad = {'HTTP_AUTHORIZATION': 'Basic %s' % token}
+        calls = []
+        authenticate_user = auth.backend.authenticate_user
+
+        def _authenticate_user(*args):
+            calls.append(args)
+            return authenticate_user(*args)
+
+        auth.backend.authenticate_user = _authenticate_user
+        try:
+            for i in range(3):
+                self.app.delete(self.root, extra_environ=bad, status=401)
+            self.assertEquals(len(calls), 3)
+
+            # the password isn't checked anymore, even the right one
+            res = self.app.delete(self.root, extra_environ=bad, status=429)
+            self.assertTrue(int(res.headers['Retry-After']) > 0)
+            self.app.post(self.root + '/email', params='new@example.com',
+                          extra_environ=good, status=429)
+            self.app.post(self.root + '/password', params='z' * 9,
+                          extra_environ=good, status=429)
+            self.assertEquals(len(calls), 3)
+
+            # without the lockout, the right password works again
+            auth.throttle = FailureThrottle(max_failures=3, window=60)
+            res = self.app.post(self.root + '/email',
+                                params='new@example.com', extra_environ=good)
+            self.assertEquals(res.body, 'new@example.com')
+        finally:
+            auth.backend.authenticate_user = authenticate_user
+            auth.throttle = None
@@ -0,0 +1,139 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import time
+import threading
+import unittest
+
+from webob.exc import HTTPServiceUnavailable
+
+from syncreg.admission import AdmissionControl, RouteClass
+from syncreg.deadline import DeadlinePolicy
+from syncreg.stats import Counters
+
+
+class FakeRequest(object):
+
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+
+class TestAdmission(unittest.TestCase):
+
+    def test_route_class(self):
+        route_class = RouteClass('slow', max_concurrency=1, max_queue=1,
+                                 queue_timeout=0.1)
+        self.assertTrue(route_class.acquire())
+
+        # the queue has room for one request, that times out
+        start = time.time()
+        self.assertFalse(route_class.acquire())
+        self.assertTrue(time.time() - start >= 0.1)
+
+        # a waiting request gets the slot as soon as it is released
+        got = []
+        route_class.queue_timeout = 5.
+        waiter = threading.Thread(target=lambda: got.append(
+                                                route_class.acquire()))
+        waiter.start()
+        while route_class.waiting == 0:
+            time.sleep(0.01)
+
+        # the queue is full
+        self.assertFalse(route_class.acquire())
+        route_class.release()
+        waiter.join()
+        self.assertEquals(got, [True])
+        self.assertEquals(route_class.stats(),
+                          {'active': 1, 'waiting': 0, 'shed': 2})
+
+    def test_wrap(self):
+        config = {'admission.classes': 'lookup, slow',
+                  'admission.lookup.routes': 'user_exists, user_node',
+                  'admission.slow.routes': 'password_reset',
+                  'admission.slow.max_concurrency': 1,
+                  'admission.slow.max_queue': 0,
+                  'admission.slow.retry_after': 12}
+        admission = AdmissionControl(config)
+        self.assertEquals(admission.routes['user_node'].name, 'lookup')
+
+        def _route(request):
+            return 'ok'
+
+        # unknown routes are not limited
+        self.assertTrue(admission.wrap('captcha_form', _route) is _route)
+
+        calls = []
+
+        def _reset(request, **data):
+            # the slot is taken, other calls are shed right away
+            try:
+                admission.wrap('password_reset', _reset)(request)
+            except HTTPServiceUnavailable, e:
+                calls.append(e.headers['Retry-After'])
+            return 'ok'
+
+        wrapped = admission.wrap('password_reset', _reset)
+        self.assertEquals(wrapped(None), 'ok')
+        self.assertEquals(calls, ['12'])
+
+        # the slot was given back
+        self.assertEquals(admission.classes['slow'].active, 0)
+        self.assertEquals(admission.stats()['slow']['shed'], 1)
+
+    def test_deadline_exceeded(self):
+        config = {'admission.classes': 'slow',
+                  'admission.slow.routes': 'password_reset',
+                  'admission.slow.max_concurrency': 1,
+                  'admission.slow.max_queue': 1,
+                  'admission.slow.queue_timeout': 10}
+        admission = AdmissionControl(config)
+        counters = Counters()
+        policy = DeadlinePolicy({'deadline.timeout': 10}, counters)
+        route_class = admission.classes['slow']
+        route_class.acquire()
+
+        def _reset(request):
+            return 'ok'
+
+        # the request waits in the queue until it runs out of time
+        wrapped = policy.wrap('password_reset',
+                              admission.wrap('password_reset', _reset))
+        request = FakeRequest({'X-Weave-Timeout': '0.05'})
+        self.assertRaises(HTTPServiceUnavailable, wrapped, request)
+        self.assertEquals(
+                counters.get('deadline_exceeded.password_reset'), 1)
+        self.assertEquals(route_class.shed, 1)
+        route_class.release()
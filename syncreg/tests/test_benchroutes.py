@@ -0,0 +1,78 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from syncreg.benchroutes import (SCENARIOS, EXCLUDED, iter_routes,
+                                 find_regressions)
+from syncreg.wsgiapp import urls
+
+
+def _summary(ops_per_sec, p50, p99=None):
+    if p99 is None:
+        p99 = p50
+    return {'requests': 100, 'errors': 0, 'ops_per_sec': ops_per_sec,
+            'p50': p50, 'p90': p50, 'p99': p99}
+
+
+class TestBenchRoutes(unittest.TestCase):
+
+    def test_every_route(self):
+        actions = [action for __, action in iter_routes(urls)]
+        self.assertEqual(len(actions), len(urls))
+        for action in actions:
+            self.assertTrue(action in SCENARIOS or action in EXCLUDED,
+                            action)
+        # only existing routes are excluded, and none has a scenario
+        for action in EXCLUDED:
+            self.assertTrue(action in actions, action)
+            self.assertFalse(action in SCENARIOS, action)
+
+    def test_regressions(self):
+        baseline = {'GET user_exists': _summary(1000., 1.),
+                    'GET user_node': _summary(1000., 1.),
+                    'GET stats': _summary(1000., 1.),
+                    'GET password_reset': _summary(1000., 1., 5.)}
+        results = {'GET user_exists': _summary(900., 1.1),
+                   'GET user_node': _summary(700., 1.4),
+                   'GET stats': _summary(1000., 1.5),
+                   'GET password_reset': _summary(1000., 1., 7.5),
+                   'GET ready': _summary(10., 100.)}
+
+        regressions = find_regressions(results, baseline, 20)
+        self.assertEqual([name for name, __ in regressions],
+                         ['GET password_reset', 'GET stats', 'GET user_node'])
+        self.assertEqual(regressions[0][1], 'p99 5.00 -> 7.50 ms')
+        self.assertEqual(find_regressions(results, baseline, 60), [])
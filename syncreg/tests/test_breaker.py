@@ -0,0 +1,74 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import time
+import unittest
+
+from syncreg.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+class TestBreaker(unittest.TestCase):
+
+    def test_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEquals(breaker.state, CLOSED)
+        breaker.failure()
+        self.assertEquals(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+
+        # a single probe goes through after the timeout
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertEquals(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.allow())
+
+        # the probe failed, the circuit opens again right away
+        breaker.failure()
+        self.assertEquals(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+
+        # a cancelled probe lets another one try
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.cancel()
+        self.assertTrue(breaker.allow())
+
+        breaker.success()
+        self.assertEquals(breaker.state, CLOSED)
+        self.assertEquals(breaker.failures, 0)
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
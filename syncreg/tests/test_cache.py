@@ -0,0 +1,179 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from syncreg.cache import MemoryCache, MemcacheClient, get_cache
+from syncreg.idempotency import CacheIdempotencyStore, get_store
+from syncreg.stubs import MemcacheStub
+
+
+class _CacheTests(object):
+    """Run against every backend."""
+
+    def test_values(self):
+        cache = self.cache
+        self.assertEquals(cache.get('missing'), None)
+        self.assertEquals(cache.get('missing', 'default'), 'default')
+        for key, value in (('str', 'value'), ('unicode', u'\xe9t\xe9'),
+                           ('int', 42), ('none', None),
+                           ('list', [1, 'two', None]),
+                           ('dict', {'a': 1})):
+            self.assertTrue(cache.set(key, value))
+            self.assertEquals(cache.get(key, 'missing'), value)
+
+        # the keys are hashed when memcached would refuse them
+        for key in ('with space', 'x' * 300, u'\xe9'):
+            cache.set(key, 1)
+            self.assertEquals(cache.get(key), 1)
+
+    def test_multi(self):
+        cache = self.cache
+        keys = ['key%d' % i for i in range(50)]
+        for index, key in enumerate(keys):
+            cache.set(key, index)
+        found = cache.get_multi(keys + ['missing'])
+        self.assertEquals(found, dict([(key, index)
+                                       for index, key in enumerate(keys)]))
+        cache.delete_multi(keys[:25])
+        self.assertEquals(sorted(cache.get_multi(keys)), sorted(keys[25:]))
+
+    def test_add_incr_delete(self):
+        cache = self.cache
+        self.assertTrue(cache.add('counter', 0, 10))
+        self.assertFalse(cache.add('counter', 5, 10))
+        self.assertEquals(cache.incr('counter'), 1)
+        self.assertEquals(cache.incr('counter', 5), 6)
+        self.assertEquals(cache.incr('missing'), None)
+        self.assertTrue(cache.delete('counter'))
+        self.assertFalse(cache.delete('counter'))
+
+    def test_expiration(self):
+        self.cache.set('short', 1, 1)
+        self.cache.set('long', 1)
+        time.sleep(1.1)
+        self.assertEquals(self.cache.get('short'), None)
+        self.assertEquals(self.cache.get('long'), 1)
+
+    def test_idempotency(self):
+        store = CacheIdempotencyStore(self.cache)
+        self.assertEquals(store.claim('bob:1', 'abc'), None)
+        self.assertEquals(store.claim('bob:1', 'abc'),
+                          ('abc', None, None, None))
+        store.complete('bob:1', 'abc', 200, None, '"bob"')
+        self.assertEquals(store.claim('bob:1', 'abc'),
+                          ('abc', 200, None, '"bob"'))
+        self.assertTrue(isinstance(store.claim('bob:1', 'abc')[3], str))
+        store.release('bob:1')
+        self.assertEquals(store.claim('bob:1', 'abc'), None)
+
+
+class TestMemoryCache(unittest.TestCase, _CacheTests):
+
+    def setUp(self):
+        self.cache = MemoryCache()
+
+
+class TestMemcacheClient(unittest.TestCase, _CacheTests):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # one server on a port, one on a unix socket
+        self.stubs = [MemcacheStub('127.0.0.1:0'),
+                      MemcacheStub('unix:%s' % os.path.join(self.dir,
+                                                            'mc.sock'))]
+        for stub in self.stubs:
+            stub.start()
+        self.cache = MemcacheClient(','.join([stub.bind
+                                              for stub in self.stubs]),
+                                    retry_delay=0.5)
+
+    def tearDown(self):
+        for stub in self.stubs:
+            stub.stop()
+        shutil.rmtree(self.dir)
+
+    def test_pipelined(self):
+        keys = ['key%d' % i for i in range(100)]
+        for key in keys:
+            self.cache.set(key, key)
+        self.assertEquals(len(self.cache.get_multi(keys)), 100)
+        # one request per server, and both servers got keys
+        self.assertEquals([stub.commands['get'] for stub in self.stubs],
+                          [1, 1])
+        self.cache.delete_multi(keys)
+        self.assertEquals(self.cache.get_multi(keys), {})
+
+    def test_server_down(self):
+        self.cache.set('key', 1)
+        stub = self.stubs[0]
+        stub.stop()
+        # the keys of the stopped server are misses
+        keys = ['key%d' % i for i in range(20)]
+        self.assertTrue(len(self.cache.get_multi(keys)) < 20)
+        self.assertFalse(self.cache.set('key0', 0) and
+                         self.cache.set('key1', 1) and
+                         self.cache.set('key2', 2) and
+                         self.cache.set('key3', 3))
+
+        # back after retry_delay
+        self.stubs[0] = MemcacheStub(stub.bind)
+        self.stubs[0].start()
+        time.sleep(0.6)
+        for key in keys:
+            self.assertTrue(self.cache.set(key, key))
+
+    def test_close(self):
+        self.cache.set('key', 1)
+        conns = [conn for pid, conn in self.cache._connections]
+        self.assertTrue(conns)
+
+        self.cache.close()
+        for conn in conns:
+            self.assertTrue(conn.file.closed)
+        self.assertEquals(self.cache._connections, [])
+        # a thread using the client afterwards connects again
+        self.assertEquals(self.cache.get('key'), 1)
+        self.assertTrue(self.cache._connections)
+
+    def test_get_cache(self):
+        self.assertEquals(get_cache({}), None)
+        self.assertTrue(isinstance(get_store({'idempotency.shared': True},
+                                             self.cache),
+                                   CacheIdempotencyStore))
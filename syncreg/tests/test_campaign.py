@@ -0,0 +1,178 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import time
+import shutil
+import smtplib
+import tempfile
+import unittest
+from email import message_from_string
+
+from syncreg.backends.resetcodes import SQLiteResetCode
+from syncreg.campaign import Campaign, MailDispatcher, RateLimiter
+from syncreg.export import read_checkpoint
+
+
+class _Auth(object):
+
+    def __init__(self, mails):
+        self.mails = mails
+
+    def get_user_id(self, user):
+        if user['username'] not in self.mails:
+            return None
+        return 1
+
+    def get_user_info(self, user, attrs):
+        user['mail'] = self.mails[user['username']]
+
+
+class _SMTP(object):
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+
+    def sendmail(self, sender, rcpts, message):
+        dispatcher = self.dispatcher
+        rcpt = rcpts[0]
+        dispatcher.attempts[rcpt] = dispatcher.attempts.get(rcpt, 0) + 1
+        if rcpt in dispatcher.broken:
+            raise smtplib.SMTPRecipientsRefused(
+                    {rcpt: (550, 'No such user')})
+        if rcpt in dispatcher.busy and dispatcher.attempts[rcpt] == 1:
+            raise smtplib.SMTPRecipientsRefused(
+                    {rcpt: (451, 'Try again later')})
+        dispatcher.messages.append((rcpt, message))
+
+    def quit(self):
+        self.dispatcher.closed += 1
+
+
+class _Dispatcher(MailDispatcher):
+
+    def __init__(self, *args, **kw):
+        self.messages = []
+        self.broken = set()
+        self.busy = set()
+        self.attempts = {}
+        self.connections = 0
+        self.closed = 0
+        MailDispatcher.__init__(self, *args, **kw)
+
+    def _connect(self):
+        self.connections += 1
+        return _SMTP(self)
+
+
+class TestCampaign(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.reset = SQLiteResetCode(os.path.join(self.dir, 'reset.db'))
+        mails = dict([('user%d' % i, 'user%d@example.com' % i)
+                      for i in range(20)])
+        mails['nomail'] = None
+        self.auth = _Auth(mails)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(100)
+        start = time.time()
+        for i in range(21):
+            limiter.wait()
+        self.assertTrue(time.time() - start >= 0.19)
+        # no limit
+        RateLimiter().wait()
+
+    def test_campaign(self):
+        dispatcher = _Dispatcher(workers=3)
+        campaign = Campaign(self.auth, self.reset, dispatcher,
+                            'https://example.com', 'weave@example.com',
+                            batch_size=4)
+        dispatcher.broken.add('user3@example.com')
+        dispatcher.busy.add('user5@example.com')
+        checkpoint = os.path.join(self.dir, 'checkpoint')
+        lines = ['user%d\n' % i for i in range(10)]
+        lines += ['\n', 'unknown\n', 'nomail\n']
+        positions = []
+        try:
+            self.assertEquals(campaign.run(lines, checkpoint=checkpoint,
+                                           callback=positions.append), 13)
+        finally:
+            dispatcher.close()
+
+        self.assertEquals(positions, [4, 8, 12, 13])
+        self.assertEquals(read_checkpoint(checkpoint), (13, None))
+        self.assertEquals(campaign.unknown, ['unknown'])
+        self.assertEquals(campaign.no_email, ['nomail'])
+        self.assertEquals(dispatcher.failures, ['user3'])
+        self.assertEquals(dispatcher.sent, 9)
+        # a permanent error is not retried, a temporary one is, on a new
+        # connection
+        self.assertEquals(dispatcher.attempts['user3@example.com'], 1)
+        self.assertEquals(dispatcher.attempts['user5@example.com'], 2)
+        self.assertTrue(dispatcher.connections <= 3 + 1)
+        self.assertEquals(dispatcher.closed, dispatcher.connections)
+
+        # the mails hold a valid code
+        for rcpt, message in dispatcher.messages:
+            username = rcpt.split('@')[0]
+            body = message_from_string(message).get_payload(decode=True)
+            self.assertTrue('username=%s&' % username in body)
+            code = body.split('key=')[1].split()[0]
+            self.assertTrue(self.reset.verify_reset_code(
+                {'username': username}, code))
+
+    def test_resume(self):
+        dispatcher = _Dispatcher(workers=2)
+        campaign = Campaign(self.auth, self.reset, dispatcher,
+                            'https://example.com', 'weave@example.com',
+                            batch_size=5)
+        lines = ['user%d@example.com' % i for i in range(20)]
+        try:
+            # the e-mails don't match the usernames here, all unknown
+            self.assertEquals(campaign.run(lines, start=15), 20)
+            self.assertEquals(len(campaign.unknown), 5)
+
+            lines = ['user%d' % i for i in range(20)]
+            self.assertEquals(campaign.run(lines, start=15), 20)
+        finally:
+            dispatcher.close()
+        sent = sorted([rcpt for rcpt, message in dispatcher.messages])
+        self.assertEquals(sent, ['user%d@example.com' % i
+                                 for i in range(15, 20)])
@@ -0,0 +1,125 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import time
+import unittest
+
+from webob.exc import HTTPServiceUnavailable
+
+from syncreg import deadline
+from syncreg.deadline import DeadlinePolicy, DeadlineBackend
+from syncreg.stats import Counters
+
+
+class FakeRequest(object):
+
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+
+class FakeBackend(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_user_id(self, user):
+        self.calls += 1
+        return 1
+
+
+class TestDeadline(unittest.TestCase):
+
+    def setUp(self):
+        self.counters = Counters()
+        self.policy = DeadlinePolicy({'deadline.timeout': 10},
+                                     self.counters)
+
+    def test_timeout(self):
+        self.assertEquals(self.policy.get_timeout(FakeRequest()), 10)
+        request = FakeRequest({'X-Weave-Timeout': '2.5'})
+        self.assertEquals(self.policy.get_timeout(request), 2.5)
+        # the header can't extend the configured timeout
+        request = FakeRequest({'X-Weave-Timeout': '60'})
+        self.assertEquals(self.policy.get_timeout(request), 10)
+        request = FakeRequest({'X-Weave-Timeout': 'what'})
+        self.assertEquals(self.policy.get_timeout(request), 10)
+
+        policy = DeadlinePolicy({}, self.counters)
+        self.assertEquals(policy.get_timeout(FakeRequest()), None)
+
+    def test_remote_timeout(self):
+        # outside of a request, the configured timeout
+        self.assertEquals(deadline.timeout(5), 5)
+        timeouts = []
+
+        def _route(request):
+            timeouts.append(deadline.timeout(5))
+            time.sleep(0.05)
+            return deadline.timeout(5)
+
+        wrapped = self.policy.wrap('password_reset', _route)
+        self.assertEquals(wrapped(FakeRequest()), 5)
+        self.assertEquals(timeouts, [5])
+
+        # bounded by the time left to the request
+        request = FakeRequest({'X-Weave-Timeout': '0.5'})
+        self.assertTrue(wrapped(request) < 0.5)
+        request = FakeRequest({'X-Weave-Timeout': '0.01'})
+        self.assertRaises(HTTPServiceUnavailable, wrapped, request)
+        self.assertEquals(
+                self.counters.get('deadline_exceeded.password_reset'), 1)
+
+    def test_wrap(self):
+        backend = DeadlineBackend(FakeBackend())
+        remaining = []
+
+        def _route(request):
+            remaining.append(deadline.remaining())
+            time.sleep(0.05)
+            return backend.get_user_id(None)
+
+        wrapped = self.policy.wrap('user_exists', _route)
+        self.assertEquals(wrapped(FakeRequest()), 1)
+        self.assertTrue(0 < remaining[0] <= 10)
+
+        # the deadline only lives during the request
+        self.assertEquals(deadline.current(), None)
+        self.assertEquals(backend.get_user_id(None), 1)
+
+        request = FakeRequest({'X-Weave-Timeout': '0.01'})
+        self.assertRaises(HTTPServiceUnavailable, wrapped, request)
+        self.assertEquals(backend._backend.calls, 2)
+        self.assertEquals(self.counters.get('deadline_exceeded.user_exists'),
+                          1)
@@ -0,0 +1,202 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from syncreg.eventlog import (EventLog, EventReader, read_offset,
+                              write_offset, segment_path, USER_CREATED,
+                              EMAIL_CHANGED)
+
+
+class TestEventLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_read(self):
+        log = EventLog(self.directory, commit_interval=0)
+        self.assertTrue(log.append(USER_CREATED, 'bob'))
+        self.assertTrue(log.append(EMAIL_CHANGED, u'bob', u'b\xe9b@x.com'))
+
+        reader = EventReader(self.directory)
+        events, offset = reader.read()
+        self.assertEqual([(event.name, event.username) for event in events],
+                         [('user_created', 'bob'), ('email_changed', 'bob')])
+        self.assertEqual(events[1].data.decode('utf8'), u'b\xe9b@x.com')
+        self.assertEqual(events[1].offset, offset)
+
+        # tailing
+        self.assertEqual(reader.read(offset), ([], offset))
+        log.append(USER_CREATED, 'sam')
+        events, offset = reader.read(offset)
+        self.assertEqual([event.username for event in events], ['sam'])
+
+        # the consumers keep their offset
+        path = os.path.join(self.directory, 'consumer')
+        self.assertEqual(read_offset(path), None)
+        write_offset(path, offset)
+        self.assertEqual(read_offset(path), offset)
+        reader.close()
+
+    def test_group_commit(self):
+        log = EventLog(self.directory, segment_size=1000,
+                       commit_interval=0.01)
+        writes = []
+        original = log._write
+
+        def _write(data):
+            writes.append(data)
+            original(data)
+        log._write = _write
+
+        def _append(index):
+            for i in range(20):
+                log.append(USER_CREATED, 'user%d-%d' % (index, i))
+
+        threads = [threading.Thread(target=_append, args=(index,))
+                   for index in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # concurrent appends shared their writes
+        self.assertTrue(len(writes) < 200)
+        self.assertTrue(os.path.exists(segment_path(self.directory, 2)))
+
+        reader = EventReader(self.directory)
+        events, offset = reader.read(limit=150)
+        self.assertEqual(len(events), 150)
+        more, offset = reader.read(offset)
+        usernames = [event.username for event in events + more]
+        self.assertEqual(len(usernames), 200)
+        self.assertEqual(len(set(usernames)), 200)
+
+    def test_partial_record(self):
+        log = EventLog(self.directory, commit_interval=0)
+        log.append(USER_CREATED, 'bob')
+        f = open(segment_path(self.directory, 1), 'ab')
+        f.write('\x00\x00\x00\x20\x00')
+        f.close()
+
+        reader = EventReader(self.directory)
+        events, offset = reader.read()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(reader.read(offset), ([], offset))
+
+    def test_torn_tail(self):
+        log = EventLog(self.directory, commit_interval=0)
+        log.append(USER_CREATED, 'bob')
+        f = open(segment_path(self.directory, 1), 'ab')
+        f.write('\x00\x00\x00\x20\x00')
+        f.close()
+
+        # a new writer drops the tail before appending
+        log = EventLog(self.directory, commit_interval=0)
+        self.assertTrue(log.append(USER_CREATED, 'sam'))
+        events, offset = EventReader(self.directory).read()
+        self.assertEqual([event.username for event in events],
+                         ['bob', 'sam'])
+
+    def test_failed_write(self):
+        log = EventLog(self.directory, commit_interval=0)
+        log.append(USER_CREATED, 'bob')
+        original = os.fsync
+
+        def _fsync(fd):
+            raise OSError('EIO')
+
+        os.fsync = _fsync
+        try:
+            self.assertFalse(log.append(USER_CREATED, 'sam'))
+        finally:
+            os.fsync = original
+        self.assertEqual(log.errors, 1)
+
+        # the failed records were truncated away
+        self.assertTrue(log.append(USER_CREATED, 'tom'))
+        events, offset = EventReader(self.directory).read()
+        self.assertEqual([event.username for event in events],
+                         ['bob', 'tom'])
+
+    def test_close(self):
+        log = EventLog(self.directory, commit_interval=0)
+        self.assertTrue(log.append(USER_CREATED, 'bob'))
+        thread = log._thread
+        log.close(5)
+        self.assertFalse(thread.isAlive())
+        self.assertEqual(log._fd, None)
+
+        # the requests still using the log write their records themselves
+        count = threading.activeCount()
+        self.assertTrue(log.append(USER_CREATED, 'sam'))
+        self.assertEqual(threading.activeCount(), count)
+        self.assertEqual(log._fd, None)
+        events, offset = EventReader(self.directory).read()
+        self.assertEqual([event.username for event in events],
+                         ['bob', 'sam'])
+
+    def test_long_username(self):
+        log = EventLog(self.directory, commit_interval=0)
+        self.assertTrue(log.append(USER_CREATED, 'x' * 300))
+        events, offset = EventReader(self.directory).read()
+        self.assertEqual(events[0].username, 'x' * 300)
+
+    def test_corrupted_record(self):
+        log = EventLog(self.directory, commit_interval=0)
+        for username in ('bob', 'sam', 'tom'):
+            log.append(USER_CREATED, username)
+        # flips a byte of the username of sam
+        path = segment_path(self.directory, 1)
+        f = open(path, 'r+b')
+        try:
+            data = f.read()
+            position = data.index('sam')
+            f.seek(position)
+            f.write('S')
+        finally:
+            f.close()
+
+        # the readers of the live segment go on with the next record
+        events, offset = EventReader(self.directory).read()
+        self.assertEqual([event.username for event in events],
+                         ['bob', 'tom'])
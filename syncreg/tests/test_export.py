@@ -0,0 +1,167 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import simplejson as json
+from sqlalchemy import create_engine
+
+from syncreg import export
+from syncreg.export import (Exporter, read_checkpoint, write_checkpoint,
+                            resume_output)
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.sqluri = 'sqlite:///%s' % os.path.join(self.tempdir, 'users.db')
+        engine = create_engine(self.sqluri)
+        engine.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, '
+                       'username VARCHAR(32), email VARCHAR(64), '
+                       'status INTEGER)')
+        for i in range(25):
+            engine.execute('INSERT INTO users (username, email, status) '
+                           'VALUES (?, ?, 1)', 'user%d' % i,
+                           u'user%d@\xe9xample.com' % i)
+        self.checkpoint = os.path.join(self.tempdir, 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_jsonl(self):
+        exporter = Exporter(self.sqluri, batch_size=10)
+        stream = StringIO()
+        self.assertEqual(exporter.export(stream), 25)
+        rows = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[3], {'id': 4, 'username': 'user3',
+                                   'mail': u'user3@\xe9xample.com',
+                                   'status': 1})
+
+    def test_csv_resume(self):
+        exporter = Exporter(self.sqluri, batch_size=10)
+
+        # the first run dies while writing the second batch
+        class _Stream(StringIO):
+            def write(self, data):
+                if self.len > 0 and data.startswith('11,'):
+                    raise IOError()
+                StringIO.write(self, data)
+
+        stream = _Stream()
+        self.assertRaises(IOError, exporter.export, stream, 'csv', None,
+                          self.checkpoint)
+        self.assertEqual(read_checkpoint(self.checkpoint), (10, None))
+
+        # no header when resuming
+        stream = StringIO(stream.getvalue())
+        stream.seek(0, 2)
+        after, offset = read_checkpoint(self.checkpoint)
+        self.assertEqual(exporter.export(stream, 'csv', after,
+                                         self.checkpoint), 15)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines[0], 'id,username,mail,status')
+        self.assertEqual(len(lines), 26)
+        self.assertEqual(lines[1], '1,user0,user0@\xc3\xa9xample.com,1')
+        self.assertEqual(lines[-1], '25,user24,user24@\xc3\xa9xample.com,1')
+        self.assertEqual(read_checkpoint(self.checkpoint), (25, None))
+
+    def test_torn_output(self):
+        exporter = Exporter(self.sqluri, batch_size=10)
+        output = os.path.join(self.tempdir, 'users.jsonl')
+        calls = []
+
+        # the run dies after the flush of the last batch, before its
+        # checkpoint
+        def _write_checkpoint(path, last_id, offset=None):
+            calls.append(offset)
+            if len(calls) == 3:
+                raise KeyboardInterrupt()
+            write_checkpoint(path, last_id, offset)
+
+        export.write_checkpoint = _write_checkpoint
+        stream = open(output, 'wb')
+        try:
+            self.assertRaises(KeyboardInterrupt, exporter.export, stream,
+                              'jsonl', None, self.checkpoint)
+        finally:
+            export.write_checkpoint = write_checkpoint
+            stream.close()
+        self.assertEqual(read_checkpoint(self.checkpoint), (20, calls[1]))
+        self.assertEqual(os.path.getsize(output), calls[2])
+
+        after, offset = read_checkpoint(self.checkpoint)
+        stream = resume_output(output, offset)
+        self.assertEqual(exporter.export(stream, 'jsonl', after,
+                                         self.checkpoint), 5)
+        stream.close()
+        ids = [json.loads(line)['id'] for line in open(output)]
+        self.assertEqual(ids, range(1, 26))
+        self.assertEqual(read_checkpoint(self.checkpoint),
+                         (25, os.path.getsize(output)))
+
+    def test_shards(self):
+        # the shards use disjoint id ranges: odd ids in the second one
+        sqluri = 'sqlite:///%s' % os.path.join(self.tempdir, 'shard.db')
+        engine = create_engine(sqluri)
+        engine.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, '
+                       'username VARCHAR(32), email VARCHAR(64), '
+                       'status INTEGER)')
+        first = create_engine(self.sqluri)
+        for id_ in range(1, 26, 2):
+            row = first.execute('SELECT * FROM users WHERE id = ?',
+                                id_).fetchone()
+            engine.execute('INSERT INTO users VALUES (?, ?, ?, ?)', *row)
+            # the last one is in the middle of its move
+            if id_ != 25:
+                first.execute('DELETE FROM users WHERE id = ?', id_)
+
+        config = os.path.join(self.tempdir, 'sync.conf')
+        f = open(config, 'w')
+        try:
+            f.write('[auth]\nsqluris = %s\nprevious_sqluris = %s\n' %
+                    (sqluri, self.sqluri))
+        finally:
+            f.close()
+        output = os.path.join(self.tempdir, 'users.jsonl')
+        self.assertEqual(export.export_command([config, '-o', output,
+                                                '-b', '10']), 0)
+        ids = [json.loads(line)['id'] for line in open(output)]
+        self.assertEqual(ids, range(1, 26))
@@ -0,0 +1,225 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import time
+import signal
+import socket
+import urllib2
+import unittest
+
+try:
+    import gevent
+except ImportError:
+    # gevent is optional, so are the tests of the green worker
+    gevent = None
+
+from syncreg.deadline import DeadlineBackend
+from syncreg.green import (BlockingBackend, GreenWorker, wrap_backends,
+                           wrap_controller)
+
+
+class FakePool(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def apply(self, func, args=None, kwds=None):
+        self.calls.append(func.__name__)
+        return func(*(args or ()), **(kwds or {}))
+
+
+class FakeBackend(object):
+
+    sqluri = 'sqlite://'
+
+    def get_user_id(self, user, default=None):
+        return user.get('username', default)
+
+
+class FakeAuth(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+
+class FakeController(object):
+
+    def __init__(self):
+        self.auth = DeadlineBackend(FakeBackend())
+        self.reset = FakeBackend()
+
+
+class FakeReloader(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.callbacks = []
+        self.reloads = 0
+
+    def run(self):
+        new = FakeController()
+        for callback in self.callbacks:
+            callback(new)
+        self.app.controllers['user'] = new
+        self.reloads += 1
+
+
+class FakeApp(object):
+
+    def __init__(self):
+        self.auth = FakeAuth(FakeBackend())
+        self.controllers = {'user': FakeController()}
+        self.reloader = FakeReloader(self)
+
+    def __call__(self, environ, start_response):
+        if environ['PATH_INFO'] == '/slow':
+            gevent.sleep(1.5)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['%d' % self.reloader.reloads]
+
+
+class TestGreen(unittest.TestCase):
+
+    def test_blocking_backend(self):
+        pool = FakePool()
+        backend = BlockingBackend(FakeBackend(), pool)
+
+        # methods go through the pool, with their arguments
+        self.assertEquals(backend.get_user_id({'username': 'tarek'}),
+                          'tarek')
+        self.assertEquals(backend.get_user_id({}, default=1), 1)
+        self.assertEquals(pool.calls, ['get_user_id', 'get_user_id'])
+
+        # attributes don't
+        self.assertEquals(backend.sqluri, 'sqlite://')
+        self.assertEquals(len(pool.calls), 2)
+
+    def test_wrap_controller(self):
+        pool = FakePool()
+        user = FakeController()
+        wrap_controller(user, pool)
+
+        # the proxies stay in front, the backend goes through the pool
+        self.assertTrue(isinstance(user.auth, DeadlineBackend))
+        self.assertTrue(isinstance(user.auth._backend, BlockingBackend))
+        self.assertTrue(isinstance(user.reset, BlockingBackend))
+        self.assertEquals(user.auth.get_user_id({'username': 'bob'}), 'bob')
+        self.assertEquals(pool.calls, ['get_user_id'])
+
+        # kept by a reload, not wrapped twice
+        reset = user.reset
+        wrap_controller(user, pool)
+        self.assertTrue(user.reset is reset)
+        self.assertTrue(isinstance(user.auth._backend._backend,
+                                   FakeBackend))
+
+    def test_wrap_backends(self):
+        if gevent is None:
+            return
+        app = FakeApp()
+        pool = wrap_backends(app, 2)
+        try:
+            self.assertEquals(pool.maxsize, 2)
+            self.assertTrue(isinstance(app.auth.backend, BlockingBackend))
+            self.assertEquals(app.auth.backend.get_user_id({}, default=1),
+                              1)
+            user = app.controllers['user']
+            self.assertTrue(isinstance(user.reset, BlockingBackend))
+
+            # the controller built by a reload is wrapped before it is used
+            app.reloader.run()
+            user = app.controllers['user']
+            self.assertTrue(isinstance(user.auth._backend, BlockingBackend))
+            self.assertTrue(isinstance(user.reset, BlockingBackend))
+        finally:
+            pool.kill()
+
+    def _get(self, url):
+        # the worker may not be up yet
+        for i in range(50):
+            try:
+                return urllib2.urlopen(url).read()
+            except urllib2.URLError:
+                time.sleep(.1)
+        raise AssertionError('Worker not reachable')
+
+    def test_worker(self):
+        if gevent is None:
+            return
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        url = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+        pid = os.fork()
+        if pid == 0:
+            try:
+                gevent.reinit()
+                GreenWorker(sock, FakeApp(), graceful_timeout=5).run()
+            finally:
+                os._exit(0)
+
+        sock.close()
+        try:
+            self.assertEquals(self._get(url + '/'), '0')
+            # SIGHUP reloads the configuration in the worker
+            os.kill(pid, signal.SIGHUP)
+            for i in range(50):
+                if self._get(url + '/') == '1':
+                    break
+                time.sleep(.1)
+            else:
+                raise AssertionError('Worker not reloaded')
+
+            # the current requests are given graceful_timeout to finish
+            slow = socket.create_connection(('127.0.0.1',
+                                             int(url.split(':')[-1])))
+            slow.sendall('GET /slow HTTP/1.0\r\n\r\n')
+            time.sleep(.2)
+            os.kill(pid, signal.SIGTERM)
+            res = ''
+            data = slow.recv(1024)
+            while data:
+                res += data
+                data = slow.recv(1024)
+            slow.close()
+            self.assertTrue(res.startswith('HTTP/1.1 200'))
+            self.assertTrue(res.endswith('1'))
+            os.waitpid(pid, 0)
+            pid = None
+        finally:
+            if pid is not None:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
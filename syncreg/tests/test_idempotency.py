@@ -0,0 +1,136 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import shutil
+import tempfile
+import time
+import sqlite3
+import threading
+import unittest
+
+from syncreg.idempotency import (IdempotencyStore, SQLiteIdempotencyStore,
+                                 get_store)
+
+
+class TestIdempotency(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'keys.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _check_store(self, store):
+        self.assertEquals(store.claim('user:1', 'abc'), None)
+        # claimed, but not completed yet
+        self.assertEquals(store.claim('user:1', 'abc'),
+                          ('abc', None, None, None))
+        store.complete('user:1', 'abc', 200, None, '"user"')
+        self.assertEquals(store.claim('user:1', 'abc'),
+                          ('abc', 200, None, '"user"'))
+
+        # a released key can be claimed again
+        self.assertEquals(store.claim('user:2', 'def'), None)
+        store.release('user:2')
+        self.assertEquals(store.claim('user:2', 'def'), None)
+
+    def test_memory(self):
+        self._check_store(IdempotencyStore())
+
+    def test_sqlite(self):
+        self._check_store(SQLiteIdempotencyStore(self.path))
+
+    def test_shared(self):
+        # two workers sharing the database
+        first = SQLiteIdempotencyStore(self.path)
+        second = SQLiteIdempotencyStore(self.path)
+        self.assertEquals(first.claim('user:1', 'abc'), None)
+        self.assertEquals(second.claim('user:1', 'abc'),
+                          ('abc', None, None, None))
+        first.complete('user:1', 'abc', 400, 'application/json', '4')
+        self.assertEquals(second.claim('user:1', 'abc'),
+                          ('abc', 400, 'application/json', '4'))
+
+    def test_close(self):
+        store = SQLiteIdempotencyStore(self.path)
+        conns = [store._conn()]
+        thread = threading.Thread(target=lambda: conns.append(store._conn()))
+        thread.start()
+        thread.join()
+
+        # the connections of all the threads are closed
+        store.close()
+        for conn in conns:
+            self.assertRaises(sqlite3.ProgrammingError, conn.execute,
+                              'SELECT 1')
+        # and opened again when needed
+        self.assertEquals(store.claim('user:1', 'abc'), None)
+        self.assertTrue(store._conn() not in conns)
+
+    def test_expiration(self):
+        store = SQLiteIdempotencyStore(self.path, ttl=0.1, pending_ttl=0.1)
+        self.assertEquals(store.claim('user:1', 'abc'), None)
+        # the owner of the key never completed
+        time.sleep(0.2)
+        self.assertEquals(store.claim('user:1', 'abc'), None)
+        store.complete('user:1', 'abc', 200, None, '"user"')
+        time.sleep(0.2)
+        self.assertEquals(store.purge(), 1)
+
+        store = IdempotencyStore(ttl=0.1, pending_ttl=0.1)
+        self.assertEquals(store.claim('user:1', 'abc'), None)
+        time.sleep(0.2)
+        self.assertEquals(store.claim('user:1', 'abc'), None)
+
+    def test_max_keys(self):
+        store = SQLiteIdempotencyStore(self.path, max_keys=10)
+        for i in range(15):
+            store.claim('user:%d' % i, 'abc')
+            store.complete('user:%d' % i, 'abc', 200, None, '"user"')
+        self.assertEquals(store.purge(), 5)
+        # the oldest ones went first
+        other = SQLiteIdempotencyStore(self.path)
+        self.assertEquals(other.claim('user:0', 'abc'), None)
+        self.assertEquals(other.claim('user:14', 'abc')[1], 200)
+
+    def test_get_store(self):
+        self.assertTrue(isinstance(get_store({}), IdempotencyStore))
+        store = get_store({'idempotency.path': self.path,
+                           'idempotency.max_keys': 5})
+        self.assertTrue(isinstance(store, SQLiteIdempotencyStore))
+        self.assertEquals(store.max_keys, 5)
+        self.assertEquals(get_store({'idempotency.enabled': False}), None)
@@ -0,0 +1,152 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from syncreg import memory
+from syncreg.memory import MemoryProfiler, categorize, bench_memory
+
+
+class _Frame(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+
+
+class _Stat(object):
+
+    def __init__(self, filename, size, size_diff, count, count_diff):
+        self.traceback = [_Frame(filename)]
+        self.size = size
+        self.size_diff = size_diff
+        self.count = count
+        self.count_diff = count_diff
+
+
+class _Snapshot(object):
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def filter_traces(self, filters):
+        return self
+
+    def compare_to(self, baseline, key):
+        return self.stats
+
+
+class _Tracemalloc(object):
+    """Stands for the module, with fixed statistics."""
+    __file__ = 'tracemalloc.py'
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.tracing = False
+
+    def Filter(self, inclusive, pattern):
+        return (inclusive, pattern)
+
+    def is_tracing(self):
+        return self.tracing
+
+    def start(self, frames=1):
+        self.tracing = True
+
+    def stop(self):
+        self.tracing = False
+
+    def take_snapshot(self):
+        return _Snapshot(self.stats)
+
+    def get_traced_memory(self):
+        return sum([stat.size for stat in self.stats]), 0
+
+
+class TestMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.tracemalloc = memory.tracemalloc
+
+    def tearDown(self):
+        memory.tracemalloc = self.tracemalloc
+
+    def test_categorize(self):
+        root = '/usr/lib/python2.6/site-packages'
+        self.assertEquals(categorize(root + '/syncreg/controllers/user.py'),
+                          'controllers')
+        self.assertEquals(categorize(root + '/mako/template.py'),
+                          'templates')
+        self.assertEquals(categorize(root + '/sqlalchemy/pool.py'),
+                          'backends')
+        self.assertEquals(categorize(root + '/syncreg/util.py'), 'caches')
+        self.assertEquals(categorize(root + '/syncreg/wsgiapp.py'),
+                          'syncreg')
+        self.assertEquals(categorize(root + '/simplejson/decoder.py'),
+                          'libraries')
+        self.assertEquals(categorize('/usr/lib/python2.6/threading.py'),
+                          'stdlib')
+        self.assertEquals(categorize('<string>'), 'other')
+
+    def test_without_tracemalloc(self):
+        memory.tracemalloc = None
+        profiler = MemoryProfiler()
+        self.assertFalse(profiler.start())
+        report = profiler.report()
+        self.assertFalse(report['tracing'])
+        self.assertTrue(report['rss'] > 0)
+
+    def test_report(self):
+        memory.tracemalloc = _Tracemalloc([
+            _Stat('/x/syncreg/util.py', 1000, 800, 10, 8),
+            _Stat('/x/syncreg/idempotency.py', 500, 500, 5, 5),
+            _Stat('/x/syncreg/controllers/user.py', 200, -100, 2, -1)])
+        profiler = MemoryProfiler(top=2)
+        self.assertTrue(profiler.start())
+        report = profiler.report()
+        self.assertTrue(report['tracing'])
+        self.assertEquals(report['traced'], 1700)
+        self.assertEquals(report['categories']['caches'],
+                          {'size': 1500, 'size_diff': 1300, 'count': 15,
+                           'count_diff': 13})
+        self.assertEquals(report['categories']['controllers']['size_diff'],
+                          -100)
+        self.assertEquals([item['file'] for item in report['top']],
+                          ['/x/syncreg/util.py', '/x/syncreg/idempotency.py'])
+        profiler.log_report()
+
+    def test_bench(self):
+        results = dict(bench_memory(20000))
+        self.assertTrue(results['LRUCache entry'] > 0)
+        self.assertTrue(results['idempotency record'] > 0)
@@ -0,0 +1,167 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+from syncreg.pools import PoolStats, PoolMonitor
+
+
+class _Backend(object):
+    pass
+
+
+class _App(object):
+
+    def __init__(self, engine, config=None):
+        self.config = config or {}
+        self.auth = _Backend()
+        self.auth.backend = _Backend()
+        self.auth.backend._engine = engine
+        self.controllers = {}
+
+
+class TestPools(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.engine = create_engine(
+            'sqlite:///%s' % os.path.join(self.dir, 'pool.db'),
+            poolclass=QueuePool, pool_size=2, max_overflow=1,
+            pool_timeout=0.1)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.dir)
+
+    def test_stats(self):
+        monitor = PoolMonitor(_App(self.engine))
+        self.engine.execute('SELECT 1')
+        stats = monitor.stats()['pools']['auth']
+        self.assertEqual(stats['checkouts'], 1)
+        self.assertEqual(stats['connects'], 1)
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['checked_out'], 0)
+
+        # all the connections in use
+        conns = [self.engine.connect() for i in range(3)]
+        self.assertRaises(TimeoutError, self.engine.connect)
+        stats = monitor.pools['auth'].stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['checked_out'], 3)
+        # only the successful checkouts are counted, and timed
+        self.assertEqual(stats['checkouts'], 4)
+        self.assertTrue(stats['wait_max'] < 0.1)
+        for conn in conns:
+            conn.close()
+
+        # recycled connections
+        self.engine.pool._recycle = 0
+        self.engine.execute('SELECT 1')
+        self.assertTrue(monitor.pools['auth'].reconnects >= 1)
+
+    def test_dispose(self):
+        monitor = PoolMonitor(_App(self.engine))
+        self.engine.execute('SELECT 1')
+        self.engine.dispose()
+        monitor.instrument()
+        monitor.instrument()
+        self.engine.execute('SELECT 1')
+        stats = monitor.pools['auth']
+        self.assertEqual(stats.checkouts, 2)
+        self.assertEqual(len([listener for listener
+                              in self.engine.pool.listeners
+                              if listener is stats]), 1)
+        self.assertEqual(self.engine.pool._creator.wrapped.__name__,
+                         'connect')
+
+    def test_connect_failures(self):
+        stats = PoolStats('auth')
+
+        def _fail():
+            raise IOError()
+        pool = QueuePool(_fail)
+        stats.instrument(pool)
+        self.assertRaises(IOError, pool.connect)
+        self.assertEqual(stats.connect_failures, 1)
+        # neither a timeout nor a checkout
+        self.assertEqual(stats.timeouts, 0)
+        self.assertEqual(stats.checkouts, 0)
+
+    def test_adaptive(self):
+        stats = PoolStats('auth', adaptive=True, target_wait=0.01,
+                          interval=0, max_overflow=3)
+        stats.instrument(self.engine.pool)
+
+        stats._checked_out(0.5)
+        self.assertEqual(self.engine.pool._max_overflow, 2)
+        stats._checked_out(0.5)
+        stats._checked_out(0.5)
+        self.assertEqual(self.engine.pool._max_overflow, 3)
+
+        # idle: back to the configured overflow
+        for i in range(5):
+            stats._checked_out(0)
+        self.assertEqual(self.engine.pool._max_overflow, 1)
+        self.assertEqual(stats.resized, 4)
+
+    def test_in_flight(self):
+        monitor = PoolMonitor(_App(self.engine, {'pool.warn_interval': 0}))
+        warned = []
+        monitor._check_capacity = warned.append
+        started = threading.Event()
+        finish = threading.Event()
+
+        def _slow(request):
+            started.set()
+            finish.wait()
+
+        slow = monitor.wrap('user_exists', _slow)
+        thread = threading.Thread(target=slow, args=(None,))
+        thread.start()
+        started.wait()
+        self.assertEqual(monitor.in_flight, 1)
+        finish.set()
+        thread.join()
+        self.assertEqual(monitor.in_flight, 0)
+        self.assertEqual(monitor.stats()['in_flight_max'], 1)
+        self.assertEqual(warned, [1])
@@ -0,0 +1,102 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import (create_engine, MetaData, Table, Column, Integer,
+                        String, select)
+
+from services.user import extract_username
+
+from syncreg.backends.sharded import HashRing, shard_id
+from syncreg.populate import Populator
+
+
+class TestPopulate(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.uris = ['sqlite:///%s' % os.path.join(self.dir, 'shard%d.db' % i)
+                     for i in range(2)]
+        for sqluri in self.uris:
+            table = Table('users', MetaData(),
+                          Column('id', Integer, primary_key=True),
+                          Column('username', String(32), unique=True),
+                          Column('email', String(255)),
+                          Column('password_hash', String(128)),
+                          Column('status', Integer))
+            table.create(bind=create_engine(sqluri))
+        self.template = {'password_hash': '{SSHA}xxx', 'status': 1}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _rows(self, sqluri):
+        engine = create_engine(sqluri)
+        table = Table('users', MetaData(), autoload=True,
+                      autoload_with=engine)
+        return engine.execute(select([table])).fetchall()
+
+    def test_populate(self):
+        written = []
+        populator = Populator(self.uris[:1], self.template, batch_size=7)
+        self.assertEqual(populator.run(20, callback=written.append), 20)
+        rows = self._rows(self.uris[0])
+        self.assertEqual(len(rows), 20)
+        self.assertEqual(rows[3]['email'], 'populate3@example.com')
+        self.assertEqual(rows[3]['username'],
+                         extract_username('populate3@example.com'))
+        self.assertEqual(rows[3]['password_hash'], '{SSHA}xxx')
+        self.assertEqual(written, [row['username'] for row in rows])
+
+        # the next users
+        self.assertEqual(populator.run(5, start=20), 5)
+        self.assertEqual(len(self._rows(self.uris[0])), 25)
+
+    def test_shards(self):
+        populator = Populator(self.uris, self.template, batch_size=10)
+        self.assertEqual(populator.run(100), 100)
+        ring = HashRing([shard_id(sqluri) for sqluri in self.uris])
+        total = 0
+        for sqluri in self.uris:
+            rows = self._rows(sqluri)
+            total += len(rows)
+            for row in rows:
+                self.assertEqual(ring.get_node(row['username']),
+                                 shard_id(sqluri))
+        self.assertEqual(total, 100)
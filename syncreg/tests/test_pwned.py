@@ -0,0 +1,102 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import shutil
+import tempfile
+import unittest
+from hashlib import sha1
+
+from syncreg.pwned import (PasswordCorpus, CorpusError, build_corpus,
+                           _bloom_bits)
+
+
+class TestPasswordCorpus(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'pwned.sha1')
+        self.bloom = os.path.join(self.tempdir, 'pwned.bloom')
+        self.passwords = ['password%d' % i for i in range(1000)]
+        lines = sorted(['%s:%d' % (sha1(password).hexdigest().upper(), i)
+                        for i, password in enumerate(self.passwords)])
+        self.lines = [line + '\n' for line in lines]
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_lookup(self):
+        self.assertEqual(build_corpus(self.lines, self.path, self.bloom),
+                         1000)
+        for bloom in (None, self.bloom):
+            corpus = PasswordCorpus(self.path, bloom)
+            self.assertEqual(len(corpus), 1000)
+            for password in self.passwords:
+                self.assertTrue(corpus.is_compromised(password))
+            self.assertTrue(corpus.is_compromised(u'password1'))
+            for i in range(1000):
+                self.assertFalse(corpus.is_compromised('other%d' % i))
+
+    def test_bloom(self):
+        build_corpus(self.lines, self.path, self.bloom)
+        corpus = PasswordCorpus(self.path, self.bloom)
+        for password in self.passwords:
+            self.assertTrue(sha1(password).digest() in corpus.bloom)
+        false_positives = [i for i in range(10000)
+                           if sha1('other%d' % i).digest() in corpus.bloom]
+        self.assertTrue(len(false_positives) < 300)
+
+    def test_large_bloom(self):
+        # the bits of the filters larger than 2 ** 32 bits are all reachable
+        bits = 2 ** 36
+        indexes = []
+        for password in self.passwords:
+            indexes.extend(_bloom_bits(sha1(password).digest(), bits, 5))
+        self.assertTrue(max(indexes) >= 2 ** 32)
+        self.assertTrue(max(indexes) < bits)
+
+    def test_build_errors(self):
+        self.assertRaises(CorpusError, build_corpus,
+                          list(reversed(self.lines)), self.path)
+        self.assertRaises(CorpusError, build_corpus, ['ABCD\n'], self.path)
+
+        # duplicates and blank lines are skipped
+        self.assertEqual(build_corpus(self.lines[:2] + ['\n'] +
+                                      self.lines[1:3], self.path), 3)
+
+        f = open(self.path, 'ab')
+        f.write('x')
+        f.close()
+        self.assertRaises(CorpusError, PasswordCorpus, self.path)
@@ -0,0 +1,187 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import shutil
+import time
+import tempfile
+import unittest
+
+from syncreg.reload import ConfigReloader, read_config
+from syncreg.util import changed_sections
+
+
+_CONFIG = """\
+[global]
+shared_secret = secret
+
+[nodes]
+fallback_node = %s
+
+[breaker]
+cache_size = 10
+"""
+
+
+class _Pools(object):
+
+    def __init__(self):
+        self.instrumented = 0
+
+    def instrument(self):
+        self.instrumented += 1
+
+
+class _Resource(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class _Controller(object):
+
+    def __init__(self, app, config=None, previous=None):
+        self.config = config or app.config
+        self.previous = previous
+        self.reset = None
+        self.events = _Resource()
+        self.idempotency = None
+        if previous is None:
+            self.cache = _Resource()
+        else:
+            self.cache = previous.cache
+
+
+class _App(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.pools = _Pools()
+        self.controllers = {}
+        self.controllers['user'] = _Controller(self)
+
+
+class TestReload(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'sync.conf')
+        self._write('http://node1')
+        config = read_config(self.path)
+        config['debug'] = True
+        self.app = _App(config)
+        self.reloader = ConfigReloader(self.app, self.path)
+        self.reloader.close_delay = 0.1
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, node):
+        f = open(self.path, 'w')
+        try:
+            f.write(_CONFIG % node)
+        finally:
+            f.close()
+
+    def test_changed_sections(self):
+        old = {'a.x': 1, 'b.x': 2, 'c.x': 3, 'debug': True}
+        new = {'a.x': 1, 'b.x': 3, 'd.x': 4, 'debug': False}
+        self.assertEquals(changed_sections(old, new), ['b', 'c', 'd'])
+        self.assertEquals(changed_sections(old, dict(old)), [])
+
+    def test_read_config(self):
+        config = read_config(self.path)
+        self.assertEquals(config['nodes.fallback_node'], 'http://node1')
+        self.assertEquals(config['breaker.cache_size'], 10)
+        self.assertRaises(IOError, read_config,
+                          os.path.join(self.dir, 'missing.conf'))
+
+    def test_config_file(self):
+        app = _App({'configuration': 'file:/etc/sync/sync.conf'})
+        self.assertEquals(ConfigReloader(app).path, '/etc/sync/sync.conf')
+        app.config['reload.config_file'] = '/tmp/sync.conf'
+        self.assertEquals(ConfigReloader(app).path, '/tmp/sync.conf')
+        self.assertEquals(ConfigReloader(_App({})).path, None)
+
+    def test_reload(self):
+        old = self.app.controllers['user']
+        # nothing changed, nothing is rebuilt
+        self.assertEquals(self.reloader.reload(), [])
+        self.assertTrue(self.app.controllers['user'] is old)
+
+        called = []
+        self.reloader.callbacks.append(called.append)
+        self._write('http://node2')
+        self.assertEquals(self.reloader.reload(), ['nodes'])
+
+        new = self.app.controllers['user']
+        self.assertTrue(new is not old)
+        self.assertTrue(new.previous is old)
+        self.assertEquals(called, [new])
+        self.assertEquals(new.config['nodes.fallback_node'], 'http://node2')
+        self.assertTrue(self.app.config is new.config)
+        # the options that don't come from the file are kept
+        self.assertTrue(self.app.config['debug'])
+        # the old controller keeps its configuration for the requests
+        # still using it
+        self.assertEquals(old.config['nodes.fallback_node'], 'http://node1')
+        self.assertEquals(self.app.pools.instrumented, 1)
+        self.assertEquals(self.reloader.reloads, 1)
+
+        # the resources that were not reused are closed, once the
+        # requests running on the old controller are done
+        self.assertFalse(old.events.closed)
+        time.sleep(0.3)
+        self.assertTrue(old.events.closed)
+        self.assertFalse(new.events.closed)
+        self.assertFalse(new.cache.closed)
+
+    def test_failed_reload(self):
+        old = self.app.controllers['user']
+        config = self.app.config
+        f = open(self.path, 'w')
+        try:
+            f.write('[nodes\nbroken')
+        finally:
+            f.close()
+        self.assertRaises(Exception, self.reloader.reload)
+        # a background reload only logs the failure
+        self.reloader.start().join()
+        self.assertTrue(self.app.controllers['user'] is old)
+        self.assertTrue(self.app.config is config)
+        self.assertEquals(self.reloader.reloads, 0)
@@ -0,0 +1,102 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import time
+import socket
+import unittest
+
+from recaptcha.client import captcha
+
+from syncreg.remote import send_email, submit_captcha
+from syncreg.stubs import SMTPStub, CaptchaStub
+
+
+class TestRemote(unittest.TestCase):
+
+    def setUp(self):
+        # a server accepting connections but never answering
+        self.hung = socket.socket()
+        self.hung.bind(('localhost', 0))
+        self.hung.listen(5)
+        self.hung_port = self.hung.getsockname()[1]
+
+    def tearDown(self):
+        self.hung.close()
+
+    def test_send_email(self):
+        stub = SMTPStub('localhost', 0)
+        stub.start()
+        try:
+            res = send_email('weave@mozilla.com', 'bob@example.com', u'reset',
+                             u'hello', 'localhost', stub.port, timeout=5)
+            self.assertEqual(res, (True, None))
+            self.assertEqual(stub.received, 1)
+        finally:
+            stub.stop()
+
+        start = time.time()
+        res, msg = send_email('weave@mozilla.com', 'bob@example.com',
+                              u'reset', u'hello', 'localhost',
+                              self.hung_port, timeout=0.2)
+        self.assertFalse(res)
+        self.assertTrue(time.time() - start < 2)
+
+    def test_submit_captcha(self):
+        stub = CaptchaStub('localhost', 0)
+        stub.start()
+        server = 'localhost:%d' % stub.port
+        default = captcha.VERIFY_SERVER
+        try:
+            resp = submit_captcha('x', 'ok', 'key', '127.0.0.1', timeout=5,
+                                  verify_server=server)
+            self.assertTrue(resp.is_valid)
+            resp = submit_captcha('x', 'invalid', 'key', '127.0.0.1',
+                                  timeout=5, verify_server=server)
+            self.assertFalse(resp.is_valid)
+            self.assertEqual(resp.error_code, 'incorrect-captcha-sol')
+            # no solution, no call
+            self.assertFalse(submit_captcha('x', '', 'key', '',
+                                            verify_server=server).is_valid)
+            self.assertEqual(stub.received, 2)
+        finally:
+            stub.stop()
+        # the server is given per call
+        self.assertEqual(captcha.VERIFY_SERVER, default)
+
+        start = time.time()
+        self.assertRaises(IOError, submit_captcha, 'x', 'ok', 'key',
+                          '127.0.0.1', timeout=0.2,
+                          verify_server='localhost:%d' % self.hung_port)
+        self.assertTrue(time.time() - start < 2)
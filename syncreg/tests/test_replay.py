@@ -0,0 +1,148 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import time
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from syncreg.replay import (parse_log, RouteMatcher, UserMapper, schedule,
+                            Replayer)
+from syncreg.wsgiapp import urls
+
+
+_LOG = """\
+10.0.0.1 - - [12/Mar/2012:10:00:00 +0000] "GET /user/1.0/aaaa HTTP/1.1" \
+200 1 "-" "Firefox/10.0"
+10.0.0.2 - - [12/Mar/2012:10:00:00 +0000] "GET /user/1.0/bbbb/node/weave \
+HTTP/1.1" 200 30 "-" "Firefox/10.0"
+garbage
+10.0.0.1 - - [12/Mar/2012:10:00:01 +0000] "PUT /user/1.0/cccc HTTP/1.1" \
+200 4 "-" "Firefox/10.0"
+10.0.0.3 - - [12/Mar/2012:10:00:02 +0000] "GET /user/1.0/aaaa/password_reset\
+ HTTP/1.1" 200 7 "-" "Firefox/10.0"
+10.0.0.3 - - [12/Mar/2012:10:00:02 +0000] "GET /boom HTTP/1.1" 200 7 "-" "-"
+"""
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path == '/boom':
+            self.send_response(500)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _Server(('localhost', 0), _Handler)
+        self.server.paths = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.url = 'http://localhost:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_parse(self):
+        requests = list(parse_log(_LOG.splitlines()))
+        self.assertEqual([path for __, __, path in requests],
+                         ['/user/1.0/aaaa', '/user/1.0/bbbb/node/weave',
+                          '/user/1.0/aaaa/password_reset', '/boom'])
+        self.assertEqual(requests[2][0] - requests[0][0], 2)
+
+        requests = list(parse_log(_LOG.splitlines(), ('PUT',)))
+        self.assertEqual(len(requests), 1)
+
+    def test_routes(self):
+        matcher = RouteMatcher(urls)
+        self.assertEqual(matcher.match('GET', '/user/1.0/aaaa'),
+                         'GET user_exists')
+        self.assertEqual(matcher.match('GET', '/user/1/aaaa/node/weave'),
+                         'GET user_node')
+        self.assertEqual(matcher.match('DELETE', '/user/1.0/a/password_reset'),
+                         'DELETE delete_password_reset')
+        self.assertEqual(matcher.match('POST', '/misc/1.0/captcha_html?x=1'),
+                         'POST captcha_form')
+        self.assertEqual(matcher.match('GET', '/user/2.0/aaaa'), 'other')
+
+    def test_users(self):
+        mapper = UserMapper(['bob', 'sam'])
+        path = mapper('/user/1.0/aaaa/node/weave')
+        self.assertTrue(path in ('/user/1.0/bob/node/weave',
+                                 '/user/1.0/sam/node/weave'))
+        self.assertEqual(mapper('/user/1.0/aaaa/node/weave'), path)
+        self.assertEqual(mapper('/__health__'), '/__health__')
+
+    def test_schedule(self):
+        requests = list(parse_log(_LOG.splitlines()))
+        delays = [delay for delay, __, __ in schedule(requests, 2.)]
+        self.assertEqual(delays, [0., 0., 1., 1.])
+        delays = [delay for delay, __, __ in schedule(requests, rate=100)]
+        self.assertEqual(delays, sorted(delays))
+
+    def test_replay(self):
+        requests = parse_log(_LOG.splitlines())
+        replayer = Replayer(self.url, RouteMatcher(urls), 2,
+                            rewrite=UserMapper(['bob']))
+        start = time.time()
+        results = replayer.run(schedule(requests, 100.))
+        self.assertTrue(time.time() - start >= 0.02)
+        self.assertEqual(sorted(self.server.paths),
+                         ['/boom', '/user/1.0/bob', '/user/1.0/bob/node/weave',
+                          '/user/1.0/bob/password_reset'])
+        self.assertEqual(results['GET user_exists']['requests'], 1)
+        self.assertEqual(results['GET user_exists']['errors'], 0)
+        self.assertEqual(results['other']['errors'], 1)
+
+        results = replayer.run(schedule(parse_log(_LOG.splitlines())),
+                               closed=True)
+        self.assertEqual(results['GET user_node']['requests'], 1)
+        self.assertEqual(len(self.server.paths), 8)
@@ -0,0 +1,144 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from services.exceptions import BackendError
+from services.user import User
+
+from syncreg.backends.replicated import ReplicatedSQLUser
+from syncreg.stubs import MemcacheStub
+
+
+class FakeSQLUser(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = []
+        self.broken = False
+
+    def _call(self, method):
+        if self.broken:
+            raise BackendError()
+        self.calls.append(method)
+        return self.name
+
+    def get_user_id(self, user):
+        return self._call('get_user_id')
+
+    def get_user_info(self, user, attrs):
+        return self._call('get_user_info')
+
+    def authenticate_user(self, user, password):
+        return self._call('authenticate_user')
+
+    def update_password(self, user, password, new_password):
+        return self._call('update_password')
+
+
+class TestReplicated(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = ReplicatedSQLUser('sqlite:////tmp/primary.db',
+                                         sticky_seconds=60)
+        self.backend.primary = self.primary = FakeSQLUser('primary')
+        self.backend.replicas = self.replicas = [FakeSQLUser('replica0'),
+                                                 FakeSQLUser('replica1')]
+
+    def test_round_robin(self):
+        user = User('tarek')
+        read = [self.backend.get_user_id(user) for i in range(4)]
+        self.assertEquals(read, ['replica0', 'replica1'] * 2)
+        self.assertEquals(self.backend.get_user_info(user, ['mail']),
+                          'replica0')
+        self.assertEquals(self.backend.authenticate_user(user, 'xxx'),
+                          'primary')
+
+    def test_failing_replica(self):
+        user = User('tarek')
+        self.replicas[0].broken = True
+        read = [self.backend.get_user_id(user) for i in range(4)]
+        self.assertEquals(read, ['replica1'] * 4)
+
+        # no replica left
+        self.replicas[1].broken = True
+        self.assertEquals(self.backend.get_user_id(user), 'primary')
+
+        # the replicas are tried again after a while
+        self.replicas[0].broken = self.replicas[1].broken = False
+        self.backend._down = {}
+        self.assertTrue(self.backend.get_user_id(user).startswith('replica'))
+
+    def test_sticky_after_write(self):
+        user = User('tarek')
+        self.assertEquals(self.backend.update_password(user, 'x', 'y'),
+                          'primary')
+        self.assertEquals(self.backend.get_user_id(user), 'primary')
+
+        # other users still read from the replicas
+        self.assertTrue(self.backend.get_user_id(User('bob'))
+                        .startswith('replica'))
+
+        self.backend._written.clear()
+        self.assertTrue(self.backend.get_user_id(user).startswith('replica'))
+
+    def test_shared_stickiness(self):
+        stub = MemcacheStub('127.0.0.1:0')
+        stub.start()
+        try:
+            # two workers
+            workers = []
+            for i in range(2):
+                backend = ReplicatedSQLUser('sqlite:////tmp/primary.db',
+                                            sticky_seconds=60,
+                                            sticky_servers=stub.bind)
+                backend.primary = self.primary
+                backend.replicas = self.replicas
+                workers.append(backend)
+
+            user = User('tarek')
+            workers[0].update_password(user, 'x', 'y')
+            # the other worker reads the user from the primary too
+            self.assertEquals(workers[1].get_user_id(user), 'primary')
+            self.assertTrue(workers[1].get_user_id(User('bob'))
+                            .startswith('replica'))
+        finally:
+            stub.stop()
+
+    def test_check_before_write(self):
+        user = User('tarek')
+        self.assertEquals(self.backend.get_user_id_for_write(user),
+                          'primary')
+        self.assertEquals(self.primary.calls, ['get_user_id'])
@@ -0,0 +1,240 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import time
+import shutil
+import threading
+import tempfile
+import unittest
+
+from services.resetcodes import AlreadySentError
+
+from syncreg.backends.resetcodes import SQLiteResetCode
+from syncreg.bench import bench_resetcodes
+
+
+class TestSQLiteResetCode(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'reset.db')
+        self.user = {'username': 'bob'}
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _backend(self, **kw):
+        return SQLiteResetCode(self.path, **kw)
+
+    def test_codes(self):
+        backend = self._backend()
+        code = backend.generate_reset_code(self.user)
+        self.assertFalse(backend.verify_reset_code(self.user, 'XXXX'))
+        self.assertFalse(backend.verify_reset_code({'username': 'sam'}, code))
+        self.assertTrue(backend.verify_reset_code(self.user, code))
+        self.assertTrue(backend.verify_reset_code(self.user, code.lower()))
+
+        # the codes survive a restart
+        self.assertTrue(self._backend().verify_reset_code(self.user, code))
+
+        backend.clear_reset_code(self.user)
+        self.assertFalse(backend.verify_reset_code(self.user, code))
+
+    def test_batch(self):
+        backend = self._backend(max_codes=3)
+        users = [{'username': 'user%d' % i} for i in range(5)]
+        old = backend.generate_reset_code(users[0])
+        codes = backend.generate_reset_codes(users)
+        self.assertEquals(len(set(codes)), 5)
+        # the previous code was replaced
+        self.assertFalse(backend.verify_reset_code(users[0], old))
+        # past max_codes, the first ones were dropped
+        valid = [backend.verify_reset_code(user, code)
+                 for user, code in zip(users, codes)]
+        self.assertEquals(valid.count(True), 3)
+
+    def test_already_sent(self):
+        backend = self._backend()
+        code = backend.generate_reset_code(self.user)
+        self.assertRaises(AlreadySentError, backend.generate_reset_code,
+                          self.user)
+        new_code = backend.generate_reset_code(self.user, overwrite=True)
+        self.assertFalse(backend.verify_reset_code(self.user, code))
+        self.assertTrue(backend.verify_reset_code(self.user, new_code))
+
+        backend = self._backend(resend_delay=0)
+        backend.generate_reset_code(self.user)
+
+    def test_use_unlocked(self):
+        backend = self._backend(resend_delay=0, timeout=0.1)
+        code = backend.generate_reset_code(self.user)
+        other = {'username': 'other'}
+        codes = []
+
+        def _update():
+            # the database is not locked while update runs
+            thread = threading.Thread(
+                    target=lambda: codes.append(
+                        backend.generate_reset_code(other)))
+            thread.start()
+            thread.join()
+            # nor is the code live anymore
+            self.assertFalse(backend.verify_reset_code(self.user, code))
+            codes.append(backend.generate_reset_code(self.user))
+            raise IOError()
+
+        self.assertRaises(IOError, backend.use_reset_code, self.user, code,
+                          _update)
+        self.assertTrue(backend.verify_reset_code(other, codes[0]))
+        # a code generated meanwhile is not replaced by the old one
+        self.assertTrue(backend.verify_reset_code(self.user, codes[1]))
+        self.assertFalse(backend.verify_reset_code(self.user, code))
+
+    def test_use(self):
+        backend = self._backend()
+        code = backend.generate_reset_code(self.user)
+        calls = []
+
+        def _update():
+            calls.append(1)
+
+        def _fail():
+            raise IOError()
+
+        self.assertFalse(backend.use_reset_code(self.user, 'X', _update))
+        self.assertEqual(calls, [])
+
+        # the code survives a failed update
+        self.assertRaises(IOError, backend.use_reset_code, self.user, code,
+                          _fail)
+        self.assertTrue(backend.verify_reset_code(self.user, code))
+
+        self.assertTrue(backend.use_reset_code(self.user, code, _update))
+        self.assertFalse(backend.use_reset_code(self.user, code, _update))
+        self.assertEqual(calls, [1])
+        self.assertEqual(len(backend._expires), 0)
+
+    def test_use_concurrent(self):
+        backend = self._backend()
+        code = backend.generate_reset_code(self.user)
+        calls = []
+        results = []
+
+        def _update():
+            calls.append(1)
+            time.sleep(0.1)
+
+        def _use():
+            # each thread has its own connection, like another worker
+            results.append(backend.use_reset_code(self.user, code, _update))
+
+        threads = [threading.Thread(target=_use) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [False] * 4 + [True])
+        self.assertEqual(calls, [1])
+
+    def test_expiration(self):
+        backend = self._backend(expiration=-1)
+        code = backend.generate_reset_code(self.user)
+        self.assertFalse(backend.verify_reset_code(self.user, code))
+        self.assertEqual(backend.purge(), 1)
+        count = backend._conn().execute('SELECT COUNT(*) FROM reset_codes')
+        self.assertEqual(count.fetchone()[0], 0)
+
+    def test_max_codes(self):
+        backend = self._backend(max_codes=10, resend_delay=0)
+        codes = {}
+        for i in range(15):
+            user = {'username': 'user%d' % i}
+            codes[i] = backend.generate_reset_code(user)
+            time.sleep(0.001)
+        self.assertEqual(len(backend._expires), 10)
+
+        # the codes closest to their expiration were dropped
+        for i in range(15):
+            user = {'username': 'user%d' % i}
+            self.assertEqual(backend.verify_reset_code(user, codes[i]),
+                             i >= 5)
+
+        self.assertEqual(backend.evictions, 5)
+
+        # regenerating codes doesn't grow the heap for ever
+        for i in range(100):
+            backend.generate_reset_code(self.user)
+        self.assertTrue(len(backend._heap) < 100)
+
+    def test_other_processes(self):
+        backend = self._backend(resend_delay=0)
+        backend.purge()
+        # codes generated by another worker, recycled since
+        worker = self._backend(expiration=0.5, resend_delay=0)
+        for i in range(5):
+            worker.generate_reset_code({'username': 'user%d' % i})
+        worker.expiration = 3600
+        code = worker.generate_reset_code(self.user)
+        time.sleep(0.6)
+
+        # not in the index of this process, but swept
+        self.assertEqual(backend.purge(), 0)
+        backend._next_sweep = 0
+        self.assertEqual(backend.purge(), 5)
+        self.assertTrue(backend.verify_reset_code(self.user, code))
+
+        # a forked process loads the index
+        backend._pid = None
+        backend.purge()
+        self.assertEqual(backend._expires.keys(), ['bob'])
+
+    def test_sweep_max_codes(self):
+        workers = [self._backend(max_codes=10, resend_delay=0)
+                   for i in range(2)]
+        for i in range(16):
+            workers[i % 2].generate_reset_code({'username': 'user%d' % i})
+            time.sleep(0.001)
+        self.assertEqual(workers[0].sweep(), 6)
+        self.assertEqual(workers[0].evictions, 6)
+        count = workers[0]._conn().execute('SELECT COUNT(*) FROM '
+                                           'reset_codes')
+        self.assertEqual(count.fetchone()[0], 10)
+
+    def test_bench(self):
+        generate, verify = bench_resetcodes(self._backend(), 50, 2)
+        self.assertEqual(generate['requests'], 50)
+        self.assertEqual(generate['errors'], 0)
+        self.assertEqual(verify['errors'], 0)
@@ -0,0 +1,190 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import signal
+import socket
+import time
+import threading
+import unittest
+import urllib2
+
+from syncreg.server import Arbiter, parse_bind
+from syncreg.warmup import Warmup
+
+
+def _app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+
+
+class _Reloader(object):
+
+    def __init__(self):
+        self.reloads = 0
+
+    def reload(self):
+        self.reloads += 1
+        return ['nodes']
+
+
+class _Auth(object):
+    backend = None
+
+
+class _ReloadableApp(object):
+
+    def __init__(self):
+        self.auth = _Auth()
+        self.controllers = {}
+        self.reloader = _Reloader()
+
+    def __call__(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['%d %d' % (os.getpid(), self.reloader.reloads)]
+
+
+class _StuckWarmup(Warmup):
+
+    def __init__(self, app):
+        Warmup.__init__(self, app)
+        self.unblock = threading.Event()
+
+    def run(self):
+        # like a connect that does not return
+        self.unblock.wait()
+        return False
+
+
+class _WarmingApp(_ReloadableApp):
+
+    def __init__(self):
+        _ReloadableApp.__init__(self)
+        self.config = {'warmup.retry_delay': 30}
+        self.warmup = _StuckWarmup(self)
+        self.warmup.start()
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestServer(unittest.TestCase):
+
+    def test_parse_bind(self):
+        self.assertEquals(parse_bind('unix:/tmp/x.sock'),
+                          (socket.AF_UNIX, '/tmp/x.sock'))
+        self.assertEquals(parse_bind('127.0.0.1:5000'),
+                          (socket.AF_INET, ('127.0.0.1', 5000)))
+        self.assertEquals(parse_bind(':5000'),
+                          (socket.AF_INET, ('0.0.0.0', 5000)))
+
+    def test_load_joins_warmup(self):
+        apps = []
+
+        def _loader():
+            apps.append(_WarmingApp())
+            return apps[-1]
+
+        arbiter = Arbiter(_loader, graceful_timeout=0.1)
+        # no fork while the warm-up thread runs
+        self.assertRaises(RuntimeError, arbiter.load)
+        apps[-1].warmup.unblock.set()
+        self.assertTrue(apps[-1].warmup.join(1))
+
+        # the thread does not wait for the retry delay to exit
+        app = _WarmingApp()
+        app.warmup.unblock.set()
+        start = time.time()
+        self.assertTrue(app.warmup.join(5))
+        self.assertTrue(time.time() - start < 5)
+
+    def _get(self, url):
+        # the workers may not be up yet
+        for i in range(50):
+            try:
+                return urllib2.urlopen(url).read()
+            except urllib2.URLError:
+                time.sleep(.1)
+        raise AssertionError('Server not reachable')
+
+    def test_workers_are_recycled(self):
+        port = _free_port()
+        url = 'http://127.0.0.1:%d/' % port
+        pid = os.fork()
+        if pid == 0:
+            try:
+                Arbiter(lambda: _app, '127.0.0.1:%d' % port, workers=1,
+                        max_requests=2).run()
+            finally:
+                os._exit(0)
+
+        try:
+            pids = [self._get(url) for i in range(6)]
+            # each worker serves two requests before being replaced
+            self.assertEquals(len(set(pids)), 3)
+            self.assertTrue(str(pid) not in pids)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+    def test_hot_reload(self):
+        port = _free_port()
+        url = 'http://127.0.0.1:%d/' % port
+        pid = os.fork()
+        if pid == 0:
+            try:
+                Arbiter(_ReloadableApp, '127.0.0.1:%d' % port, workers=1,
+                        hot_reload=True).run()
+            finally:
+                os._exit(0)
+
+        try:
+            worker, reloads = self._get(url).split()
+            self.assertEquals(reloads, '0')
+            os.kill(pid, signal.SIGHUP)
+            for i in range(50):
+                if self._get(url).split()[1] == '1':
+                    break
+                time.sleep(.1)
+            # the same worker reloaded its configuration
+            self.assertEquals(self._get(url).split(), [worker, '1'])
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
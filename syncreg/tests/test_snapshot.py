@@ -0,0 +1,92 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import shutil
+import tempfile
+import unittest
+
+from syncreg.snapshot import (write_snapshot, NodeSnapshot, SnapshotError,
+                              KEY_SIZE)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'nodes.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_lookup(self):
+        entries = [('user%d' % i, 'node%d' % (i % 3)) for i in range(500)]
+        entries.append(('x' * (KEY_SIZE + 1), 'node0'))
+        entries.append(('nonode', None))
+        self.assertEqual(write_snapshot(self.path, reversed(entries)), 500)
+
+        snapshot = NodeSnapshot(self.path)
+        self.assertEqual(len(snapshot), 500)
+        for i in range(500):
+            self.assertEqual(snapshot.get('user%d' % i), 'node%d' % (i % 3))
+        self.assertEqual(snapshot.get(u'user1'), 'node1')
+        for username in ('user', 'user5000', 'a', 'zzz', 'nonode',
+                         'x' * (KEY_SIZE + 1)):
+            self.assertEqual(snapshot.get(username), None)
+
+    def test_refresh(self):
+        snapshot = NodeSnapshot(self.path, check_interval=0)
+        self.assertEqual(snapshot.get('bob'), None)
+
+        write_snapshot(self.path, [('bob', 'node1')])
+        self.assertEqual(snapshot.get('bob'), 'node1')
+        self.assertFalse(snapshot.refresh())
+
+        write_snapshot(self.path, [('bob', 'node2'), ('sam', 'node1')])
+        os.utime(self.path, (0, 0))
+        self.assertEqual(snapshot.get('bob'), 'node2')
+        self.assertEqual(snapshot.get('sam'), 'node1')
+
+        # a broken file is not used, the previous mapping stays
+        broken = self.path + '.broken'
+        f = open(broken, 'wb')
+        f.write('garbage' * 10)
+        f.close()
+        os.rename(broken, self.path)
+        self.assertRaises(SnapshotError, snapshot.refresh)
+        self.assertEqual(snapshot.get('bob'), 'node2')
+
+        os.remove(self.path)
+        self.assertEqual(snapshot.get('bob'), None)
@@ -0,0 +1,86 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import socket
+import smtplib
+import urllib2
+import unittest
+
+from syncreg.stubs import SMTPStub, CaptchaStub, MemcacheStub
+
+
+class TestStubs(unittest.TestCase):
+
+    def test_smtp(self):
+        stub = SMTPStub('localhost', 0)
+        stub.start()
+        try:
+            server = smtplib.SMTP('localhost', stub.port, timeout=5)
+            server.sendmail('weave@mozilla.com', ['bob@example.com'],
+                            'Subject: reset\n\nhello')
+            server.quit()
+            self.assertEqual(stub.received, 1)
+        finally:
+            stub.stop()
+
+    def test_captcha(self):
+        stub = CaptchaStub('localhost', 0)
+        stub.start()
+        url = 'http://localhost:%d/recaptcha/api/verify' % stub.port
+        try:
+            res = urllib2.urlopen(url, 'challenge=x&response=ok').read()
+            self.assertEqual(res.splitlines()[0], 'true')
+            res = urllib2.urlopen(url, 'challenge=x&response=invalid').read()
+            self.assertEqual(res.splitlines()[0], 'false')
+            self.assertEqual(stub.received, 2)
+        finally:
+            stub.stop()
+
+    def test_memcache(self):
+        stub = MemcacheStub('localhost:0')
+        stub.start()
+        host, port = stub.bind.split(':')
+        try:
+            sock = socket.create_connection((host, int(port)), 5)
+            sock.sendall('set key 0 0 5\r\nvalue\r\nget key other\r\n')
+            expected = 'STORED\r\nVALUE key 0 5\r\nvalue\r\nEND\r\n'
+            res = ''
+            while len(res) < len(expected):
+                res += sock.recv(1024)
+            self.assertEqual(res, expected)
+            sock.close()
+            self.assertEqual(stub.commands, {'set': 1, 'get': 1})
+        finally:
+            stub.stop()
@@ -0,0 +1,138 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import time
+import unittest
+
+from syncreg.throttle import FailureThrottle, get_throttle, client_ip
+
+
+class FakeRequest(object):
+
+    def __init__(self, remote_addr, forwarded=None):
+        self.remote_addr = remote_addr
+        self.environ = {'REMOTE_ADDR': remote_addr}
+        if forwarded is not None:
+            self.environ['HTTP_X_FORWARDED_FOR'] = forwarded
+
+
+class TestFailureThrottle(unittest.TestCase):
+
+    def test_user_lockout(self):
+        throttle = FailureThrottle(max_failures=3, max_ip_failures=100,
+                                   window=0.5)
+        self.assertEquals(throttle.failure('bob', '10.0.0.1'), [])
+        self.assertEquals(throttle.failure('bob', '10.0.0.2'), [])
+        self.assertEquals(throttle.locked('bob', '10.0.0.3'), 0)
+
+        # the lockout starts once, whatever the IP
+        self.assertEquals(throttle.failure('bob', '10.0.0.3'), ['user:bob'])
+        self.assertTrue(0 < throttle.locked('bob', '10.0.0.4') <= 0.5)
+        self.assertEquals(throttle.failure('bob', '10.0.0.4'), [])
+        self.assertEquals(throttle.locked('alice', '10.0.0.4'), 0)
+
+        time.sleep(0.6)
+        self.assertEquals(throttle.locked('bob', '10.0.0.1'), 0)
+
+    def test_ip_lockout(self):
+        throttle = FailureThrottle(max_failures=100, max_ip_failures=3,
+                                   window=60)
+        for name in ('bob', 'alice'):
+            self.assertEquals(throttle.failure(name, '10.0.0.1'), [])
+        self.assertEquals(throttle.failure('carol', '10.0.0.1'),
+                          ['ip:10.0.0.1'])
+        self.assertTrue(throttle.locked('dave', '10.0.0.1') > 0)
+        self.assertEquals(throttle.locked('dave', '10.0.0.2'), 0)
+
+    def test_sliding_window(self):
+        throttle = FailureThrottle(max_failures=4, window=0.4)
+        for i in range(3):
+            throttle.failure('bob', None)
+        # the failures of the previous period still count, partly
+        time.sleep(0.42)
+        self.assertEquals(throttle.failure('bob', None), [])
+        self.assertEquals(throttle.failure('bob', None), ['user:bob'])
+
+        # but not after two periods
+        throttle = FailureThrottle(max_failures=4, window=0.2)
+        for i in range(3):
+            throttle.failure('bob', None)
+        time.sleep(0.45)
+        self.assertEquals(throttle.failure('bob', None), [])
+
+    def test_success(self):
+        throttle = FailureThrottle(max_failures=2, window=60)
+        throttle.failure('bob', None)
+        throttle.success('bob')
+        self.assertEquals(throttle.failure('bob', None), [])
+
+    def test_max_keys(self):
+        throttle = FailureThrottle(max_keys=10)
+        for i in range(100):
+            throttle.failure('user%d' % i, '10.0.0.%d' % i)
+        self.assertEquals(len(throttle._windows), 10)
+
+    def test_get_throttle(self):
+        self.assertEquals(get_throttle({}), None)
+        throttle = get_throttle({'throttle.enabled': True,
+                                 'throttle.max_failures': 5})
+        self.assertEquals(throttle.max_failures, 5)
+        self.assertEquals(throttle.max_ip_failures, 100)
+
+    def test_client_ip(self):
+        self.assertEquals(client_ip(FakeRequest('10.0.0.1')), '10.0.0.1')
+        # the peer of a unix socket
+        self.assertEquals(client_ip(FakeRequest('')), None)
+
+        # only the hops added by the trusted proxies are used
+        request = FakeRequest('', 'spoofed, 10.0.0.2, 10.0.0.3')
+        self.assertEquals(client_ip(request), None)
+        self.assertEquals(client_ip(request, 1), '10.0.0.3')
+        self.assertEquals(client_ip(request, 2), '10.0.0.2')
+        self.assertEquals(client_ip(FakeRequest(''), 1), None)
+        self.assertEquals(client_ip(FakeRequest('', '10.0.0.2'), 2), None)
+
+    def test_no_ip(self):
+        # behind a unix socket without X-Forwarded-For, the users don't
+        # share a lockout
+        throttle = FailureThrottle(max_failures=3, max_ip_failures=3,
+                                   window=60)
+        ip = client_ip(FakeRequest(''))
+        for i in range(10):
+            self.assertEquals(throttle.failure('user%d' % i, ip), [])
+        self.assertEquals(throttle.locked('bob', ip), 0)
+        self.assertEquals(throttle.locked('bob', ''), 0)
+        self.assertEquals(throttle.failure('bob', ''), [])
+        self.assertEquals(len(throttle._windows), 11)
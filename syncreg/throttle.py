@@ -0,0 +1,262 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Throttle of the failed authentications.
+
+    [throttle]
+    enabled = true
+    max_failures = 10
+    max_ip_failures = 100
+    window = 300
+    trusted_proxies = 1
+
+The failed authentications of delete_user, change_email and
+change_password are counted per user name and per source IP over a
+sliding window of "window" seconds. Once a counter reaches its limit, the
+requests of that user or IP get a 429 for the next "window" seconds,
+before the password is checked, and the AUTH_FAILURE event is logged once
+for the whole lockout instead of once per attempt.
+
+The counters are kept per process, in at most "max_keys" entries of a
+few slots each.
+
+Behind a reverse proxy, the peer address is the proxy's, or empty on a
+unix socket: "trusted_proxies" is then the number of proxies appending
+to X-Forwarded-For, and the client IP is the address the farthest of
+them saw. Requests without a client IP are only counted per user name.
+"""
+import time
+import base64
+import binascii
+import threading
+
+from webob.exc import HTTPClientError, HTTPUnauthorized
+from cef import log_cef, AUTH_FAILURE
+
+from services.wsgiauth import Authentication
+
+from syncreg.util import LRUCache
+
+
+class HTTPTooManyRequests(HTTPClientError):
+    code = 429
+    title = 'Too Many Requests'
+    explanation = 'Too many failed authentications, retry later.'
+
+
+class _Window(object):
+    """Failures of the current and previous periods of a key."""
+    __slots__ = ('start', 'previous', 'current', 'locked_until')
+
+    def __init__(self, start):
+        self.start = start
+        self.previous = 0
+        self.current = 0
+        self.locked_until = 0
+
+
+class FailureThrottle(object):
+    """Sliding window counters of the failures, per user name and per IP.
+
+    The window is approximated with two fixed periods: the failures of
+    the previous period are weighted by the part of it still in the
+    window.
+
+    Args:
+        max_failures: failures of a user name triggering a lockout
+        max_ip_failures: failures of an IP triggering a lockout
+        window: length of the window and of the lockouts, in seconds
+        max_keys: maximum number of user names and IPs tracked
+    """
+    def __init__(self, max_failures=10, max_ip_failures=100, window=300,
+                 max_keys=100000):
+        self.max_failures = max_failures
+        self.max_ip_failures = max_ip_failures
+        self.window = window
+        # an idle key has nothing left to count after two periods
+        self._windows = LRUCache(max_keys, window * 2)
+        self._lock = threading.Lock()
+
+    def _keys(self, username, ip):
+        keys = []
+        if username is not None:
+            keys.append(('user:' + username, self.max_failures))
+        if ip:
+            keys.append(('ip:' + ip, self.max_ip_failures))
+        return keys
+
+    def locked(self, username, ip):
+        """Returns the seconds left in the lockout of the user name or of
+        the IP, or 0."""
+        now = time.time()
+        left = 0
+        for key, limit in self._keys(username, ip):
+            window = self._windows.get(key)
+            if window is not None and window.locked_until > now:
+                left = max(left, window.locked_until - now)
+        return left
+
+    def failure(self, username, ip):
+        """Counts a failure.
+
+        Returns:
+            the list of the keys ('user:name', 'ip:address') whose lockout
+            starts with this failure
+        """
+        now = time.time()
+        locked = []
+        self._lock.acquire()
+        try:
+            for key, limit in self._keys(username, ip):
+                window = self._windows.get(key)
+                if window is None:
+                    window = _Window(now)
+                elapsed = now - window.start
+                if elapsed >= self.window:
+                    periods = int(elapsed // self.window)
+                    if periods == 1:
+                        window.previous = window.current
+                    else:
+                        window.previous = 0
+                    window.current = 0
+                    window.start += periods * self.window
+                    elapsed = now - window.start
+                window.current += 1
+                count = (window.previous * (1 - elapsed / self.window) +
+                         window.current)
+                if count >= limit and window.locked_until <= now:
+                    window.locked_until = now + self.window
+                    locked.append(key)
+                # refreshes the expiration
+                self._windows.set(key, window)
+        finally:
+            self._lock.release()
+        return locked
+
+    def success(self, username):
+        """Forgets the failures of the user name."""
+        self._windows.delete('user:' + username)
+
+
+def get_throttle(config):
+    """Returns the throttle described by the [throttle] section, or None
+    when disabled."""
+    if not config.get('throttle.enabled', False):
+        return None
+    return FailureThrottle(config.get('throttle.max_failures', 10),
+                           config.get('throttle.max_ip_failures', 100),
+                           config.get('throttle.window', 300),
+                           config.get('throttle.max_keys', 100000))
+
+
+def client_ip(request, trusted_proxies=0):
+    """Returns the IP of the client, or None.
+
+    Args:
+        request: the request
+        trusted_proxies: number of proxies appending to X-Forwarded-For
+            in front of the application
+    """
+    if not trusted_proxies:
+        return request.remote_addr or None
+    hops = [hop.strip() for hop in
+            request.environ.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+    hops = [hop for hop in hops if hop]
+    if len(hops) < trusted_proxies:
+        return None
+    return hops[-trusted_proxies]
+
+
+def _basic_username(environ):
+    """Returns the user name of the Basic Authorization header, or None."""
+    auth = environ.get('HTTP_AUTHORIZATION', '')
+    if not auth.startswith('Basic '):
+        return None
+    try:
+        return base64.decodestring(auth[6:].strip()).split(':', 1)[0]
+    except (binascii.Error, ValueError):
+        return None
+
+
+class ThrottledAuthentication(Authentication):
+    """Authentication refusing the user names and IPs with too many
+    recent failures, before their password is checked."""
+
+    def __init__(self, config):
+        super(ThrottledAuthentication, self).__init__(config)
+        self.throttle = get_throttle(config)
+        self.trusted_proxies = config.get('throttle.trusted_proxies', 0)
+
+    def check_throttle(self, request, username):
+        """Raises a 429 when the user name or the IP of the request is
+        locked out."""
+        if self.throttle is None:
+            return
+        ip = client_ip(request, self.trusted_proxies)
+        left = self.throttle.locked(username, ip)
+        if left:
+            raise HTTPTooManyRequests(retry_after=int(left) + 1)
+
+    def authenticate_user(self, request, config, username=None):
+        environ = request.environ
+        if (self.throttle is None or 'REMOTE_USER' in environ or
+                'HTTP_AUTHORIZATION' not in environ):
+            return super(ThrottledAuthentication,
+                         self).authenticate_user(request, config, username)
+
+        if username is None:
+            username = _basic_username(environ)
+        ip = client_ip(request, self.trusted_proxies)
+        self.check_throttle(request, username)
+
+        try:
+            user_id = super(ThrottledAuthentication,
+                            self).authenticate_user(request, config,
+                                                    username)
+        except HTTPUnauthorized:
+            self._failure(request, config, username, ip)
+            raise
+        if user_id is None:
+            self._failure(request, config, username, ip)
+        elif username is not None:
+            self.throttle.success(username)
+        return user_id
+
+    def _failure(self, request, config, username, ip):
+        for key in self.throttle.failure(username, ip):
+            log_cef('Authentication Throttled', 5, request.environ, config,
+                    username, AUTH_FAILURE, throttled=key,
+                    window=self.throttle.window)
@@ -34,12 +34,23 @@
 #
 # ***** END LICENSE BLOCK *****
 import os
+import time
+import threading
+from ConfigParser import ConfigParser
 from mako.lookup import TemplateLookup
 
 _TPL_DIR = os.path.join(os.path.dirname(__file__), 'templates')
 _lookup = TemplateLookup(directories=[_TPL_DIR],
                          module_directory=_TPL_DIR)  # XXX defined in prod
 
+# templates that are only rendered through inheritance
+_BASE_TEMPLATES = ('base.mako',)
+
+# values used to render the templates without a request
+_SAMPLE_DATA = {'error': None, 'key': 'KEY', 'username': 'user',
+                'user_name': 'user', 'code': 'CODE', 'captcha': '',
+                'host': 'http://localhost'}
+
 
 def render_mako(template, **data):
     """Renders a mako template located in '/templates'
@@ -53,3 +64,290 @@ def render_mako(template, **data):
     """
     template = _lookup.get_template(template)
     return template.render(**data)
+
+
+class BackendProxy(object):
+    """Base class of the objects wrapping a backend.
+
+    Attributes are read from the wrapped backend, methods go through
+    _wrap_method, which subclasses override.
+    """
+    def __init__(self, backend):
+        self._backend = backend
+
+    def _wrap_method(self, name, method):
+        return method
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if not callable(attr):
+            return attr
+        return self._wrap_method(name, attr)
+
+
+_MISSING = object()
+
+
+class _Entry(object):
+    """Link of the list of LRUCache, in insertion order."""
+    __slots__ = ('prev', 'next', 'key', 'value', 'expires')
+
+    def __init__(self, key=None, value=None, expires=None):
+        self.prev = self.next = self
+        self.key = key
+        self.value = value
+        self.expires = expires
+
+
+class LRUCache(object):
+    """Thread-safe mapping that drops its least recently used entries.
+
+    Args:
+        maxsize: maximum number of entries
+        ttl: if provided, entries expire after that many seconds
+    """
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = {}
+        # circular doubly linked list, most recent entries at the end
+        self._root = _Entry()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def _append(self, entry):
+        root = self._root
+        last = root.prev
+        entry.prev = last
+        entry.next = root
+        last.next = root.prev = entry
+
+    def get(self, key, default=None):
+        """Returns the value of key, or default when missing or expired."""
+        self._lock.acquire()
+        try:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry.expires is not None and entry.expires < time.time():
+                self._unlink(entry)
+                del self._data[key]
+                return default
+            self._unlink(entry)
+            self._append(entry)
+            return entry.value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        """Sets the value of key, dropping the oldest entry if needed."""
+        if ttl is None:
+            ttl = self.ttl
+        expires = ttl is not None and time.time() + ttl or None
+        self._lock.acquire()
+        try:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._unlink(entry)
+            elif len(self._data) >= self.maxsize:
+                oldest = self._root.next
+                self._unlink(oldest)
+                del self._data[oldest.key]
+            entry = _Entry(key, value, expires)
+            self._append(entry)
+            self._data[key] = entry
+        finally:
+            self._lock.release()
+
+    def incr(self, key, delta=1):
+        """Adds delta to the value of key, keeping its expiration.
+
+        Returns:
+            the new value, or None when key is missing or expired
+        """
+        self._lock.acquire()
+        try:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry.expires is not None and entry.expires < time.time():
+                self._unlink(entry)
+                del self._data[key]
+                return None
+            entry.value += delta
+            return entry.value
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        """Removes key. Returns True if it was there."""
+        self._lock.acquire()
+        try:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return False
+            self._unlink(entry)
+            return True
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            self._root = _Entry()
+        finally:
+            self._lock.release()
+
+
+def read_config_section(path, section):
+    """Reads a section of a configuration file like sync.conf
+
+    Used by the command line tools, which don't load the application.
+
+    Returns:
+        a mapping of the raw string values
+    """
+    parser = ConfigParser()
+    if not parser.read([path]):
+        raise IOError('Could not read %r' % path)
+    return dict(parser.items(section))
+
+
+def changed_sections(old, new):
+    """Returns the sections that differ between two configurations
+
+    Args:
+        old, new: flat mappings of 'section.option' keys
+
+    Returns:
+        a sorted list of section names. Options without a section
+        are ignored.
+    """
+    changed = set()
+    for key in set(old) | set(new):
+        if '.' not in key:
+            continue
+        if old.get(key, _MISSING) != new.get(key, _MISSING):
+            changed.add(key.split('.', 1)[0])
+    return sorted(changed)
+
+
+def split_list(value):
+    """Returns the items of a comma or line separated configuration value
+
+    Args:
+        value: a string, a list or None
+
+    Returns:
+        a list of non-empty strings
+    """
+    if value is None:
+        return []
+    if isinstance(value, basestring):
+        value = value.replace('\n', ',').split(',')
+    return [item.strip() for item in value if item.strip()]
+
+
+def preload_templates():
+    """Compiles every template located in '/templates'
+
+    The compiled modules are kept by the lookup, so calling this in a
+    master process before forking lets all workers share them.
+
+    Returns:
+        the list of the loaded template names
+    """
+    names = sorted(name for name in os.listdir(_TPL_DIR)
+                   if name.endswith('.mako'))
+    for name in names:
+        _lookup.get_template(name)
+    return names
+
+
+def render_templates():
+    """Renders once every template located in '/templates'
+
+    Returns:
+        the list of the rendered template names
+    """
+    names = [name for name in preload_templates()
+             if name not in _BASE_TEMPLATES]
+    for name in names:
+        render_mako(name, **_SAMPLE_DATA)
+    return names
+
+
+def unwrap_app(app):
+    """Returns the application wrapped by the WSGI middlewares.
+
+    Args:
+        app: the object returned by make_app
+
+    Returns:
+        the first object found that holds the controllers, or None
+    """
+    while app is not None and not hasattr(app, 'controllers'):
+        for attr in ('application', 'app', 'wrap_app'):
+            wrapped = getattr(app, attr, None)
+            if wrapped is not None:
+                app = wrapped
+                break
+        else:
+            return None
+    return app
+
+
+def iter_engines(app):
+    """Yields the SQLAlchemy engines used by the application backends.
+
+    Args:
+        app: the application, wrapped or not
+
+    Yields:
+        (name, engine) tuples
+    """
+    app = unwrap_app(app)
+    if app is None:
+        return
+
+    backends = [('auth', app.auth.backend)]
+    user = app.controllers.get('user')
+    if user is not None and getattr(user, 'reset', None) is not None:
+        backends.append(('reset_codes', user.reset))
+
+    for name, backend in backends:
+        for item in backend_engines(name, backend):
+            yield item
+
+
+def backend_engines(name, backend):
+    """Yields the SQLAlchemy engines of a backend.
+
+    Args:
+        name: the name of the backend, used as a prefix
+        backend: the backend, proxied or not
+
+    Yields:
+        (name, engine) tuples
+    """
+    engines = getattr(backend, 'iter_engines', None)
+    if engines is not None:
+        for sub, engine in engines():
+            yield '%s.%s' % (name, sub), engine
+        return
+    engine = getattr(backend, '_engine', None)
+    if engine is not None:
+        yield name, engine
+
+
+def dispose_engines(app):
+    """Drops all pooled connections, so a forked process gets its own."""
+    for __, engine in iter_engines(app):
+        engine.dispose()
@@ -0,0 +1,176 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Warm-up of the application.
+
+Runs when the application is created, before it takes traffic: opens some
+pooled connections on every backend engine, renders each template once and
+looks up a canary user. Until all of this succeeded, the readiness page
+answers with a 503.
+"""
+import os
+import time
+import threading
+import traceback
+
+from services.user import User
+
+from syncreg import logger
+from syncreg.util import iter_engines, render_templates
+
+
+class Warmup(object):
+    """Warms up an application.
+
+    Options, from the [warmup] section:
+
+    - pool_connections: connections opened on each engine (default: 5)
+    - templates: renders every template once (default: true)
+    - canary: looks up a user (default: true)
+    - canary_user: the user looked up (default: __warmup__)
+    - background: warms up in a thread (default: true)
+    - retry_delay: seconds between two attempts in the background
+      (default: 5)
+    """
+    def __init__(self, app):
+        self.app = app
+        config = app.config
+        self.pool_connections = config.get('warmup.pool_connections', 5)
+        self.templates = config.get('warmup.templates', True)
+        self.canary = config.get('warmup.canary', True)
+        self.canary_user = config.get('warmup.canary_user', '__warmup__')
+        self.background = config.get('warmup.background', True)
+        self.retry_delay = config.get('warmup.retry_delay', 5)
+        self.ready = False
+        self.errors = []
+        self.duration = None
+        self._done = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the warm-up, in a thread if configured so.
+
+        Called again in each forked worker, since neither the threads nor
+        the pooled connections survive the fork.
+        """
+        self.ready = False
+        self.errors = []
+        self._stopped.clear()
+        self._done.clear()
+        if not self.background:
+            self.run()
+            return
+
+        self._thread = threading.Thread(target=self._run_until_ready)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        """Waits for the warm-up to end. Returns True if the app is ready."""
+        self._done.wait(timeout)
+        return self.ready
+
+    def stop(self):
+        """Stops retrying in the background."""
+        self._stopped.set()
+
+    def join(self, timeout=None):
+        """Stops the warm-up and waits for its thread to exit.
+
+        Returns:
+            True if no warm-up thread is running anymore
+        """
+        self.stop()
+        if self._thread is None:
+            return True
+        self._thread.join(timeout)
+        if self._thread.isAlive():
+            return False
+        self._thread = None
+        return True
+
+    def _run_until_ready(self):
+        while not self.run() and not self._stopped.isSet():
+            self._stopped.wait(self.retry_delay)
+
+    def run(self):
+        """Runs all the steps once. Returns True if they all succeeded."""
+        start = time.time()
+        errors = []
+        for name, step in (('pools', self.warm_pools),
+                           ('templates', self.warm_templates),
+                           ('canary', self.run_canary)):
+            try:
+                step()
+            except Exception:
+                logger.error('Warm-up step %r failed' % name)
+                logger.error(traceback.format_exc())
+                errors.append(name)
+
+        self.errors = errors
+        self.duration = time.time() - start
+        self.ready = not errors
+        if self.ready or not self.background:
+            self._done.set()
+        if self.ready:
+            logger.info('Warm-up done in %.2fs (pid %d)' % (self.duration,
+                                                            os.getpid()))
+        return self.ready
+
+    def warm_pools(self):
+        """Fills the connection pools."""
+        if not self.pool_connections:
+            return
+        for name, engine in iter_engines(self.app):
+            conns = []
+            try:
+                for i in range(self.pool_connections):
+                    conns.append(engine.connect())
+            finally:
+                # the connections go back into the pool
+                for conn in conns:
+                    conn.close()
+
+    def warm_templates(self):
+        """Compiles and renders every template."""
+        if self.templates:
+            render_templates()
+
+    def run_canary(self):
+        """Looks up a user, which goes through the whole auth backend."""
+        if self.canary:
+            self.app.auth.backend.get_user_id(User(self.canary_user))
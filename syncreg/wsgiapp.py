@@ -36,11 +36,22 @@
 """
 Application entry point.
 """
-from services.baseapp import set_app
-from services.wsgiauth import Authentication
+from services.baseapp import set_app, SyncServerApp
 
+from syncreg import logger
 from syncreg.controllers.user import UserController
 from syncreg.controllers.static import StaticController
+from syncreg.controllers.status import StatusController
+from syncreg.admission import AdmissionControl
+from syncreg.deadline import DeadlinePolicy
+from syncreg.health import HealthChecker
+from syncreg.memory import get_profiler
+from syncreg.pools import PoolMonitor
+from syncreg.reload import ConfigReloader
+from syncreg.stats import Counters
+from syncreg.throttle import ThrottledAuthentication
+from syncreg.util import dispose_engines
+from syncreg.warmup import Warmup
 
 
 _EXTRAS = {'auth': True}
@@ -75,8 +86,61 @@ urls = [('GET', _url('/user/_API_/_USERNAME_'), 'user', 'user_exists'),
         (('GET', 'POST'), _url('/misc/_API_/captcha_html'), 'user',
          'captcha_form'),
         # media   XXX served by Apache in real production
-        ('GET', '/media/{filename}', 'static', 'get_file')]
+        ('GET', '/media/{filename}', 'static', 'get_file'),
 
+        # status
+        ('GET', '/__ready__', 'status', 'ready'),
+        ('GET', '/__health__', 'status', 'health'),
+        ('GET', '/__stats__', 'status', 'stats'),
+        ('POST', '/__reload__', 'status', 'reload'),
+        ('GET', '/__memory__', 'status', 'memory')]
 
-controllers = {'user': UserController, 'static': StaticController}
-make_app = set_app(urls, controllers, auth_class=Authentication)
+
+class SyncRegApp(SyncServerApp):
+    """The registration application."""
+
+    def __init__(self, urls, controllers, config=None, auth_class=None):
+        self.counters = Counters()
+        # traces the allocations of everything built below
+        self.memory = get_profiler(config or {})
+        super(SyncRegApp, self).__init__(urls, controllers, config,
+                                         auth_class)
+        self.admission = AdmissionControl(self.config)
+        self.deadlines = DeadlinePolicy(self.config, self.counters)
+        self.pools = PoolMonitor(self)
+        self.warmup = Warmup(self)
+        self.warmup.start()
+        # the health threads are started by the first status() call, so
+        # that a pre-fork master doesn't hold connections
+        self.health = HealthChecker(self)
+        self.reloader = ConfigReloader(self)
+        if self.config.get('reload.signal', False):
+            try:
+                self.reloader.install()
+            except ValueError:
+                logger.warning('The HUP signal can only be handled when '
+                               'the application is loaded in the main '
+                               'thread')
+
+    def after_fork(self):
+        """Called in a worker process right after the fork."""
+        dispose_engines(self)
+        # disposing replaced the pools
+        self.pools.instrument()
+        self.warmup.start()
+        self.health.start()
+
+    def _get_function(self, controller, action):
+        function = super(SyncRegApp, self)._get_function(controller, action)
+        if function is None:
+            return None
+        function = self.pools.wrap(action, function)
+        # the time spent waiting for admission counts in the deadline
+        function = self.admission.wrap(action, function)
+        return self.deadlines.wrap(action, function)
+
+
+controllers = {'user': UserController, 'static': StaticController,
+               'status': StatusController}
+make_app = set_app(urls, controllers, klass=SyncRegApp,
+                   auth_class=ThrottledAuthentication)